@@ -1,63 +1,1870 @@
+from time import sleep, monotonic, perf_counter
+MODULE_STARTED = perf_counter()
 import tkinter as tk
 import tkinter.ttk as ttk
-from time import sleep
 import threading
-import requests
+import heapq
+import bisect
+import itertools
+import queue
+import os
+import json
+import hashlib
+import string
+import codecs
+import importlib
+import urllib.parse
+from collections import namedtuple
+from operator import itemgetter
 import numpy as np
-import matplotlib.pyplot as plt
 from abc import ABC, abstractmethod
-from datetime import datetime
-import matplotlib.animation as animation
+from datetime import date, datetime, timezone
 import random
 
 
+class LazyModule:
+    """
+    Stands in for a module that is only imported the first time one of its attributes is used, keeping the http,
+    plotting, concurrency and command line libraries off the startup path until the feature using them is first needed.
+    """
+    def __init__(self, name):
+        """
+        :param name: full name of the module to import, eg "matplotlib.pyplot"
+        """
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+requests = LazyModule("requests")
+plt = LazyModule("matplotlib.pyplot")
+futures = LazyModule("concurrent.futures")
+multiprocessing = LazyModule("multiprocessing")
+http_server = LazyModule("http.server")
+email_utils = LazyModule("email.utils")
+argparse = LazyModule("argparse")
+IMPORTS_LOADED = perf_counter()
+
+
+# outcome of one round of Publisher.notify_observers. latencies maps each observer that finished to the seconds its
+# update took, failures maps each observer whose update raised to the exception, timed_out maps each observer still
+# running when its timeout ran out to the Future of its update, skipped lists the observers not updated because an
+# update of theirs that timed out in an earlier round is still running, and slowest lists the (seconds, observer) pairs
+# of the slowest observers
+DispatchReport = namedtuple("DispatchReport", ["latencies", "failures", "timed_out", "skipped", "slowest"])
+
 
 class Publisher(ABC):
+    def __init__(self, width=1, timeout=None, slowest_count=5):
+        """
+        Create a set of subscribers(observers) who want to be notified on data change
+        :param width: number of observers updated at the same time, 1 updates them one after another on the calling
+                      thread
+        :param timeout: seconds an observer may take to update before it is reported as timed out, None waits for
+                        every observer
+        :param slowest_count: number of the slowest observers kept in each DispatchReport
+        """
+        self.observers = set()
+        self.width = width
+        self.timeout = timeout
+        self.slowest_count = slowest_count
+        self.executor = None
+        self.last_report = None
+        # observer to the Future of its update that timed out and is still running on the pool
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+
+    def attach(self, observer):
+        """
+        register an observer(a Patient object) to be notified
+        :param observer: object to add to the Publishers set to be notified
+        :return: none
+        """
+        self.observers.add(observer)
+
+    def detach(self, observer):
+        """
+        deregister observer from being notified
+        :param observer: object to remove from the Publisher set
+        :return:none
+        """
+        self.observers.discard(observer)
+
+    def notify_observers(self, observers=None):
+        """
+        Notify observer objects that they must update. An observer whose update raises does not stop the others from
+        being updated, its exception is reported instead. With a width above 1 the observers are updated concurrently
+        on a thread pool, and an observer that takes longer than the timeout is reported as timed out and no longer
+        waited for, though its update carries on in the background and can be followed through the Future reported.
+        Until that update finishes the observer is skipped, so a slow observer never holds more than one pool worker.
+        :param observers: optional subset of the attached observers to notify, defaults to all of them
+        :return: DispatchReport of the round, also kept as last_report
+        """
+        if observers is None:
+            observers = list(self.observers)
+        latencies = {}
+        failures = {}
+        timed_out = {}
+        skipped = []
+        if self.width <= 1:
+            for observer in observers:
+                started = perf_counter()
+                try:
+                    observer.update()
+                except Exception as error:
+                    failures[observer] = error
+                latencies[observer] = perf_counter() - started
+        else:
+            if self.executor is None:
+                self.executor = futures.ThreadPoolExecutor(max_workers=self.width, thread_name_prefix="notify")
+            started = {}
+            pending = {}
+            with self.in_flight_lock:
+                for observer in observers:
+                    if observer in self.in_flight:
+                        skipped.append(observer)
+                    else:
+                        pending[self.executor.submit(self.timed_update, observer, started)] = observer
+            while pending:
+                # wake when an update finishes, or when the first running update runs out of time
+                wait_for = None
+                if self.timeout is not None:
+                    running = [started[observer] for observer in pending.values() if observer in started]
+                    wait_for = max(min(running) + self.timeout - perf_counter(), 0.0) if running else self.timeout
+                done, not_done = futures.wait(pending, timeout=wait_for, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    observer = pending.pop(future)
+                    error, latency = future.result()
+                    latencies[observer] = latency
+                    if error is not None:
+                        failures[observer] = error
+                if self.timeout is not None:
+                    now = perf_counter()
+                    for future in list(pending):
+                        observer = pending[future]
+                        if observer in started and now - started[observer] >= self.timeout:
+                            del pending[future]
+                            timed_out[observer] = future
+                            with self.in_flight_lock:
+                                self.in_flight[observer] = future
+                            future.add_done_callback(lambda done, observer=observer: self.finish_in_flight(observer))
+
+        slowest = heapq.nlargest(self.slowest_count, ((latencies[observer], observer) for observer in latencies),
+                                 key=lambda pair: pair[0])
+        self.last_report = DispatchReport(latencies, failures, timed_out, skipped, slowest)
+        return self.last_report
+
+    def finish_in_flight(self, observer):
+        with self.in_flight_lock:
+            self.in_flight.pop(observer, None)
+
+    @staticmethod
+    def timed_update(observer, started):
+        # runs on the pool, recording when the update started so its timeout is counted from then rather than from
+        # when it was queued
+        started[observer] = perf_counter()
+        try:
+            observer.update()
+            error = None
+        except Exception as exception:
+            error = exception
+        return error, perf_counter() - started[observer]
+
+
+class Observer(ABC):
+    @abstractmethod
+    def update(self):
+        """
+        Once the subject has notified the observers that they should be updated, this method will execute.
+        :return:none
+        """
+        pass
+
+
+class PollScheduler:
+    """
+    Decides when each attached patient is next polled, backed by a priority queue of next-due times. A patient whose
+    values stay the same is polled less and less often, up to the ceiling, while a patient whose values change or
+    breach a limit is polled more often again, down to the floor.
+    """
+    def __init__(self, floor, ceiling, backoff=2.0, jitter=True):
+        """
+        Create an empty schedule
+        :param floor: shortest interval between polls of a patient, in seconds
+        :param ceiling: longest interval between polls of a patient, in seconds
+        :param backoff: factor the interval grows by after a poll without change, and shrinks by after a change
+        :param jitter: spread the first poll of each patient randomly over the floor interval, so polls do not all
+                       arrive in one burst every period
+        """
+        self.floor = floor
+        self.ceiling = max(ceiling, floor)
+        self.backoff = backoff
+        self.jitter = jitter
+        self.intervals = {}
+        self.due_times = {}
+        self.queue = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def __contains__(self, patient_id):
+        return patient_id in self.intervals
+
+    def set_bounds(self, floor, ceiling):
+        """
+        Change the floor and ceiling, clamping the current interval of every patient into the new range
+        :param floor: shortest interval between polls of a patient, in seconds
+        :param ceiling: longest interval between polls of a patient, in seconds
+        :return: none
+        """
+        with self.lock:
+            self.floor = floor
+            self.ceiling = max(ceiling, floor)
+            for patient_id in self.intervals:
+                self.intervals[patient_id] = self.clamp(self.intervals[patient_id])
+
+    def clamp(self, interval):
+        return min(max(interval, self.floor), self.ceiling)
+
+    def add(self, patient_id, now=None):
+        """
+        Start polling a patient at the floor interval
+        :param patient_id: id of the patient to schedule
+        :param now: current monotonic time, defaults to time.monotonic()
+        :return: none
+        """
+        now = monotonic() if now is None else now
+        with self.lock:
+            if patient_id in self.intervals:
+                return
+            self.intervals[patient_id] = self.floor
+            if self.jitter:
+                self.push(patient_id, now + random.uniform(0, self.floor))
+            else:
+                self.push(patient_id, now + self.floor)
+
+    def remove(self, patient_id):
+        """
+        Stop polling a patient. Its entry stays in the queue, but is skipped once it reaches the front.
+        :param patient_id: id of the patient to unschedule
+        :return: none
+        """
+        with self.lock:
+            self.intervals.pop(patient_id, None)
+            self.due_times.pop(patient_id, None)
+
+    def push(self, patient_id, due_time):
+        self.due_times[patient_id] = due_time
+        heapq.heappush(self.queue, (due_time, patient_id))
+
+    def discard_stale(self):
+        # entries for removed or rescheduled patients are left in the heap and dropped once they reach the front
+        while self.queue and self.due_times.get(self.queue[0][1]) != self.queue[0][0]:
+            heapq.heappop(self.queue)
+
+    def next_due(self):
+        """
+        :return: monotonic time at which the next patient is due, or None if no patient is waiting to be polled
+        """
+        with self.lock:
+            self.discard_stale()
+            return self.queue[0][0] if self.queue else None
+
+    def pop_due(self, now=None):
+        """
+        Take every patient whose poll is due. They are not rescheduled until record is called with the poll result.
+        :param now: current monotonic time, defaults to time.monotonic()
+        :return: list of patient ids to poll
+        """
+        now = monotonic() if now is None else now
+        due = []
+        with self.lock:
+            self.discard_stale()
+            while self.queue and self.queue[0][0] <= now:
+                due_time, patient_id = heapq.heappop(self.queue)
+                del self.due_times[patient_id]
+                due.append(patient_id)
+                self.discard_stale()
+        return due
+
+    def record(self, patient_id, changed, breached=False, now=None):
+        """
+        Reschedule a patient after it has been polled. A breach drops straight to the floor, a change shrinks the
+        interval by the backoff factor, and a poll with no change grows it by the backoff factor.
+        :param patient_id: id of the patient that was polled
+        :param changed: whether any of the patients values changed in the poll
+        :param breached: whether the patients values are above a set limit
+        :param now: current monotonic time, defaults to time.monotonic()
+        :return: the patients new interval in seconds, or None if the patient is no longer scheduled
+        """
+        now = monotonic() if now is None else now
+        with self.lock:
+            if patient_id not in self.intervals:
+                return None
+            interval = self.intervals[patient_id]
+            if breached:
+                interval = self.floor
+            elif changed:
+                interval = interval / self.backoff
+            else:
+                interval = interval * self.backoff
+            interval = self.clamp(interval)
+            self.intervals[patient_id] = interval
+            self.push(patient_id, now + interval)
+            return interval
+
+
+class ConsistentHashRing:
+    """
+    Assigns keys to nodes by consistent hashing. Each node is placed at several points on a ring of hashes, and a key
+    belongs to the node at the first point at or after its own hash, so adding or removing a node only moves the keys
+    between it and its neighbours.
+    """
+    def __init__(self, nodes=(), replicas=64):
+        """
+        :param nodes: initial node names
+        :param replicas: points placed on the ring per node, more spreading the keys more evenly
+        """
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+        for node in nodes:
+            self.add_node(node)
+
+    def __len__(self):
+        return len(set(self.owners.values()))
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+    def add_node(self, node):
+        for replica in range(self.replicas):
+            point = self.hash(str(node) + "#" + str(replica))
+            self.owners[point] = node
+            bisect.insort(self.points, point)
+
+    def remove_node(self, node):
+        for replica in range(self.replicas):
+            point = self.hash(str(node) + "#" + str(replica))
+            if self.owners.get(point) == node:
+                del self.owners[point]
+                del self.points[bisect.bisect_left(self.points, point)]
+
+    def node_for(self, key):
+        """
+        :param key: key to place, eg a patient id
+        :return: the node the key belongs to, or None if the ring is empty
+        """
+        if not self.points:
+            return None
+        position = bisect.bisect_left(self.points, self.hash(key)) % len(self.points)
+        return self.owners[self.points[position]]
+
+
+class PollShard:
+    """
+    Poll loop run in a worker process by the ShardedPoller. It polls the patients of its shard with its own scheduler,
+    connection pool and rate limit, parsing their responses in its own interpreter, and sends back only the readings of
+    the patients that changed.
+    """
+    def __init__(self, root_url, rate, floor, ceiling, width=4, timeout=60.0):
+        """
+        :param root_url: base url of the FHIR server
+        :param rate: requests per second this shard may send
+        :param floor: shortest poll interval in seconds
+        :param ceiling: longest poll interval in seconds
+        :param width: number of patients updated at the same time
+        :param timeout: seconds a patient may take to update
+        """
+        self.root_url = root_url
+        self.rate = rate
+        self.floor = floor
+        self.ceiling = ceiling
+        self.width = width
+        self.timeout = timeout
+
+    def run(self, commands, deltas):
+        """
+        Run in the worker process until told to stop. Commands are ("add", patient id, name, readings),
+        ("remove", patient id), ("breached", patient id), ("bounds", floor, ceiling), ("rate", requests per second)
+        and ("stop",). Each change is
+        sent to deltas as (patient id, readings), readings in the order of Patient.get_readings. A patient whose update
+        times out is held out of the schedule until the update finishes, which puts ("finished", patient id) on
+        commands, and its change is sent then.
+        :param commands: multiprocessing queue of commands from the ShardedPoller
+        :param deltas: multiprocessing queue of changed readings to the ShardedPoller
+        :return: none
+        """
+        Server.root_url = self.root_url
+        Server.rate_limiter = RateLimiter(self.rate, max(self.rate * 2, 1))
+        Server.session = requests.Session()
+        scheduler = PollScheduler(self.floor, self.ceiling)
+        publisher = Publisher(width=self.width, timeout=self.timeout)
+        patients = {}
+        # patient id to the readings from before an update that is still running after its timeout
+        running = {}
+        while True:
+            due_time = scheduler.next_due()
+            wait_for = scheduler.floor if due_time is None else min(due_time - monotonic(), scheduler.floor)
+            wait_for = max(wait_for, Server.circuit_breaker.retry_in(), 0.0)
+            try:
+                command = commands.get(timeout=wait_for) if wait_for > 0 else commands.get_nowait()
+            except queue.Empty:
+                command = None
+            while command is not None:
+                if command[0] == "stop":
+                    Server.session.close()
+                    return
+                if command[0] == "add":
+                    patient = Patient(command[2], '-', '-', '-', '-', '-', '-', '-', '-', command[1], '-', '-')
+                    patient.set_readings(command[3])
+                    patients[patient._id] = patient
+                    scheduler.add(patient._id)
+                elif command[0] == "remove":
+                    patients.pop(command[1], None)
+                    running.pop(command[1], None)
+                    scheduler.remove(command[1])
+                elif command[0] == "breached" and command[1] in scheduler and command[1] not in running:
+                    scheduler.record(command[1], True, True)
+                elif command[0] == "finished" and command[1] in running:
+                    before = running.pop(command[1])
+                    readings = patients[command[1]].get_readings()
+                    changed = readings != before
+                    scheduler.record(command[1], changed)
+                    if changed:
+                        deltas.put((command[1], readings))
+                elif command[0] == "bounds":
+                    scheduler.set_bounds(command[1], command[2])
+                elif command[0] == "rate":
+                    Server.rate_limiter = RateLimiter(command[1], max(command[1] * 2, 1))
+                try:
+                    command = commands.get_nowait()
+                except queue.Empty:
+                    command = None
+
+            due_patients = [patients[patient_id] for patient_id in scheduler.pop_due() if patient_id in patients]
+            if not due_patients:
+                continue
+            before = {}
+            for patient in due_patients:
+                before[patient._id] = patient.get_readings()
+            report = publisher.notify_observers(due_patients)
+            for patient in report.failures:
+                print("update failed for patient " + patient._id + ": " + str(report.failures[patient]))
+            # as in Controller.update_now, a patient that timed out is not rescheduled until its update finishes, and
+            # its change is diffed against the readings from before it then
+            for patient in report.timed_out:
+                print("update timed out for patient " + patient._id)
+                running[patient._id] = before[patient._id]
+                report.timed_out[patient].add_done_callback(
+                    lambda future, patient_id=patient._id: commands.put(("finished", patient_id)))
+            for patient in due_patients:
+                if patient in report.timed_out:
+                    continue
+                readings = patient.get_readings()
+                changed = readings != before[patient._id]
+                scheduler.record(patient._id, changed)
+                if changed:
+                    deltas.put((patient._id, readings))
+
+
+class ShardedPoller:
+    """
+    Polls a large set of patients from several worker processes, so that the parsing of responses is not bound by the
+    interpreter lock of the ui process. Patient ids are partitioned across the shards by consistent hashing. The number
+    of shards follows the number of patients, up to max_shards, and when it changes only the patients whose shard
+    changed are moved. Changed readings come back through a single queue, emptied with drain.
+    """
+    def __init__(self, floor, ceiling, max_shards=4, patients_per_shard=2000, width=4, timeout=60.0):
+        """
+        :param floor: shortest poll interval in seconds
+        :param ceiling: longest poll interval in seconds
+        :param max_shards: most worker processes to run
+        :param patients_per_shard: patients a shard is expected to keep up with before another is started
+        :param width: number of patients each shard updates at the same time
+        :param timeout: seconds a patient may take to update
+        """
+        self.floor = floor
+        self.ceiling = ceiling
+        self.max_shards = max_shards
+        self.patients_per_shard = patients_per_shard
+        self.width = width
+        self.timeout = timeout
+        # spawn rather than fork, so the workers do not inherit the tkinter state of the ui process
+        self.context = multiprocessing.get_context("spawn")
+        self.deltas = self.context.Queue()
+        self.ring = ConsistentHashRing()
+        self.shards = {}
+        self.shard_counter = itertools.count()
+        self.assignment = {}
+        self.patients = {}
+
+    def __len__(self):
+        return len(self.patients)
+
+    def __contains__(self, patient_id):
+        return patient_id in self.patients
+
+    def shard_rate(self):
+        # the shards share the request rate of the whole application between them
+        return Server.rate_limiter.rate / max(len(self.shards), 1)
+
+    def start_shard(self):
+        shard_id = next(self.shard_counter)
+        commands = self.context.Queue()
+        shard = PollShard(Server.root_url, self.shard_rate(), self.floor, self.ceiling, self.width, self.timeout)
+        process = self.context.Process(target=shard.run, args=(commands, self.deltas), daemon=True)
+        process.start()
+        self.shards[shard_id] = (process, commands)
+        self.ring.add_node(shard_id)
+
+    def stop_shard(self, shard_id):
+        process, commands = self.shards.pop(shard_id)
+        self.ring.remove_node(shard_id)
+        commands.put(("stop",))
+
+    def wanted_shards(self):
+        return min(max(-(-len(self.patients) // self.patients_per_shard), 1), self.max_shards)
+
+    def resize(self):
+        """
+        Start or stop shards to match the number of patients, then move the patients whose shard changed
+        :return: none
+        """
+        wanted = self.wanted_shards()
+        if wanted == len(self.shards):
+            return
+        while len(self.shards) < wanted:
+            self.start_shard()
+        while len(self.shards) > wanted:
+            self.stop_shard(max(self.shards))
+        for patient_id in self.patients:
+            self.place(patient_id)
+        # the request rate is shared out again between the new number of shards
+        rate = self.shard_rate()
+        for shard_id in self.shards:
+            self.shards[shard_id][1].put(("rate", rate))
+        print("polling " + str(len(self.patients)) + " patients over " + str(len(self.shards)) + " shards at " +
+              str(round(rate, 1)) + " requests per second each")
+
+    def place(self, patient_id):
+        # send the patient to the shard that owns it on the ring, removing it from the shard it was on before
+        shard_id = self.ring.node_for(patient_id)
+        previous = self.assignment.get(patient_id)
+        if previous == shard_id:
+            return
+        if previous in self.shards:
+            self.shards[previous][1].put(("remove", patient_id))
+        name, readings = self.patients[patient_id]
+        self.shards[shard_id][1].put(("add", patient_id, name, readings))
+        self.assignment[patient_id] = shard_id
+
+    def add(self, patient):
+        """
+        Start polling a patient on the shard it hashes to
+        :param patient: Patient object
+        :return: none
+        """
+        self.patients[patient._id] = (patient._name, patient.get_readings())
+        if len(self.shards) != self.wanted_shards():
+            self.resize()
+        self.place(patient._id)
+
+    def remove(self, patient_id):
+        if patient_id not in self.patients:
+            return
+        del self.patients[patient_id]
+        shard_id = self.assignment.pop(patient_id)
+        if shard_id in self.shards:
+            self.shards[shard_id][1].put(("remove", patient_id))
+        self.resize()
+
+    def mark_breached(self, patient_id):
+        # a patient breaching a limit is polled again at the floor
+        if patient_id in self.assignment:
+            self.shards[self.assignment[patient_id]][1].put(("breached", patient_id))
+
+    def set_bounds(self, floor, ceiling):
+        self.floor = floor
+        self.ceiling = ceiling
+        for shard_id in self.shards:
+            self.shards[shard_id][1].put(("bounds", floor, ceiling))
+
+    def drain(self):
+        """
+        Collect the readings sent back by the shards since the last drain, without waiting
+        :return: dictionary mapping each changed patient id to its latest readings
+        """
+        changes = {}
+        while True:
+            try:
+                patient_id, readings = self.deltas.get_nowait()
+            except queue.Empty:
+                return changes
+            if patient_id in self.patients:
+                self.patients[patient_id] = (self.patients[patient_id][0], readings)
+                changes[patient_id] = readings
+
+    def stop(self):
+        for shard_id in list(self.shards):
+            self.stop_shard(shard_id)
+        self.assignment.clear()
+
+
+class AlertRule:
+    """
+    A single alert condition over one of a patients vitals, such as "systolic > 140 for 3" or "total_chol > p90". The
+    threshold is either a fixed number, the mean of the current values of every patient ("mean"), or a percentile of
+    them ("p90"). A rule with "for N" only raises once the last N readings all meet the condition.
+    """
+    VITALS = ("total_chol", "systolic", "diastolic")
+    OPERATORS = {">": np.greater, ">=": np.greater_equal, "<": np.less, "<=": np.less_equal}
+
+    def __init__(self, name, vital, operator, threshold, consecutive=1):
+        """
+        :param name: unique name of the rule, used to report its transitions
+        :param vital: one of AlertRule.VITALS
+        :param operator: one of the keys of AlertRule.OPERATORS
+        :param threshold: a number, "mean", or a percentile written as "p" followed by a number between 0 and 100
+        :param consecutive: number of consecutive readings that must meet the condition
+        """
+        if vital not in self.VITALS:
+            raise ValueError("unknown vital " + str(vital))
+        if operator not in self.OPERATORS:
+            raise ValueError("unknown operator " + str(operator))
+        if consecutive < 1:
+            raise ValueError("consecutive readings must be at least 1")
+        self.name = name
+        self.vital = vital
+        self.operator = operator
+        self.consecutive = consecutive
+        self.percentile = None
+        self.threshold = None
+        if threshold == "mean":
+            self.threshold = threshold
+        elif isinstance(threshold, str) and threshold.startswith("p"):
+            self.percentile = float(threshold[1:])
+            if not 0 <= self.percentile <= 100:
+                raise ValueError("percentile must be between 0 and 100")
+        else:
+            self.threshold = float(threshold)
+
+    @classmethod
+    def parse(cls, name, text):
+        """
+        Compile a rule written as "<vital> <operator> <threshold> [for <N> [readings]]"
+        :param name: unique name of the rule
+        :param text: the rule text
+        :return: AlertRule
+        """
+        tokens = text.split()
+        # the optional clause is "for <N>" or "for <N> readings", a "for" on its own is not accepted
+        clause = tokens[3:]
+        if len(clause) == 3 and clause[2] == "readings":
+            clause = clause[:2]
+        if len(tokens) < 3 or (clause and (len(clause) != 2 or clause[0] != "for" or not clause[1].isdigit())):
+            raise ValueError("rules are written as '<vital> <operator> <threshold> [for <N> [readings]]', got " +
+                             repr(text))
+        consecutive = int(clause[1]) if clause else 1
+        return cls(name, tokens[0], tokens[1], tokens[2], consecutive)
+
+    def is_dynamic(self):
+        """
+        :return: whether the threshold is computed from the current values on every evaluation
+        """
+        return self.percentile is not None or self.threshold == "mean"
+
+    def get_threshold(self):
+        """
+        :return: the threshold as given, a number, "mean", or a percentile such as "p90"
+        """
+        return "p%g" % self.percentile if self.percentile is not None else self.threshold
+
+
+class RuleEngine:
+    """
+    Evaluates every alert rule over every patient at once. The current values and recent readings of each vital are
+    held in one array per vital with a row per patient, and rules sharing a vital, operator and number of consecutive
+    readings are compiled into a single group whose thresholds are compared against the readings in one vectorized
+    pass. Only transitions are reported: a rule is raised when a patient starts meeting it, and cleared when they stop.
+    """
+    def __init__(self, depth=8):
+        """
+        :param depth: number of readings kept per patient and vital, the largest consecutive count a rule can use
+        """
+        self.depth = depth
+        self.rules = {}
+        self.groups = []
+        self.patient_ids = []
+        self.rows = {}
+        self.history = {}
+        self.reading_times = {}
+        self.active = {}
+        self.lock = threading.Lock()
+        for vital in AlertRule.VITALS:
+            self.history[vital] = np.full((0, depth), np.nan)
+            self.reading_times[vital] = np.empty(0, dtype=object)
+
+    def set_rule(self, rule):
+        """
+        Add a rule, replacing any rule with the same name. Its state starts cleared, so patients already meeting it are
+        reported as raised on the next evaluation.
+        :param rule: AlertRule
+        :return: none
+        """
+        if rule.consecutive > self.depth:
+            raise ValueError("rules can use at most " + str(self.depth) + " consecutive readings")
+        with self.lock:
+            self.rules[rule.name] = rule
+            self.active[rule.name] = np.zeros(len(self.patient_ids), dtype=bool)
+            self.compile()
+
+    def remove_rule(self, name):
+        """
+        Remove a rule. Patients it was raised for are not reported as cleared.
+        :param name: name of the rule to remove
+        :return: none
+        """
+        with self.lock:
+            self.rules.pop(name, None)
+            self.active.pop(name, None)
+            self.compile()
+
+    def compile(self):
+        # group the rules so that each group is a single broadcast comparison of (patients, readings) against
+        # (rules,) thresholds
+        groups = {}
+        for rule in self.rules.values():
+            groups.setdefault((rule.vital, rule.operator, rule.consecutive), []).append(rule)
+        self.groups = []
+        for (vital, operator, consecutive), rules in groups.items():
+            static = np.array([np.nan if rule.is_dynamic() else rule.threshold for rule in rules], dtype=float)
+            self.groups.append((vital, AlertRule.OPERATORS[operator], consecutive, rules, static))
+
+    @staticmethod
+    def to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+
+    def sync_rows(self, patient_ids):
+        # keep one row per patient in the order given, carrying over the history of patients already known
+        if patient_ids == self.patient_ids:
+            return
+        old_rows = self.rows
+        keep = np.array([old_rows.get(patient_id, -1) for patient_id in patient_ids], dtype=int)
+        known = keep >= 0
+        for vital in AlertRule.VITALS:
+            history = np.full((len(patient_ids), self.depth), np.nan)
+            times = np.empty(len(patient_ids), dtype=object)
+            history[known] = self.history[vital][keep[known]]
+            times[known] = self.reading_times[vital][keep[known]]
+            self.history[vital] = history
+            self.reading_times[vital] = times
+        for name in self.active:
+            active = np.zeros(len(patient_ids), dtype=bool)
+            active[known] = self.active[name][keep[known]]
+            self.active[name] = active
+        self.patient_ids = list(patient_ids)
+        self.rows = {patient_id: row for row, patient_id in enumerate(self.patient_ids)}
+
+    def observe(self, patient_dict, hidden):
+        # record the current readings, shifting a new reading into the history whenever its date has changed
+        patients = list(patient_dict.values())
+        self.sync_rows(list(patient_dict))
+        time_getters = {"total_chol": lambda patient: patient._last_update,
+                        "systolic": lambda patient: patient._blood_pressure_time,
+                        "diastolic": lambda patient: patient._blood_pressure_time}
+        for vital in AlertRule.VITALS:
+            values = np.array([np.nan if vital in hidden.get(patient._id, ()) else
+                               self.to_float(getattr(patient, "_" + vital)) for patient in patients], dtype=float)
+            times = np.empty(len(patients), dtype=object)
+            times[:] = [str(time_getters[vital](patient)) for patient in patients]
+            history = self.history[vital]
+            new_reading = times != self.reading_times[vital]
+            history[new_reading, :-1] = history[new_reading, 1:]
+            # the latest slot always holds the current value, so a reading removed from the monitor clears its rules
+            history[:, -1] = values
+            self.reading_times[vital] = times
+
+    def evaluate(self, patient_dict, hidden=None):
+        """
+        Record the current values of the patients given, then evaluate every rule over them
+        :param patient_dict: dictionary of patient id to Patient object, the population the rules are evaluated over
+        :param hidden: optional dictionary of patient id to the vitals not monitored for that patient, which are treated
+                       as missing
+        :return: list of (state, rule name, patient id) tuples, where state is "raised" or "cleared"
+        """
+        transitions = []
+        with self.lock:
+            self.observe(patient_dict, hidden or {})
+            for vital, compare, consecutive, rules, thresholds in self.groups:
+                window = self.history[vital][:, -consecutive:]
+                if any(rule.is_dynamic() for rule in rules):
+                    thresholds = thresholds.copy()
+                    current = window[:, -1]
+                    current = current[~np.isnan(current)]
+                    for index, rule in enumerate(rules):
+                        if not rule.is_dynamic():
+                            continue
+                        if current.size == 0:
+                            thresholds[index] = np.nan
+                        elif rule.percentile is not None:
+                            thresholds[index] = np.percentile(current, rule.percentile)
+                        else:
+                            thresholds[index] = current.mean()
+                # (patients, rules, readings), missing readings and thresholds compare as false
+                with np.errstate(invalid="ignore"):
+                    met = compare(window[:, None, :], thresholds[None, :, None]).all(axis=2)
+                previous = np.column_stack([self.active[rule.name] for rule in rules])
+                rows, columns = np.nonzero(met != previous)
+                for row, index in zip(rows, columns):
+                    state = "raised" if met[row, index] else "cleared"
+                    transitions.append((state, rules[index].name, self.patient_ids[row]))
+                for index, rule in enumerate(rules):
+                    self.active[rule.name] = met[:, index]
+        return transitions
+
+    def active_patients(self, name):
+        """
+        :param name: name of a rule
+        :return: set of patient ids the rule is currently raised for
+        """
+        with self.lock:
+            if name not in self.active:
+                return set()
+            return set(self.patient_ids[row] for row in np.flatnonzero(self.active[name]))
+
+    def alerting_rules(self, patient_id, exclude=()):
+        """
+        :param patient_id: id of a patient
+        :param exclude: names of rules to leave out
+        :return: list of the names of rules currently raised for the patient
+        """
+        with self.lock:
+            row = self.rows.get(patient_id)
+            if row is None:
+                return []
+            return [name for name in self.active if name not in exclude and self.active[name][row]]
+
+
+class PractitionerRoster:
+    """
+    Keeps track of which practitioners are being monitored, and which patients were found for each of them. Patients
+    shared between practitioners are reference counted so that they are only fetched and polled once, and are only
+    dropped once the last practitioner who sees them has been removed.
+    """
     def __init__(self):
         """
-        Create a set of subscribers(observers) who want to be notified on data change
+        Create empty mappings from practitioner to patients and from patient to practitioners
+        """
+        self.practitioner_patients = {}
+        self.patient_practitioners = {}
+
+    def __contains__(self, practitioner_id):
+        return practitioner_id in self.practitioner_patients
+
+    def __len__(self):
+        return len(self.practitioner_patients)
+
+    def patient_ids(self):
+        """
+        Every patient id found for any practitioner on the roster
+        :return: set of patient id strings
+        """
+        return set(self.patient_practitioners)
+
+    def add_practitioner(self, practitioner_id, patient_ids):
+        """
+        Add a practitioner and the patients found in their encounters to the roster
+        :param practitioner_id: practitioner identifier string
+        :param patient_ids: iterable of patient ids found for the practitioner
+        :return: list of patient ids that were not on the roster before this practitioner was added
+        """
+        new_patients = []
+        self.practitioner_patients[practitioner_id] = set(patient_ids)
+        for patient_id in self.practitioner_patients[practitioner_id]:
+            if patient_id not in self.patient_practitioners:
+                self.patient_practitioners[patient_id] = set()
+                new_patients.append(patient_id)
+            self.patient_practitioners[patient_id].add(practitioner_id)
+        return new_patients
+
+    def remove_practitioner(self, practitioner_id):
+        """
+        Remove a practitioner from the roster, leaving every other practitioner and their patients untouched
+        :param practitioner_id: practitioner identifier string
+        :return: list of patient ids that no longer belong to any practitioner on the roster
+        """
+        orphaned_patients = []
+        for patient_id in self.practitioner_patients.pop(practitioner_id, ()):
+            practitioners = self.patient_practitioners[patient_id]
+            practitioners.discard(practitioner_id)
+            if not practitioners:
+                del self.patient_practitioners[patient_id]
+                orphaned_patients.append(patient_id)
+        return orphaned_patients
+
+
+class BulkExportIngestor:
+    """
+    Builds the patient dictionary from FHIR Bulk Data $export NDJSON in a single pass over the resources, in any order.
+    Only the few fields the monitor shows are kept from each line: encounter participants, patient names and
+    demographics, the observations referenced by total cholesterol reports, and the latest blood pressure per patient.
+    The pieces are joined once every line has been fed in.
+    """
+    CHOLESTEROL_CODE = "2093-3"
+    BLOOD_PRESSURE_CODE = "55284-4"
+    SYSTOLIC_CODE = "8480-6"
+    DIASTOLIC_CODE = "8462-4"
+    NPI_SYSTEM = "http://hl7.org/fhir/sid/us-npi"
+    RESOURCE_TYPES = ["Practitioner", "Patient", "Encounter", "DiagnosticReport", "Observation"]
+
+    def __init__(self, model):
+        """
+        :param model: the model class, used to create the Patient objects
+        """
+        self.model = model
+        self.practitioner_identifiers = {}
+        self.practitioner_patients = {}
+        self.encounter_names = {}
+        self.demographics = {}
+        self.chol_reports = {}
+        self.chol_values = {}
+        self.blood_pressure = {}
+        self.lines = 0
+
+    @staticmethod
+    def reference_id(reference):
+        # "Patient/123" -> "123", also accepting absolute and urn:uuid references
+        return reference.rsplit('/', 1)[-1].rsplit(':', 1)[-1]
+
+    @staticmethod
+    def issued_date(resource):
+        issued = resource.get('issued') or resource.get('effectiveDateTime')
+        if not issued:
+            return None
+        return datetime.strptime(issued[:len('2008-10-14')], '%Y-%m-%d').date()
+
+    @staticmethod
+    def codes(resource):
+        return [coding.get('code') for coding in resource.get('code', {}).get('coding', [])]
+
+    def feed(self, resource):
+        """
+        Take in one resource from an NDJSON line
+        :param resource: the decoded resource dictionary
+        :return: none
+        """
+        self.lines += 1
+        resource_type = resource.get('resourceType')
+        if resource_type == 'Encounter':
+            self.feed_encounter(resource)
+        elif resource_type == 'Patient':
+            self.feed_patient(resource)
+        elif resource_type == 'DiagnosticReport':
+            self.feed_report(resource)
+        elif resource_type == 'Observation':
+            self.feed_observation(resource)
+        elif resource_type == 'Practitioner':
+            # only the NPI is used to match practitioner identifiers, as in Server.get_practitioner_patients
+            for identifier in resource.get('identifier', []):
+                if identifier.get('system') == self.NPI_SYSTEM:
+                    self.practitioner_identifiers[resource['id']] = identifier.get('value')
+
+    def feed_encounter(self, resource):
+        subject = resource.get('subject', {})
+        if 'reference' not in subject:
+            return
+        patient_id = self.reference_id(subject['reference'])
+        if 'display' in subject and patient_id not in self.encounter_names:
+            # get rid of digits in their names
+            self.encounter_names[patient_id] = ''.join(i for i in subject['display'] if not i.isdigit())
+        for participant in resource.get('participant', []):
+            reference = participant.get('individual', {}).get('reference')
+            if reference:
+                self.practitioner_patients.setdefault(self.reference_id(reference), set()).add(patient_id)
+
+    def feed_patient(self, resource):
+        address = resource.get('address') or [{}]
+        name = '-'
+        if resource.get('name'):
+            parts = resource['name'][0].get('given', []) + [resource['name'][0].get('family', '')]
+            name = ''.join(i for i in ' '.join(parts).strip() if not i.isdigit())
+        self.demographics[resource['id']] = {
+            "name": name,
+            "birth_date": resource.get("birthDate", '-'),
+            "gender": resource.get("gender", '-'),
+            "city": address[0].get("city", '-'),
+            "state": address[0].get("state", '-'),
+            "country": address[0].get("country", '-'),
+        }
+
+    def feed_report(self, resource):
+        date = self.issued_date(resource)
+        subject = resource.get('subject', {}).get('reference')
+        if date is None or subject is None:
+            return
+        for result in resource.get('result', []):
+            if result.get('display') == 'Total Cholesterol':
+                self.chol_reports[self.reference_id(result['reference'])] = (self.reference_id(subject), date)
+
+    def feed_observation(self, resource):
+        codes = self.codes(resource)
+        if self.CHOLESTEROL_CODE in codes:
+            self.chol_values[resource['id']] = resource.get('valueQuantity', {}).get('value')
+        elif self.BLOOD_PRESSURE_CODE in codes:
+            date = self.issued_date(resource)
+            subject = resource.get('subject', {}).get('reference')
+            if date is None or subject is None:
+                return
+            patient_id = self.reference_id(subject)
+            if patient_id in self.blood_pressure and self.blood_pressure[patient_id][0] >= date:
+                return
+            components = resource.get('component', [])
+            values = {}
+            for index, component in enumerate(components):
+                value = component.get('valueQuantity', {}).get('value')
+                values[index] = value
+                for code in self.codes(component):
+                    values[code] = value
+            # fall back on the component order the search api returns, diastolic first
+            systolic = values.get(self.SYSTOLIC_CODE, values.get(1))
+            diastolic = values.get(self.DIASTOLIC_CODE, values.get(0))
+            if systolic is not None and diastolic is not None:
+                self.blood_pressure[patient_id] = (date, systolic, diastolic)
+
+    def build(self, practitioner_ids=None):
+        """
+        Join everything fed in into Patient objects, keeping only patients with a total cholesterol report
+        :param practitioner_ids: optional list of practitioner identifiers, restricting the patients to those in the
+                                 practitioners encounters. Every patient in the export is kept if not given
+        :return: tuple of a dictionary mapping each practitioner identifier to the list of its patient ids (None if
+                 not restricted), and the patient_dict of Patient objects
+        """
+        latest_chol = {}
+        for observation_id, (patient_id, date) in self.chol_reports.items():
+            value = self.chol_values.get(observation_id)
+            if value is None:
+                continue
+            if patient_id not in latest_chol or latest_chol[patient_id][1] < date:
+                latest_chol[patient_id] = (value, date)
+
+        practitioner_patients = None
+        wanted = latest_chol
+        if practitioner_ids is not None:
+            practitioner_patients = {}
+            for practitioner_id in practitioner_ids:
+                practitioner_patients[practitioner_id] = set()
+            for reference, patient_ids in self.practitioner_patients.items():
+                identifier = self.practitioner_identifiers.get(reference)
+                if identifier in practitioner_patients:
+                    practitioner_patients[identifier].update(patient_ids)
+            wanted = set().union(*practitioner_patients.values())
+            for practitioner_id in practitioner_patients:
+                practitioner_patients[practitioner_id] = list(practitioner_patients[practitioner_id])
+
+        patient_dict = {}
+        for patient_id in wanted:
+            if patient_id not in latest_chol:
+                continue
+            value, date = latest_chol[patient_id]
+            demographics = self.demographics.get(patient_id, {})
+            name = self.encounter_names.get(patient_id, demographics.get("name", '-'))
+            blood_pressure_time, systolic, diastolic = self.blood_pressure.get(patient_id, ('-', 0, 0))
+            patient_values = (name, (value, date, systolic, diastolic, blood_pressure_time,
+                                     demographics.get("city", '-'), demographics.get("state", '-'),
+                                     demographics.get("country", '-'), patient_id,
+                                     demographics.get("gender", '-'), demographics.get("birth_date", '-')))
+            patient_dict[patient_id] = self.model.return_patient(patient_values)
+        return practitioner_patients, patient_dict
+
+    def ingest_files(self, directory):
+        """
+        Feed in every NDJSON file of an export already written to disk, one line at a time
+        :param directory: folder holding the .ndjson files
+        :return: none
+        """
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith('.ndjson'):
+                continue
+            with open(os.path.join(directory, file_name), encoding='utf-8') as ndjson_file:
+                for line in ndjson_file:
+                    if line.strip():
+                        self.feed(json.loads(line))
+
+    @classmethod
+    def type_filters(cls, practitioner_ids):
+        """
+        Scope an export to the practitioners: their Practitioner resources and encounters, the patients in those
+        encounters, and those patients' reports and cholesterol and blood pressure observations
+        :param practitioner_ids: list of practitioner identifiers
+        :return: list of _typeFilter search queries, one per resource type
+        """
+        identifiers = ",".join(cls.NPI_SYSTEM + "|" + practitioner_id for practitioner_id in practitioner_ids)
+        # the patients are reached from the encounters by reverse chaining, as Encounter.patient refers to them
+        in_encounters = "_has:Encounter:patient:participant.identifier=" + identifiers
+        return ["Practitioner?identifier=" + identifiers,
+                "Encounter?participant.identifier=" + identifiers,
+                "Patient?" + in_encounters,
+                "DiagnosticReport?patient." + in_encounters,
+                "Observation?code=" + cls.CHOLESTEROL_CODE + "," + cls.BLOOD_PRESSURE_CODE + "&patient." +
+                in_encounters]
+
+    def ingest_export(self, server, practitioner_ids=None):
+        """
+        Run a bulk export on the server and feed in the files it produces, streaming each one. With practitioners
+        given, the export is scoped to them with _typeFilter. A server that refuses the filters is asked for the whole
+        export instead, which build still restricts to the practitioners.
+        :param server: Server object to export from
+        :param practitioner_ids: optional list of practitioner identifiers to scope the export to
+        :return: none
+        """
+        type_filters = self.type_filters(practitioner_ids) if practitioner_ids else []
+        try:
+            urls = server.bulk_export(self.RESOURCE_TYPES, type_filters)
+        except ServerResponseError as error:
+            if not type_filters:
+                raise
+            print("scoped bulk export refused, exporting every resource: " + str(error))
+            urls = server.bulk_export(self.RESOURCE_TYPES)
+        for url in urls:
+            for resource in server.iter_ndjson(url):
+                self.feed(resource)
+
+
+# one change to the model. kind is one of the ChangeJournal kinds. For a patient added, new is the Patient object, for a
+# vital updated, field is the name of the reading (see Model.READING_FIELDS) with its old and new values, for a
+# threshold changed, field is the name of the rule with its old and new threshold, and for an alert changed, field is
+# the name of the rule raised or cleared for the patient with whether it was raised before and after
+ChangeEvent = namedtuple("ChangeEvent", ["seq", "kind", "patient_id", "field", "old", "new"])
+
+
+class ChangeJournal:
+    """
+    Append-only journal of the changes made to the model, each numbered with a sequence number. Consumers subscribe
+    from an offset and are handed only the events appended since they last caught up, so they can keep their own state
+    up to date incrementally, catch up after a pause, or replay the journal from the start.
+    """
+    PATIENT_ADDED = "patient added"
+    PATIENT_REMOVED = "patient removed"
+    VITAL_UPDATED = "vital updated"
+    THRESHOLD_CHANGED = "threshold changed"
+    ALERT_CHANGED = "alert changed"
+
+    def __init__(self, retain=None):
+        """
+        :param retain: most events kept once every consumer has applied them, None keeps every event for replay
+        """
+        self.retain = retain
+        self.events = []
+        # sequence number of the first event still held
+        self.first_seq = 0
+        self.consumers = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.first_seq + len(self.events)
+
+    def append(self, kind, patient_id=None, field=None, old=None, new=None):
+        """
+        Append an event, safe to call from any thread
+        :return: the ChangeEvent appended
+        """
+        with self.lock:
+            event = ChangeEvent(self.first_seq + len(self.events), kind, patient_id, field, old, new)
+            self.events.append(event)
+            return event
+
+    def read(self, offset=0, limit=None):
+        """
+        :param offset: sequence number of the first event wanted
+        :param limit: most events to return, or None for all of them
+        :return: list of the ChangeEvents from the offset on
+        :raises ValueError: if events from the offset on have already been discarded
+        """
+        with self.lock:
+            if offset < self.first_seq:
+                raise ValueError("events before " + str(self.first_seq) + " have been discarded")
+            start = offset - self.first_seq
+            end = len(self.events) if limit is None else min(start + limit, len(self.events))
+            return self.events[start:end]
+
+    def subscribe(self, consumer, offset=None):
+        """
+        Register a consumer to be caught up by dispatch
+        :param consumer: JournalConsumer
+        :param offset: sequence number to apply events from, None starts from the next event appended
+        :return: none
+        """
+        consumer.offset = len(self) if offset is None else offset
+        self.consumers.append(consumer)
+
+    def unsubscribe(self, consumer):
+        self.consumers.remove(consumer)
+
+    def dispatch(self):
+        """
+        Catch every subscribed consumer up with the events appended since it last was, then discard the events past
+        the retention limit that every consumer has applied. Consumers are caught up on the calling thread, so the
+        controller calls this from the ui thread.
+        :return: none
+        """
+        for consumer in list(self.consumers):
+            consumer.catch_up(self)
+        if self.retain is None:
+            return
+        with self.lock:
+            applied = min([consumer.offset for consumer in self.consumers] + [len(self)])
+            discard = min(applied - self.first_seq, len(self.events) - self.retain)
+            if discard > 0:
+                del self.events[:discard]
+                self.first_seq += discard
+
+
+class JournalConsumer(ABC):
+    """
+    Generalisation of the objects that keep their state up to date from a ChangeJournal. Keeps track of the offset it
+    has applied events up to, and of the patients added and not yet removed, so it can look patients up by id.
+    """
+    def __init__(self):
+        self.offset = 0
+        self.patients = {}
+
+    def catch_up(self, journal):
+        """
+        Apply the events appended to the journal since the last catch up
+        :param journal: ChangeJournal to read from
+        :return: none
+        """
+        events = journal.read(self.offset)
+        if not events:
+            return
+        for event in events:
+            if event.kind == ChangeJournal.PATIENT_ADDED:
+                self.patients[event.patient_id] = event.new
+        self.apply(events)
+        for event in events:
+            if event.kind == ChangeJournal.PATIENT_REMOVED:
+                self.patients.pop(event.patient_id, None)
+        self.offset = events[-1].seq + 1
+
+    @abstractmethod
+    def apply(self, events):
+        """
+        Bring the consumers state up to date with a batch of new events, in order
+        :param events: list of ChangeEvents
+        :return: none
+        """
+        pass
+
+    def changed_patients(self, events, kinds):
+        """
+        :param events: list of ChangeEvents
+        :param kinds: the kinds of events to include
+        :return: list of the Patient objects named by the events of those kinds, each once, that have not been removed
+        """
+        patient_ids = dict.fromkeys(event.patient_id for event in events if event.kind in kinds)
+        return [self.patients[patient_id] for patient_id in patient_ids if patient_id in self.patients]
+
+
+class PatientIndex(JournalConsumer):
+    """
+    Indexes the patients on the roster so the patient list can be sorted, filtered and searched without scanning every
+    patient. Each sort key is held as a sorted list of (key, patient id) pairs kept up to date with bisect, names are
+    held in an inverted index from each lower case token to the patients whose name contains it, with the tokens kept
+    sorted for prefix search, and locations are held in hash indexes by state and by (state, city). A patient is
+    reindexed whenever its values may have changed, which only moves its own entries.
+    """
+    SORT_KEYS = ("name", "total_chol", "systolic", "diastolic", "last_update")
+    # sort key of a missing value, after every present one in ascending order
+    MISSING = (1,)
+    # punctuation and digits separate the words of a name
+    SEPARATORS = str.maketrans(dict.fromkeys(string.punctuation + string.digits, " "))
+
+    def __init__(self):
+        super().__init__()
+        self.entries = {}
+        self.sorted = {}
+        self.tokens = {}
+        self.token_list = []
+        self.states = {}
+        self.locations = {}
+        self.lock = threading.Lock()
+        for key in self.SORT_KEYS:
+            self.sorted[key] = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, patient_id):
+        return patient_id in self.entries
+
+    @classmethod
+    def tokenise(cls, text):
+        """
+        :param text: a name, or the name part of a search
+        :return: list of the lower case words in the text, punctuation and digits separating words
+        """
+        return str(text).lower().translate(cls.SEPARATORS).split()
+
+    @classmethod
+    def sort_value(cls, key, value):
+        """
+        Convert a patient value into a key that sorts consistently, missing and unparseable values sorting last
+        :param key: one of PatientIndex.SORT_KEYS
+        :param value: the value held on the patient
+        :return: tuple of (0, comparable value), or PatientIndex.MISSING
+        """
+        if key == "name":
+            return (0, str(value).lower())
+        if key == "last_update":
+            if isinstance(value, str):
+                try:
+                    value = datetime.fromisoformat(value)
+                except ValueError:
+                    return cls.MISSING
+            # patients hold the date of their latest reading, a datetime is placed within its day so both compare
+            if isinstance(value, datetime):
+                seconds = value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1e6
+                return (0, value.toordinal() + seconds / 86400)
+            if isinstance(value, date):
+                return (0, float(value.toordinal()))
+            return cls.MISSING
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return cls.MISSING
+        # nan would break the ordering bisect relies on
+        return (0, value) if value == value else cls.MISSING
+
+    def entry(self, patient):
+        sort_values = {}
+        for key in self.SORT_KEYS:
+            sort_values[key] = self.sort_value(key, getattr(patient, "_" + key))
+        state = str(patient._state).lower()
+        city = str(patient._city).lower()
+        return sort_values, frozenset(self.tokenise(patient._name)), state, city
+
+    def update(self, patient):
+        """
+        Add a patient to the index, or reindex it if its values have changed since it was last indexed
+        :param patient: Patient object
+        :return: none
+        """
+        self.update_many([patient])
+
+    def update_many(self, patients):
+        """
+        Add or reindex a batch of patients. A batch that is large next to the index, such as a newly loaded
+        practitioner, is appended and each sorted list resorted once, rather than inserting every patient in place.
+        :param patients: iterable of Patient objects
+        :return: none
+        """
+        entries = [(patient._id, self.entry(patient)) for patient in patients]
+        with self.lock:
+            changed = []
+            for patient_id, entry in entries:
+                previous = self.entries.get(patient_id)
+                if previous == entry:
+                    continue
+                if previous is not None:
+                    self.unindex(patient_id, previous)
+                # assigning over the old entry keeps the patients place in roster order
+                self.entries[patient_id] = entry
+                changed.append((patient_id, entry))
+            resort = len(changed) * 16 > len(self.entries)
+            for patient_id, entry in changed:
+                self.index(patient_id, entry, resort)
+            if resort:
+                for key in self.SORT_KEYS:
+                    self.sorted[key].sort()
+                self.token_list.sort()
+
+    def index(self, patient_id, entry, append=False):
+        # adds the entry to the sorted lists and the token and location indexes, called with the lock held. Appended
+        # entries leave the sorted lists to be resorted by the caller
+        sort_values, tokens, state, city = entry
+        for key in self.SORT_KEYS:
+            if append:
+                self.sorted[key].append((sort_values[key], patient_id))
+            else:
+                bisect.insort(self.sorted[key], (sort_values[key], patient_id))
+        for token in tokens:
+            if token not in self.tokens:
+                self.tokens[token] = set()
+                if append:
+                    self.token_list.append(token)
+                else:
+                    bisect.insort(self.token_list, token)
+            self.tokens[token].add(patient_id)
+        self.states.setdefault(state, set()).add(patient_id)
+        self.locations.setdefault((state, city), set()).add(patient_id)
+
+    def remove(self, patient_id):
+        """
+        Remove a patient from the index
+        :param patient_id: patient id string, ignored if the patient is not indexed
+        :return: none
+        """
+        with self.lock:
+            entry = self.entries.pop(patient_id, None)
+            if entry is not None:
+                self.unindex(patient_id, entry)
+
+    def unindex(self, patient_id, entry):
+        # removes the entry from the sorted lists and the token and location indexes, called with the lock held
+        sort_values, tokens, state, city = entry
+        for key in self.SORT_KEYS:
+            entries = self.sorted[key]
+            position = bisect.bisect_left(entries, (sort_values[key], patient_id))
+            del entries[position]
+        for token in tokens:
+            self.tokens[token].discard(patient_id)
+            if not self.tokens[token]:
+                del self.tokens[token]
+                del self.token_list[bisect.bisect_left(self.token_list, token)]
+        for index, location in ((self.states, state), (self.locations, (state, city))):
+            index[location].discard(patient_id)
+            if not index[location]:
+                del index[location]
+
+    def apply(self, events):
+        """
+        Index the patients added, reindex the patients with updated vitals and unindex the patients removed
+        :param events: list of ChangeEvents
+        :return: none
+        """
+        self.update_many(self.changed_patients(events, (ChangeJournal.PATIENT_ADDED, ChangeJournal.VITAL_UPDATED)))
+        for event in events:
+            if event.kind == ChangeJournal.PATIENT_REMOVED:
+                self.remove(event.patient_id)
+
+    def prefix_matches(self, prefix):
+        """
+        :param prefix: lower case word
+        :return: set of the patients with a name token starting with the prefix
+        """
+        matches = set()
+        position = bisect.bisect_left(self.token_list, prefix)
+        while position < len(self.token_list) and self.token_list[position].startswith(prefix):
+            matches |= self.tokens[self.token_list[position]]
+            position += 1
+        return matches
+
+    def query(self, text="", state=None, city=None, sort_key=None, descending=False):
+        """
+        Find the patients matching a search, in the order asked for
+        :param text: words that must each start a word of the patients name, eg "jo smi" matches John Smith
+        :param state: only include patients in this state, case insensitive
+        :param city: only include patients in this city, case insensitive
+        :param sort_key: one of PatientIndex.SORT_KEYS, or None to keep the order patients were indexed in
+        :param descending: sort from the largest value down, missing values still sorting last
+        :return: list of patient id strings
+        """
+        with self.lock:
+            candidates = None
+            for word in self.tokenise(text):
+                matches = self.prefix_matches(word)
+                candidates = matches if candidates is None else candidates & matches
+            if state is not None or city is not None:
+                if state is not None and city is not None:
+                    matches = self.locations.get((state.lower(), city.lower()), set())
+                elif state is not None:
+                    matches = self.states.get(state.lower(), set())
+                else:
+                    matches = set()
+                    for location in self.locations:
+                        if location[1] == city.lower():
+                            matches |= self.locations[location]
+                candidates = matches if candidates is None else candidates & matches
+
+            if sort_key is None:
+                if candidates is None:
+                    return list(self.entries)
+                return [patient_id for patient_id in self.entries if patient_id in candidates]
+
+            entries = self.sorted[sort_key]
+            if candidates is not None and len(candidates) * 8 < len(entries):
+                # a narrow search is quicker to sort on its own than to pick out of the whole sorted list
+                entries = sorted((self.entries[patient_id][0][sort_key], patient_id) for patient_id in candidates)
+            if descending:
+                split = bisect.bisect_left(entries, (self.MISSING,))
+                ordered = itertools.chain(reversed(entries[:split]), entries[split:])
+            else:
+                ordered = entries
+            if candidates is None:
+                return [patient_id for key, patient_id in ordered]
+            return [patient_id for key, patient_id in ordered if patient_id in candidates]
+
+
+class HistoryArchive(JournalConsumer):
+    """
+    On-disk columnar archive of every cholesterol and blood pressure reading the monitor observes. Readings are
+    appended to fixed-width segments, each a directory holding one .npy file per column (patient, time, kind, value1,
+    value2), so they can be read back as memory-mapped numpy arrays without parsing and without loading whole files
+    into memory. A manifest records the rows and time range of each segment, so a query only opens the segments it
+    overlaps. Once a segment is full it is sealed with an index of where each of its patients' rows are.
+    """
+    CHOLESTEROL = 0
+    BLOOD_PRESSURE = 1
+    COLUMNS = {"patient": np.int32, "time": "datetime64[s]", "kind": np.int8, "value1": np.float64,
+               "value2": np.float64}
+
+    def __init__(self, directory, segment_rows=1 << 20):
+        """
+        Open the archive in the directory, creating it if it does not exist
+        :param directory: folder holding the archive
+        :param segment_rows: readings held by each segment, used when the archive is created
+        """
+        super().__init__()
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.patients_path = os.path.join(directory, "patients.txt")
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding='utf-8') as manifest_file:
+                self.manifest = json.load(manifest_file)
+        else:
+            self.manifest = {"segment_rows": segment_rows, "segments": []}
+        # patients are stored in the patient column by their position in patients.txt
+        self.patient_ids = []
+        if os.path.exists(self.patients_path):
+            with open(self.patients_path, encoding='utf-8') as patients_file:
+                self.patient_ids = patients_file.read().split()
+        self.patient_numbers = {patient_id: number for number, patient_id in enumerate(self.patient_ids)}
+        self.patients_file = open(self.patients_path, "a", encoding='utf-8')
+        self.open_segment = None
+        self.open_columns = None
+        # the times, in seconds, of the last reading of each kind archived for each patient, so readings are only
+        # appended once, also across restarts
+        self.last_times = self.load_last_times()
+
+    def load_last_times(self):
+        """
+        Find the time of the latest reading of each kind archived for each patient, from every segment
+        :return: dictionary mapping patient id to a list of the times in seconds of its latest cholesterol and blood
+                 pressure readings, None where there is none
+        """
+        missing = np.iinfo(np.int64).min
+        latest = np.full((len(self.patient_ids), 2), missing, dtype=np.int64)
+        for segment in self.manifest["segments"]:
+            if segment["rows"] == 0:
+                continue
+            columns = self.columns(segment)
+            np.maximum.at(latest, (columns["patient"], columns["kind"]), columns["time"].astype(np.int64))
+        last_times = {}
+        for number, kind in zip(*np.nonzero(latest != missing)):
+            times = last_times.setdefault(self.patient_ids[number], [None, None])
+            times[kind] = int(latest[number, kind])
+        return last_times
+
+    @staticmethod
+    def seconds(time):
+        return int(np.datetime64(time, "s").astype(np.int64))
+
+    def segment_path(self, segment, name):
+        return os.path.join(self.directory, segment["name"], name + ".npy")
+
+    def columns(self, segment, mode="r"):
+        """
+        :param segment: entry of the manifest
+        :param mode: memmap mode, "r" to read or "r+" to append
+        :return: dictionary mapping each column name to its memory-mapped array, cut to the rows written
+        """
+        columns = {}
+        for name in self.COLUMNS:
+            columns[name] = np.load(self.segment_path(segment, name), mmap_mode=mode)
+        if mode == "r":
+            for name in columns:
+                columns[name] = columns[name][:segment["rows"]]
+        return columns
+
+    def new_segment(self):
+        segment = {"name": "segment_%06d" % len(self.manifest["segments"]), "rows": 0, "start": None, "end": None,
+                   "sealed": False}
+        os.makedirs(os.path.join(self.directory, segment["name"]), exist_ok=True)
+        for name in self.COLUMNS:
+            np.lib.format.open_memmap(self.segment_path(segment, name), mode="w+", dtype=self.COLUMNS[name],
+                                      shape=(self.manifest["segment_rows"],))
+        self.manifest["segments"].append(segment)
+        return segment
+
+    def seal(self, segment):
+        """
+        Index a full segment by patient: the patients in it, and their rows grouped together in time order
+        :param segment: entry of the manifest
+        :return: none
+        """
+        columns = self.columns(segment)
+        order = np.lexsort((columns["time"], columns["patient"]))
+        patients, offsets = np.unique(columns["patient"][order], return_index=True)
+        np.save(self.segment_path(segment, "order"), order)
+        np.save(self.segment_path(segment, "patients"), patients)
+        np.save(self.segment_path(segment, "offsets"), np.append(offsets, len(order)))
+        segment["sealed"] = True
+
+    def patient_number(self, patient_id):
+        number = self.patient_numbers.get(patient_id)
+        if number is None:
+            number = len(self.patient_ids)
+            self.patient_ids.append(patient_id)
+            self.patient_numbers[patient_id] = number
+            self.patients_file.write(patient_id + "\n")
+        return number
+
+    def append(self, patient_id, kind, time, value1, value2=np.nan):
+        """
+        Append one reading, starting a new segment when the open one is full. Call flush to make it durable.
+        :param patient_id: patient id string
+        :param kind: HistoryArchive.CHOLESTEROL or HistoryArchive.BLOOD_PRESSURE
+        :param time: date or datetime the reading was issued
+        :param value1: total cholesterol, or systolic
+        :param value2: diastolic, unused for cholesterol
+        :return: none
+        """
+        with self.lock:
+            segment = self.manifest["segments"][-1] if self.manifest["segments"] else None
+            if segment is None or segment["rows"] == self.manifest["segment_rows"]:
+                if segment is not None:
+                    self.open_columns = None
+                    self.seal(segment)
+                segment = self.new_segment()
+            if self.open_segment is not segment:
+                self.open_segment = segment
+                self.open_columns = self.columns(segment, "r+")
+            row = segment["rows"]
+            seconds = self.seconds(time)
+            self.open_columns["patient"][row] = self.patient_number(patient_id)
+            self.open_columns["time"][row] = np.datetime64(seconds, "s")
+            self.open_columns["kind"][row] = kind
+            self.open_columns["value1"][row] = value1
+            self.open_columns["value2"][row] = value2
+            segment["rows"] = row + 1
+            segment["start"] = seconds if segment["start"] is None else min(segment["start"], seconds)
+            segment["end"] = seconds if segment["end"] is None else max(segment["end"], seconds)
+
+    def record(self, patient):
+        """
+        Append the readings of a patient that have not been archived yet
+        :param patient: Patient object
+        :return: none
+        """
+        last_times = self.last_times.setdefault(patient._id, [None, None])
+        chol = RuleEngine.to_float(patient._total_chol)
+        if isinstance(patient._last_update, date) and not np.isnan(chol) and \
+                self.seconds(patient._last_update) != last_times[self.CHOLESTEROL]:
+            self.append(patient._id, self.CHOLESTEROL, patient._last_update, chol)
+            last_times[self.CHOLESTEROL] = self.seconds(patient._last_update)
+        systolic = RuleEngine.to_float(patient._systolic)
+        diastolic = RuleEngine.to_float(patient._diastolic)
+        if isinstance(patient._blood_pressure_time, date) and not np.isnan(systolic) and \
+                self.seconds(patient._blood_pressure_time) != last_times[self.BLOOD_PRESSURE]:
+            self.append(patient._id, self.BLOOD_PRESSURE, patient._blood_pressure_time, systolic, diastolic)
+            last_times[self.BLOOD_PRESSURE] = self.seconds(patient._blood_pressure_time)
+
+    def apply(self, events):
+        """
+        Archive the new readings of the patients added or updated, then flush them to disk
+        :param events: list of ChangeEvents
+        :return: none
+        """
+        patients = self.changed_patients(events, (ChangeJournal.PATIENT_ADDED, ChangeJournal.VITAL_UPDATED))
+        for patient in patients:
+            self.record(patient)
+        if patients:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the appended rows and the manifest to disk. The manifest is replaced in one step, so a crash leaves the
+        rows of the last flush readable.
+        :return: none
+        """
+        with self.lock:
+            if self.open_columns is not None:
+                for name in self.open_columns:
+                    self.open_columns[name].flush()
+            self.patients_file.flush()
+            temporary_path = self.manifest_path + ".tmp"
+            with open(temporary_path, "w", encoding='utf-8') as manifest_file:
+                json.dump(self.manifest, manifest_file)
+            os.replace(temporary_path, self.manifest_path)
+
+    def segments(self, start=None, end=None):
+        """
+        Iterate over the memory-mapped columns of the segments holding readings between start and end
+        :param start: earliest date or datetime wanted, or None
+        :param end: latest date or datetime wanted, or None
+        :return: generator of (manifest entry, dictionary of columns) tuples
+        """
+        start = None if start is None else int(np.datetime64(start, "s").astype(np.int64))
+        end = None if end is None else int(np.datetime64(end, "s").astype(np.int64))
+        for segment in list(self.manifest["segments"]):
+            if segment["rows"] == 0:
+                continue
+            if (start is not None and segment["end"] < start) or (end is not None and segment["start"] > end):
+                continue
+            yield segment, self.columns(segment)
+
+    def query(self, patient_ids=None, start=None, end=None, kind=None):
+        """
+        Read the readings matching a query. Only the segments overlapping the time range are opened, and in sealed
+        segments the rows of the wanted patients are found through the segment index rather than a scan.
+        :param patient_ids: iterable of patient id strings, or None for every patient
+        :param start: earliest date or datetime wanted, or None
+        :param end: latest date or datetime wanted, or None
+        :param kind: HistoryArchive.CHOLESTEROL or HistoryArchive.BLOOD_PRESSURE, or None for both
+        :return: dictionary of column arrays, with the patient column holding patient id strings
+        """
+        wanted = None
+        if patient_ids is not None:
+            wanted = np.array(sorted(self.patient_numbers[patient_id] for patient_id in patient_ids
+                                     if patient_id in self.patient_numbers), dtype=np.int32)
+        parts = {name: [] for name in self.COLUMNS}
+        for segment, columns in self.segments(start, end):
+            if wanted is None:
+                rows = np.arange(segment["rows"])
+            elif segment["sealed"]:
+                patients = np.load(self.segment_path(segment, "patients"), mmap_mode="r")
+                offsets = np.load(self.segment_path(segment, "offsets"), mmap_mode="r")
+                order = np.load(self.segment_path(segment, "order"), mmap_mode="r")
+                positions = np.searchsorted(patients, wanted)
+                found = positions[(positions < len(patients)) & (patients[np.minimum(positions, len(patients) - 1)]
+                                                                == wanted)]
+                rows = np.concatenate([order[offsets[position]:offsets[position + 1]] for position in found] +
+                                      [np.empty(0, dtype=np.int64)])
+            else:
+                rows = np.nonzero(np.isin(columns["patient"], wanted))[0]
+            mask = np.ones(len(rows), dtype=bool)
+            if start is not None:
+                mask &= columns["time"][rows] >= np.datetime64(start, "s")
+            if end is not None:
+                mask &= columns["time"][rows] <= np.datetime64(end, "s")
+            if kind is not None:
+                mask &= columns["kind"][rows] == kind
+            rows = rows[mask]
+            for name in self.COLUMNS:
+                parts[name].append(columns[name][rows])
+        result = {}
+        for name in self.COLUMNS:
+            result[name] = np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=self.COLUMNS[name])
+        result["patient"] = np.array(self.patient_ids, dtype=object)[result["patient"]] if len(result["patient"]) \
+            else np.empty(0, dtype=object)
+        return result
+
+    def close(self):
+        """
+        Flush the archive and close its files, does nothing if already closed
+        :return: none
+        """
+        if self.patients_file.closed:
+            return
+        self.flush()
+        self.patients_file.close()
+
+
+class Model:
+    """
+    Class responsible for the management of business logic within the system
+    """
+    # names of the values returned by Patient.get_readings, in order
+    READING_FIELDS = ("total_chol", "last_update", "systolic", "diastolic", "blood_pressure_time")
+    # names of the built in alert rules
+    CHOL_RULE = "cholesterol above average"
+    SYSTOLIC_RULE = "systolic limit"
+    DIASTOLIC_RULE = "diastolic limit"
+
+    def __init__(self, journal_retain=10000):
+        """
+        Create the practitioner roster used to deduplicate patients shared between practitioners, the index used to
+        sort, filter and search the patient list, and the alert rule engine, which starts with the rule flagging
+        cholesterol above the average of the monitored patients
+        :param journal_retain: most journal events kept once every consumer has applied them, None keeps every event
+                               so that a consumer can replay the journal from the start
         """
-        self.observers = set()
-
-    def attach(self, observer):
+        self.roster = PractitionerRoster()
+        self.journal = ChangeJournal(journal_retain)
+        self.patient_index = PatientIndex()
+        self.journal.subscribe(self.patient_index)
+        self.rule_engine = RuleEngine()
+        self.rule_engine.set_rule(AlertRule(self.CHOL_RULE, "total_chol", ">", "mean"))
+
+    def set_rule(self, rule):
         """
-        register an observer(a Patient object) to be notified
-        :param observer: object to add to the Publishers set to be notified
+        Add an alert rule, replacing any rule with the same name, and journal the change of threshold
+        :param rule: AlertRule object
         :return: none
         """
-        self.observers.add(observer)
+        previous = self.rule_engine.rules.get(rule.name)
+        self.rule_engine.set_rule(rule)
+        self.journal.append(ChangeJournal.THRESHOLD_CHANGED, field=rule.name,
+                            old=previous.get_threshold() if previous is not None else None, new=rule.get_threshold())
 
-    def detach(self, observer):
+    def set_limit_rule(self, name, vital, limit):
         """
-        deregister observer from being notified
-        :param observer: object to remove from the Publisher set
-        :return:none
+        Replace the rule for one of the blood pressure limits
+        :param name: Model.SYSTOLIC_RULE or Model.DIASTOLIC_RULE
+        :param vital: "systolic" or "diastolic"
+        :param limit: the value above which the rule is raised
+        :return: none
         """
-        self.observers.discard(observer)
+        self.set_rule(AlertRule(name, vital, ">", limit))
 
-    def notify_observers(self):
+    def add_patients(self, patients):
         """
-        Traverse the Publishers set notifying all observer objects that they must update.
-        :return:none
+        Journal patients that have been loaded
+        :param patients: iterable of Patient objects
+        :return: none
         """
-        for observer in self.observers:
-            observer.update()
-
+        for patient in patients:
+            self.journal.append(ChangeJournal.PATIENT_ADDED, patient._id, new=patient)
 
-class Observer(ABC):
-    @abstractmethod
-    def update(self):
+    def remove_patients(self, patient_ids):
         """
-        Once the subject has notified the observers that they should be updated, this method will execute.
-        :return:none
+        Journal patients that are no longer on the roster
+        :param patient_ids: iterable of patient id strings
+        :return: none
         """
-        pass
+        for patient_id in patient_ids:
+            self.journal.append(ChangeJournal.PATIENT_REMOVED, patient_id)
 
+    def update_readings(self, patient, before):
+        """
+        Journal each reading of a patient that an update changed, safe to call from the update threads
+        :param patient: Patient object, after its update
+        :param before: the patients get_readings from before the update
+        :return: whether any reading changed
+        """
+        changed = False
+        for field, old, new in zip(self.READING_FIELDS, before, patient.get_readings()):
+            if old != new:
+                self.journal.append(ChangeJournal.VITAL_UPDATED, patient._id, field, old, new)
+                changed = True
+        return changed
+
+    def evaluate_alerts(self, patient_dict, hidden=None):
+        """
+        Evaluate the alert rules over the live values of the monitored patients, journaling the rules raised and cleared,
+        safe to call from the update threads
+        :param patient_dict: dictionary of patient id to Patient object, the monitored patients
+        :param hidden: dictionary of patient id to the vitals not monitored for that patient, see RuleEngine.evaluate
+        :return: list of (state, rule name, patient id) tuples
+        """
+        transitions = self.rule_engine.evaluate(patient_dict, hidden)
+        for state, rule_name, patient_id in transitions:
+            print("alert " + state + ": " + rule_name + " for patient " + patient_id)
+            self.journal.append(ChangeJournal.ALERT_CHANGED, patient_id, rule_name, state == "cleared", state == "raised")
+        return transitions
 
-class Model:
-    """
-    Class responsible for the management of business logic within the system
-    """
     def return_patient(self, patient_values):
         """
         Takes in some values found for a patient, and returns a new Patient object with those values attached to the
@@ -81,36 +1888,34 @@ class Model:
                           patient_id, patient_gender, patient_birth_date)
         return patient
 
-    def chol_average(self, patient_dict):
-        """
-        Given a dictionary, will traverse the patients inside and calculate the corresponding average cholesterol
-        :param patient_dict: dictionary containing patients
-        :return: float, average of all cholesterol's
-        """
-        chol_values = []
-
-        for patient_id in patient_dict:
-            if patient_dict[patient_id]._total_chol != '-':
-                chol_values.append(float(patient_dict[patient_id]._total_chol))
-
-        if chol_values:
-            return sum(chol_values) / len(chol_values)
-        else:
-            return 0.0
-
 
-class View:
+class View(JournalConsumer):
     """
-    Class that manages the retrieval and display of information for the application.
+    Class that manages the retrieval and display of information for the application. Keeps the monitored patient list
+    up to date from the model's change journal.
     """
-    def __init__(self, root, model):
+    # sort options offered for the patient list, mapped to the PatientIndex sort key
+    SORT_OPTIONS = {"Sort: Roster Order": None, "Sort: Name": "name", "Sort: Total Cholesterol": "total_chol",
+                    "Sort: Systolic": "systolic", "Sort: Diastolic": "diastolic", "Sort: Last Update": "last_update"}
+
+    def __init__(self, root, model, virtual_lists=False, chart_aggregate_above=200, chart_bins=30):
         """
         Initiate the View objects canvas, frame, treeviews, buttons, labels and entries
         :param root: tk object describing the application context to place onto
         :param model: model object necessary to calculate variables
+        :param virtual_lists: whether the patient and monitored lists only materialise the rows in view, for panels
+                              of many thousands of patients
+        :param chart_aggregate_above: number of monitored patients above which the graph shows the distributions of
+                                      the panel instead of a bar per patient
+        :param chart_bins: number of bins per axis of the aggregated charts
         """
+        super().__init__()
         self.model = model
         self.root = root
+        self.chart_aggregate_above = chart_aggregate_above
+        self.chart_bins = chart_bins
+        # "bar" or "cohort", whichever the graph was last drawn as
+        self.chart_mode = None
         self.canvas = tk.Canvas(self.root, height=600, width=900)
         self.canvas.pack()
 
@@ -119,9 +1924,39 @@ class View:
         self.frame = tk.Frame(self.root)
         self.frame.place(relheight=0.65, relwidth=0.9, relx=0.03, rely=0.03, anchor="nw")
 
-        self.patient_list = PatientList(self.frame)
-        self.monitored_patients = MonitoredList(self.frame)
+        if virtual_lists:
+            self.patient_list = VirtualPatientList(self.frame)
+            self.monitored_patients = VirtualMonitoredList(self.frame)
+        else:
+            self.patient_list = PatientList(self.frame)
+            self.monitored_patients = MonitoredList(self.frame)
+
+        # only the widgets needed to load patients are built before the window first appears, the rest are built by
+        # build_secondary_widgets once the window is up
+        self.secondary_widgets_built = False
+        # clicking the name heading of the patient list flips the sort between ascending and descending
+        self.sort_descending = False
+        self.id_entry = tk.Entry(self.frame, width=50, font=24)
+        self.id_button = tk.Button(self.frame, text="Retrieve Patient List (Enter ID)")
+        self.remove_practitioner_button = tk.Button(self.frame, text="Remove Practitioner (Enter ID)")
+        self.bulk_load_button = tk.Button(self.frame, text="Bulk Load (Enter IDs or NDJSON Folder)")
+        self.server_status_label = tk.Label(self.root, anchor="w", padx=2, text="Server: closed")
+
+        self.id_entry.place(relheight=0.05, relwidth=0.325)
+        self.id_button.place(relheight=0.05, relwidth=0.325, relx=0.33)
+        self.remove_practitioner_button.place(relheight=0.05, relwidth=0.325, relx=0.66)
+        self.bulk_load_button.place(relheight=0.05, relwidth=0.325, relx=0.66, rely=0.15)
+        self.server_status_label.place(relheight=0.03, relwidth=0.94, relx=0.03, rely=0.97, anchor="w")
 
+    def build_secondary_widgets(self):
+        """
+        Build the buttons, entries and labels that are not needed until patients have been loaded. Runs once the
+        window has first been drawn, so that it appears without waiting for them.
+        :return: none
+        """
+        if self.secondary_widgets_built:
+            return
+        self.secondary_widgets_built = True
         self.add_patient_to_monitor = tk.Button(self.frame, text="Add Patient To Monitor")
         self.add_patient_cholesterol_to_monitor = tk.Button(self.frame, text="Add Patient Cholesterol To Monitor")
         self.add_patient_blood_pressure_to_monitor = tk.Button(self.frame, text="Add Patient Blood Pressure To Monitor")
@@ -130,26 +1965,31 @@ class View:
         self.remove_patient_blood_pressure = tk.Button(self.frame, text="Remove Patient Blood Pressure From Monitor")
         self.graph_patient = tk.Button(self.frame, text="Graph Monitored Patients")
         self.update_period_entry = tk.Entry(self.frame, width=50, font=24)
-        self.id_button = tk.Button(self.frame, text="Retrieve Patient List (Enter ID)")
         self.update_button = tk.Button(self.frame, text="Set Update Period (sec)")
         self.systolic_bp_entry = tk.Entry(self.frame, width=50, font=24)
         self.systolic_bp_button = tk.Button(self.frame, text="Set X (Systolic BP)")
         self.diastolic_bp_entry = tk.Entry(self.frame, width=50, font=24)
         self.diastolic_bp_button = tk.Button(self.frame, text="Set Y (Diastolic BP)")
-        self.id_entry = tk.Entry(self.frame, width=50, font=24)
+        self.alert_rule_entry = tk.Entry(self.frame, width=50, font=24)
+        self.alert_rule_button = tk.Button(self.frame, text="Add Alert Rule (eg systolic > 140 for 3)")
+        self.push_button = tk.Button(self.frame, text="Push Updates: Off")
+        self.search_entry = tk.Entry(self.frame, width=50, font=24)
+        self.search_button = tk.Button(self.frame, text="Search (name, city: X, state: Y)")
+        self.sort_box = ttk.Combobox(self.frame, state="readonly", values=list(self.SORT_OPTIONS))
+        self.sort_box.set("Sort: Roster Order")
         self.patient_info_title_label = tk.Label(self.root, anchor="w", padx=2, text="Patient Information:")
         self.patient_name_label = tk.Label(self.root, anchor="w", padx=2, text="")
         self.patient_gender_label = tk.Label(self.root, anchor="w", padx=2, text="")
         self.patient_address_label = tk.Label(self.root, anchor="w", padx=2, text="")
 
-        self.id_entry.place(relheight=0.05, relwidth=0.325)
-        self.id_button.place(relheight=0.05, relwidth=0.325, relx=0.33)
         self.update_period_entry.place(relheight=0.05, relwidth=0.325, rely=0.05)
         self.update_button.place(relheight=0.05, relwidth=0.325, relx=0.33, rely=0.05)
         self.systolic_bp_entry.place(relheight=0.05, relwidth=0.325, rely=0.1)
         self.systolic_bp_button.place(relheight=0.05, relwidth=0.325, relx=0.33, rely=0.1)
         self.diastolic_bp_entry.place(relheight=0.05, relwidth=0.325, rely=0.15)
         self.diastolic_bp_button.place(relheight=0.05, relwidth=0.325, relx=0.33, rely=0.15)
+        self.alert_rule_entry.place(relheight=0.05, relwidth=0.325, relx=0.66, rely=0.05)
+        self.alert_rule_button.place(relheight=0.05, relwidth=0.325, relx=0.66, rely=0.1)
         self.add_patient_cholesterol_to_monitor.place(relheight=0.05, relwidth=0.325, relx=0.33, rely=0.37, anchor="w")
         self.add_patient_blood_pressure_to_monitor.place(relheight=0.05, relwidth=0.325, relx=0.33, rely=0.25,
                                                          anchor="w")
@@ -158,6 +1998,10 @@ class View:
         self.remove_patient_cholesterol.place(relheight=0.05, relwidth=0.325, relx=0.33, rely=0.43, anchor="w")
         self.remove_patient_blood_pressure.place(relheight=0.05, relwidth=0.325, relx=0.33, rely=0.31, anchor="w")
         self.graph_patient.place(relheight=0.05, relwidth=0.325, relx=0.66, rely=0.25, anchor="w")
+        self.push_button.place(relheight=0.05, relwidth=0.325, relx=0, rely=0.37, anchor="w")
+        self.search_entry.place(relheight=0.05, relwidth=0.325, relx=0.66, rely=0.31, anchor="w")
+        self.search_button.place(relheight=0.05, relwidth=0.325, relx=0.66, rely=0.37, anchor="w")
+        self.sort_box.place(relheight=0.05, relwidth=0.325, relx=0.66, rely=0.43, anchor="w")
         self.patient_info_title_label.place(relheight=0.03, relwidth=0.5, relx=0.325, rely=0.8, anchor="w")
         self.patient_name_label.place(relheight=0.03, relwidth=0.5, relx=0.48, rely=0.77, anchor="w")
         self.patient_gender_label.place(relheight=0.03, relwidth=0.5, relx=0.48, rely=0.8, anchor="w")
@@ -168,13 +2012,10 @@ class View:
         get patient selected from the list of all patients, and pass patient values back to controller
         :return: tuple of the patients name, values and item number within the treeview
         """
-        item = self.patient_list.patient_tree.selection()
+        item = self.patient_list.selected_id()
         patient_values = None
-        if len(item) is not 0:
-            item = item[0]
-            patient_values = (
-                self.patient_list.patient_tree.item(item, "text"), self.patient_list.patient_tree.item(item, "values"),
-                item)
+        if item is not None:
+            patient_values = (self.patient_list.row_text(item), self.patient_list.row_values(item), item)
         return patient_values
 
     def change_font_colour(self, option):
@@ -199,18 +2040,31 @@ class View:
             self.root.update_idletasks()
             self.root.update()
 
+            rows = self.monitored_patients.row_ids()
+            if len(rows) > self.chart_aggregate_above:
+                # too many patients for a bar each, draw the distributions of the panel instead
+                if self.chart_mode != "cohort":
+                    self.chart_mode = "cohort"
+                    plt.gcf().clf()
+                self.create_cohort_graph(rows)
+                plt.draw()
+                plt.pause(0.1)
+                continue
+            if self.chart_mode != "bar":
+                self.chart_mode = "bar"
+                plt.gcf().clf()
+
             plt.axes().clear()
             patient_name_axis = []
             patient_chol_axis = []
 
             ## Retrieve Data from Monitored Patient List
-            for item in self.monitored_patients.patient_tree.get_children():
+            for item in rows:
                 # search through all items in the monitor list, add the cholesterol values to the chol axis array.
-                patient_values = (self.monitored_patients.patient_tree.item(item, "text"),
-                                  self.monitored_patients.patient_tree.item(item, "values"), item)
+                patient_values = (self.monitored_patients.row_text(item), self.monitored_patients.row_values(item), item)
                 patient = self.model.return_patient(patient_values)
                 if patient._total_chol != '-':
-                    monitored_patient_names = (self.monitored_patients.patient_tree.item(item, "text"))
+                    monitored_patient_names = self.monitored_patients.row_text(item)
                     patient_name_axis.append(monitored_patient_names)
 
                     ## Add Data into Y-Axis Array
@@ -240,249 +2094,310 @@ class View:
             plt.pause(0.1)
 
 
-    def add_monitor(self, systolic_limit, diastolic_limit, cholestrol, bp):
+    def create_cohort_graph(self, rows):
+        """
+        Draw the cholesterol and blood pressure distributions of the monitored patients: a histogram of cholesterol, box
+        plots of each vital and a heatmap of systolic against diastolic. Every chart is drawn from binned counts or
+        summary statistics, so the drawing cost depends on the number of bins rather than the number of patients.
+        :param rows: ids of the rows in the monitor treeview
+        :return: none
+        """
+        # one pass over the rows into an array of cholesterol, systolic and diastolic, nan where not monitored
+        values = np.array([[RuleEngine.to_float(value) for value in
+                            itemgetter(0, 2, 3)(self.monitored_patients.row_values(item))] for item in rows],
+                          dtype=float).reshape(-1, 3)
+        cholesterol, systolic, diastolic = values.T
+        cholesterol = cholesterol[~np.isnan(cholesterol)]
+        pressures = ~np.isnan(systolic) & ~np.isnan(diastolic)
+
+        figure = plt.gcf()
+        figure.clf()
+        if figure.get_figwidth() < 12:
+            figure.set_size_inches(12, 5)
+        histogram_axes, box_axes, heatmap_axes = figure.subplots(1, 3)
+
+        counts, edges = np.histogram(cholesterol, bins=self.chart_bins)
+        histogram_axes.stairs(counts, edges, fill=True, color='green')
+        histogram_axes.set_xlabel("Cholesterol (mg/dL)")
+        histogram_axes.set_ylabel("Patients")
+        histogram_axes.set_title("Cholesterol (n=" + str(len(cholesterol)) + ")")
+
+        # outliers would be drawn as a point each, so only the boxes and whiskers are drawn
+        box_axes.boxplot([cholesterol, systolic[pressures], diastolic[pressures]], showfliers=False)
+        box_axes.set_xticks([1, 2, 3], ["Cholesterol", "Systolic", "Diastolic"], fontsize=8)
+        box_axes.set_title("Distributions")
+
+        counts, systolic_edges, diastolic_edges = np.histogram2d(systolic[pressures], diastolic[pressures],
+                                                                 bins=self.chart_bins)
+        mesh = heatmap_axes.pcolormesh(systolic_edges, diastolic_edges, counts.T, cmap="Reds")
+        figure.colorbar(mesh, ax=heatmap_axes, label="Patients")
+        heatmap_axes.set_xlabel("Systolic (mmHg)")
+        heatmap_axes.set_ylabel("Diastolic (mmHg)")
+        heatmap_axes.set_title("Blood Pressure (n=" + str(int(pressures.sum())) + ")")
+        figure.tight_layout()
+
+    def add_monitor(self, cholestrol, bp):
         """
         Add a patient to the monitor treeview
-        :param patient_id: the specified patient id to add to the monitor treeview
+        :param cholestrol: whether to monitor the patients cholesterol
+        :param bp: whether to monitor the patients blood pressure
         :return: none
         """
         patient_values = self.get_patient_all()
         if patient_values is not None:
             patient = self.model.return_patient(patient_values)
-            # print(patient._name)
+            # monitor the patient object that is kept updated, not a copy of the selected row
+            patient = self.patient_list.patient_dict.get(patient._id, patient)
             # add to monitor patient list if not there already
             if patient._id not in self.monitored_patients.patient_dict:
                 self.monitored_patients.patient_dict[patient._id] = patient
+                self.monitored_patients.monitored_vitals[patient._id] = (cholestrol, bp)
 
                 tag_above = "above"
                 tag_below = "below"
-                avg_chol = self.model.chol_average(self.monitored_patients.patient_dict)
-                # insert the patient into the monitor list
-                if (cholestrol == True) and (bp == True):
-                    self.monitored_patients.patient_tree.insert("", "end", text=patient._name, values=(patient._total_chol,
-                                                                                                       patient._last_update,
-                                                                                                       patient._systolic,
-                                                                                                       patient._diastolic,
-                                                                                                       patient._blood_pressure_time,
-                                                                                                  patient._city,
-                                                                                                  patient._state,
-                                                                                                  patient._country,
-                                                                                                  patient._id,
-                                                                                                  patient._gender,
-                                                                                                  patient._birth_date))
-                elif (cholestrol == True) and (bp == False):
-                    self.monitored_patients.patient_tree.insert("", "end", text=patient._name, values=(patient._total_chol,
-                                                                                                       patient._last_update,
-                                                                                                       '-',
-                                                                                                       '-',
-                                                                                                       '-',
-                                                                                                  patient._city,
-                                                                                                  patient._state,
-                                                                                                  patient._country,
-                                                                                                  patient._id,
-                                                                                                  patient._gender,
-                                                                                                  patient._birth_date))
-                elif (cholestrol == False) and (bp == True):
-                    self.monitored_patients.patient_tree.insert("", "end", text=patient._name, values=('-',
-                                                                                                       '-',
-                                                                                                       patient._systolic,
-                                                                                                       patient._diastolic,
-                                                                                                       patient._blood_pressure_time,
-                                                                                                  patient._city,
-                                                                                                  patient._state,
-                                                                                                  patient._country,
-                                                                                                  patient._id,
-                                                                                                  patient._gender,
-                                                                                                  patient._birth_date))
+                # insert the patient into the monitor list, the patient id doubles as the row id
+                self.monitored_patients.insert_row(patient._id, patient._name, self.monitored_row_values(patient))
                 # check which entries left in the monitored patient list have above average cholesterol and change their
                 # colour based on that
-                self.check_children_chol(systolic_limit, diastolic_limit, avg_chol, tag_above, tag_below)
+                self.check_children_chol(tag_above, tag_below, (patient._id,))
                 # process the colours assigned to the tags
                 self.style.map("Treeview", foreground=self.change_font_colour("foreground"))
             else:
-
-                # Create list of 'id's
-                list_of_entries_in_tree_view = self.monitored_patients.patient_tree.get_children()
-                item = None
-                for each in list_of_entries_in_tree_view:
-                    patient_id = self.monitored_patients.patient_tree.item(each, "values")[8]
-                    if patient._id == patient_id:
-                        item = each
-                        break
-
-                patient_values = list(self.monitored_patients.patient_tree.item(item, "values"))
+                patient_values = list(self.monitored_patients.row_values(patient._id))
+                monitored_chol, monitored_bp = self.monitored_patients.monitored_vitals[patient._id]
 
                 if (cholestrol == False) and (bp == True):
+                    self.monitored_patients.monitored_vitals[patient._id] = (monitored_chol, True)
                     patient_values[2] = patient._systolic
                     patient_values[3] = patient._diastolic
                     patient_values[4] = patient._blood_pressure_time
-
-                    self.monitored_patients.patient_tree.item(item, values=tuple(patient_values))
+                    self.monitored_patients.set_row(patient._id, values=tuple(patient_values))
 
                 elif (cholestrol == True) and (bp == False):
+                    self.monitored_patients.monitored_vitals[patient._id] = (True, monitored_bp)
                     patient_values[0] = patient._total_chol
                     patient_values[1] = patient._last_update
-                    self.monitored_patients.patient_tree.item(item, values=tuple(patient_values))
+                    self.monitored_patients.set_row(patient._id, values=tuple(patient_values))
 
                 tag_above = "above"
                 tag_below = "below"
                 if len(self.monitored_patients.patient_dict) >= 1:
                     # only need to change font colour if there are patients in the monitor list.
-                    # calculate new cholesterol average now that an item has been popped from the dictionary
-                    avg_chol = self.model.chol_average(self.monitored_patients.patient_dict)
                     # check which entries left in the monitored patient list have above average cholesterol and change their
                     # colour based on that
-                    self.check_children_chol(systolic_limit, diastolic_limit, avg_chol, tag_above, tag_below)
+                    self.check_children_chol(tag_above, tag_below, (patient._id,))
                     # process the colours assigned to the tags
                     self.style.map("Treeview", foreground=self.change_font_colour("foreground"))
 
-    def remove_specific_monitor(self, systolic_limit, diastolic_limit, cholestrol, bp):
+    def remove_specific_monitor(self, cholestrol, bp):
 
-        if len(self.monitored_patients.patient_tree.selection()) > 0:
+        item = self.monitored_patients.selected_id()
+        if item is not None:
             # check if an item has been selected
-            item = self.monitored_patients.patient_tree.selection()[0]
-
-            patient_values = list(self.monitored_patients.patient_tree.item(item, "values"))
+            patient_values = list(self.monitored_patients.row_values(item))
+            monitored_chol, monitored_bp = self.monitored_patients.monitored_vitals[item]
 
             if (cholestrol == True) and (bp == False):
+                self.monitored_patients.monitored_vitals[item] = (monitored_chol, False)
                 patient_values[2] = '-'
                 patient_values[3] = '-'
                 patient_values[4] = '-'
-
-                self.monitored_patients.patient_tree.item(item, values=tuple(patient_values))
+                self.monitored_patients.set_row(item, values=tuple(patient_values))
 
             elif (cholestrol == False) and (bp == True):
+                self.monitored_patients.monitored_vitals[item] = (False, monitored_bp)
                 patient_values[0] = '-'
                 patient_values[1] = '-'
-                self.monitored_patients.patient_tree.item(item, values=tuple(patient_values))
+                self.monitored_patients.set_row(item, values=tuple(patient_values))
 
             tag_above = "above"
             tag_below = "below"
             if len(self.monitored_patients.patient_dict) >= 1:
                 # only need to change font colour if there are patients in the monitor list.
-                # calculate new cholesterol average now that an item has been popped from the dictionary
-                avg_chol = self.model.chol_average(self.monitored_patients.patient_dict)
                 # check which entries left in the monitored patient list have above average cholesterol and change their
                 # colour based on that
-                self.check_children_chol(systolic_limit, diastolic_limit, avg_chol, tag_above, tag_below)
+                self.check_children_chol(tag_above, tag_below, (item,))
                 # process the colours assigned to the tags
                 self.style.map("Treeview", foreground=self.change_font_colour("foreground"))
 
-    def remove_monitor(self, systolic_limit, diastolic_limit):
+    def remove_monitor(self):
         """
         Remove a specific patient from the monitor list.
         :return: none
         """
         # remove patient from the monitored patient list, not destroying any patient objects in the patient_list,
         # just the treeview entry
-        if len(self.monitored_patients.patient_tree.selection()) > 0:
+        item = self.monitored_patients.selected_id()
+        if item is not None:
             # check if an item has been selected
-            item = self.monitored_patients.patient_tree.selection()[0]
-            patient_id = self.monitored_patients.patient_tree.item(item, "values")[8]
-
-            self.monitored_patients.patient_tree.delete(item)
-            self.monitored_patients.patient_dict.pop(patient_id)
+            self.monitored_patients.delete_row(item)
+            self.monitored_patients.patient_dict.pop(item)
+            self.monitored_patients.monitored_vitals.pop(item, None)
             # tags for above avg cholesterol and below avg
             tag_above = "above"
             tag_below = "below"
             if len(self.monitored_patients.patient_dict) >= 1:
                 # only need to change font colour if there are patients in the monitor list.
-                # calculate new cholesterol average now that an item has been popped from the dictionary
-                avg_chol = self.model.chol_average(self.monitored_patients.patient_dict)
                 # check which entries left in the monitored patient list have above average cholesterol and change their
                 # colour based on that
-                self.check_children_chol(systolic_limit, diastolic_limit, avg_chol, tag_above, tag_below)
+                self.check_children_chol(tag_above, tag_below)
                 # process the colours assigned to the tags
                 self.style.map("Treeview", foreground=self.change_font_colour("foreground"))
+            else:
+                # nothing is monitored any more, so the rules raised for the last patient are cleared
+                self.model.evaluate_alerts({})
 
-    def check_children_chol(self, systolic_limit, diastolic_limit, avg_chol, tag_above, tag_below):
+    def check_children_chol(self, tag_above, tag_below, patient_ids=()):
         """
-        Traverse through the monitored patient list, checking if the cholesterol value attached to the patient object
-        is above the calculated average of all patients in the monitor treeview
-        :param avg_chol: the average cholesterol of all patients in the monitor treeview
+        Evaluate the models alert rules over the monitored patients once the monitor list has changed, and recolour the
+        given patients and the patients whose rules were raised or cleared, see colour_monitored
         :param tag_above: tag used to denote if a patient has above the average cholesterol in the treeview
         :param tag_below: tag used to denote if a patient has below the average cholesterol in the treeview
-        :param systolic_limit: tag used to denote if a patient has below the average cholesterol in the treeview
-        :param diastolic_limit: tag used to denote if a patient has below the average cholesterol in the treeview
-
-
+        :param patient_ids: monitored patients to recolour even if none of their rules changed, such as one just added
         :return: none
         """
+        patient_dict, hidden = self.monitored_population()
+        transitions = self.model.evaluate_alerts(patient_dict, hidden)
+        patient_ids = set(patient_ids).union(patient_id for state, rule_name, patient_id in transitions)
+        self.colour_monitored(patient_ids, tag_above, tag_below)
 
-        for item in self.monitored_patients.patient_tree.get_children():
-
-            patient_values = (self.monitored_patients.patient_tree.item(item, "text"),
-                              self.monitored_patients.patient_tree.item(item, "values"), item)
-            patient = self.model.return_patient(patient_values)
-
-
-            #Perform the Cholesterol Checks and BP Checks, change color accordingly
-            #Show red foreground if patient's total chol above avg chol
-            #Show Light Salmon background if either patient systolic or diastolic above set parameters
-
-            self.monitored_patients.patient_tree.tag_configure(tag_below, foreground='black')
+    def colour_monitored(self, patient_ids, tag_above="above", tag_below="below"):
+        """
+        Colour monitored patients by the rules that are currently raised for them. Cholesterol above the average of the
+        monitored patients shows a red foreground, and any other raised rule, such as the systolic and diastolic limits,
+        shows a light salmon background.
+        :param patient_ids: ids of the monitored patients to recolour, others are skipped
+        :param tag_above: tag used to denote if a patient has above the average cholesterol in the treeview
+        :param tag_below: tag used to denote if a patient has below the average cholesterol in the treeview
+        :return: none
+        """
+        self.monitored_patients.patient_tree.tag_configure(tag_above, foreground='red')
+        self.monitored_patients.patient_tree.tag_configure(tag_below, foreground='black')
+        self.monitored_patients.patient_tree.tag_configure("alert", background="light salmon")
 
-            if patient._systolic == '-':
-                self.monitored_patients.patient_tree.item(item, tags=tag_below)
-                self.monitored_patients.patient_tree.tag_configure(tag_below, foreground='black')
-            else:
-                if systolic_limit and diastolic_limit:
-                    if int(patient._systolic) > systolic_limit or int(patient._diastolic) > diastolic_limit:
-                        self.monitored_patients.patient_tree.item(item, tags=tag_above)
-                        self.monitored_patients.patient_tree.tag_configure(tag_above,background="light salmon", foreground="black")
-                    else:
-                        self.monitored_patients.patient_tree.item(item, tags=tag_below)
-                        self.monitored_patients.patient_tree.tag_configure(tag_below, foreground='black')
+        chol_above = self.model.rule_engine.active_patients(Model.CHOL_RULE)
+        for patient_id in patient_ids:
+            if not self.monitored_patients.has_row(patient_id):
+                continue
+            tags = [tag_above if patient_id in chol_above else tag_below]
+            if self.model.rule_engine.alerting_rules(patient_id, exclude=(Model.CHOL_RULE,)):
+                tags.append("alert")
+            self.monitored_patients.set_row(patient_id, tags=tuple(tags))
 
-            # go through the elements in the monitor list, checking if their cholesterol value is higher than the average
-            # calculated for the monitor list
+    def monitored_row_values(self, patient):
+        """
+        :param patient: a monitored Patient object
+        :return: tuple of the values shown in the patients monitored row, with the vitals not monitored shown as '-'
+        """
+        cholestrol, bp = self.monitored_patients.monitored_vitals[patient._id]
+        cholesterol_values = (patient._total_chol, patient._last_update) if cholestrol else ('-', '-')
+        blood_pressure_values = (patient._systolic, patient._diastolic, patient._blood_pressure_time) if bp \
+            else ('-', '-', '-')
+        return cholesterol_values + blood_pressure_values + (patient._city, patient._state, patient._country,
+                                                             patient._id, patient._gender, patient._birth_date)
+
+    def apply(self, events):
+        """
+        Bring the monitored patient list up to date with the changes journaled by the model, only touching the rows of
+        the monitored patients the events name: new readings are shown in their rows, and the rows of patients whose
+        rules were raised or cleared are recoloured. A change of threshold recolours every monitored patient, as the
+        rule it changed starts over.
+        :param events: list of ChangeEvents
+        :return: none
+        """
+        for patient in self.changed_patients(events, (ChangeJournal.VITAL_UPDATED,)):
+            if patient._id in self.monitored_patients.monitored_vitals:
+                self.monitored_patients.set_row(patient._id, values=self.monitored_row_values(patient))
+        if any(event.kind == ChangeJournal.THRESHOLD_CHANGED for event in events):
+            self.refresh_alerts()
+            return
+        alerted = set(event.patient_id for event in events if event.kind == ChangeJournal.ALERT_CHANGED)
+        if alerted:
+            self.colour_monitored(alerted)
+            self.style.map("Treeview", foreground=self.change_font_colour("foreground"))
 
-            if patient._total_chol == '-':
-                self.monitored_patients.patient_tree.item(item, tags=tag_below)
-                self.monitored_patients.patient_tree.tag_configure(tag_below, foreground='black')
-            else:
-                if float(patient._total_chol) > avg_chol:
-                    self.monitored_patients.patient_tree.item(item, tags=tag_above)
-                    self.monitored_patients.patient_tree.tag_configure(tag_above, foreground='red')
-                else:
-                    self.monitored_patients.patient_tree.item(item, tags=tag_below)
-                    self.monitored_patients.patient_tree.tag_configure(tag_below, foreground='black')
+    def monitored_population(self):
+        """
+        The monitored patients as the alert rules see them, safe to call from the update threads
+        :return: tuple of a dictionary of patient id to the live Patient object for each monitored patient, and a
+                 dictionary of patient id to the vitals that are not monitored for that patient
+        """
+        patient_dict = {}
+        hidden = {}
+        for patient_id, (cholestrol, bp) in list(self.monitored_patients.monitored_vitals.items()):
+            patient = self.patient_list.patient_dict.get(patient_id)
+            if patient is None:
+                continue
+            patient_dict[patient_id] = patient
+            hidden[patient_id] = (() if cholestrol else ("total_chol",)) + (() if bp else ("systolic", "diastolic"))
+        return patient_dict, hidden
 
+    def refresh_alerts(self):
+        """
+        Re-evaluate the alert rules and recolour the monitored patients, used once the rules themselves change
+        :return: none
+        """
+        if len(self.monitored_patients.patient_dict) >= 1:
+            self.check_children_chol("above", "below", self.monitored_patients.row_ids())
+            self.style.map("Treeview", foreground=self.change_font_colour("foreground"))
 
-    def insert_patients(self):
+    def insert_patients(self, patients):
         """
         Insert patients into the patient_list treeview, that is, the treeview that will display all patients found from
-        the server call that have a total cholesterol value reported for them.
+        the server call that have a total cholesterol value reported for them. Patients already in the treeview are
+        left in place, so adding a practitioner does not reload the patients of the others.
+        :param patients: iterable of Patient objects to insert
         :return: none
         """
-        # runs after completion of server contacting, inserts all patients found on server into the
-        # patient_list treeview
-        self.clear_tree(self.patient_list.patient_tree)
-        self.clear_tree(self.monitored_patients.patient_tree)
-        self.monitored_patients.patient_dict = {}
-
-        for patient_id in self.patient_list.patient_dict:
-            patient = self.patient_list.patient_dict[patient_id]
-            self.patient_list.patient_tree.insert("", "end", text=patient._name, values=(patient._total_chol,
-                                                                                         patient._last_update,
-                                                                                         patient._systolic,
-                                                                                         patient._diastolic,
-                                                                                         patient._blood_pressure_time,
-                                                                                    patient._city, patient._state,
-                                                                                    patient._country, patient._id,
-                                                                                    patient._gender,
-                                                                                    patient._birth_date))
-
-    def clear_tree(self, treeview):
+        for patient in patients:
+            if self.patient_list.has_row(patient._id):
+                continue
+            # the patient id doubles as the treeview item id so that rows can be found again when removed
+            self.patient_list.insert_row(patient._id, patient._name, (patient._total_chol,
+                                                                      patient._last_update,
+                                                                      patient._systolic,
+                                                                      patient._diastolic,
+                                                                      patient._blood_pressure_time,
+                                                                      patient._city, patient._state,
+                                                                      patient._country, patient._id,
+                                                                      patient._gender,
+                                                                      patient._birth_date))
+
+    def remove_patients(self, patient_ids):
         """
-        Delete all children within the specified treeview
-        :param treeview: the treeview for which to clear all children off of.
+        Remove patients from both the patient_list and monitored treeviews, used once the last practitioner who
+        sees them has been removed from the roster
+        :param patient_ids: iterable of patient id strings to remove
         :return: none
         """
-        if len(treeview.get_children()) > 0:
-            # unpacking the children list returned from the treeview
-            treeview.delete(*treeview.get_children())
+        patient_ids = set(patient_ids)
+        for patient_id in patient_ids:
+            if self.patient_list.has_row(patient_id):
+                self.patient_list.delete_row(patient_id)
+            if self.monitored_patients.has_row(patient_id):
+                self.monitored_patients.delete_row(patient_id)
+            self.monitored_patients.patient_dict.pop(patient_id, None)
+            self.monitored_patients.monitored_vitals.pop(patient_id, None)
+
+        if len(self.monitored_patients.patient_dict) >= 1:
+            self.check_children_chol("above", "below")
+            self.style.map("Treeview", foreground=self.change_font_colour("foreground"))
+        else:
+            self.model.evaluate_alerts({})
 
+    def show_server_status(self, status):
+        """
+        Display the state of the circuit breaker and rate limiter protecting the server
+        :param status: dictionary returned by Server.get_status
+        :return: none
+        """
+        text = "Server: " + status["state"]
+        if status["state"] != CircuitBreaker.CLOSED:
+            text += " (retry in " + str(int(status["retry_in"])) + "s)"
+        text += "   Breaker trips: " + str(status["trips"]) + "   Rejected: " + str(status["rejected"]) + \
+                "   Throttled: " + str(status["throttled"])
+        self.server_status_label['text'] = text
+        self.server_status_label['foreground'] = 'black' if status["state"] == CircuitBreaker.CLOSED else 'red'
 
     def get_id_entry(self):
         """
@@ -491,6 +2406,63 @@ class View:
         """
         return self.id_entry.get()
 
+    def get_practitioner_ids(self):
+        """
+        Split the practitioner identifier field into the separate identifiers entered, separated by commas or spaces
+        :return: list of practitioner identifier strings, in the order entered and without duplicates
+        """
+        practitioner_ids = []
+        for practitioner_id in self.get_id_entry().replace(",", " ").split():
+            if practitioner_id not in practitioner_ids:
+                practitioner_ids.append(practitioner_id)
+        return practitioner_ids
+
+    def show_push_mode(self, push_mode):
+        """
+        Show whether updates are pushed by the server or polled
+        :param push_mode: boolean
+        :return: none
+        """
+        self.push_button['text'] = "Push Updates: On" if push_mode else "Push Updates: Off"
+
+    def get_search_query(self):
+        """
+        Split the search entry into the name words and the location filters. Parts are separated by commas, and a part
+        starting with "city:" or "state:" filters by location, eg "john, state: Massachusetts"
+        :return: tuple of the name text, and the state and city to filter by, each None if not given
+        """
+        text = []
+        location = {"state": None, "city": None}
+        for part in self.search_entry.get().split(","):
+            field, separator, value = part.partition(":")
+            if separator and field.strip().lower() in location:
+                location[field.strip().lower()] = value.strip() or None
+            else:
+                text.append(part)
+        return " ".join(text), location["state"], location["city"]
+
+    def get_sort(self):
+        """
+        :return: tuple of the PatientIndex sort key chosen, or None for roster order, and whether to sort descending
+        """
+        if not self.secondary_widgets_built:
+            return None, self.sort_descending
+        return self.SORT_OPTIONS.get(self.sort_box.get()), self.sort_descending
+
+    def refresh_patients(self, patients):
+        """
+        Refresh the values held in the patient_list rows of patients that have been updated
+        :param patients: iterable of Patient objects
+        :return: none
+        """
+        for patient in patients:
+            if self.patient_list.has_row(patient._id):
+                self.patient_list.set_row(patient._id, values=(patient._total_chol, patient._last_update,
+                                                               patient._systolic, patient._diastolic,
+                                                               patient._blood_pressure_time, patient._city,
+                                                               patient._state, patient._country, patient._id,
+                                                               patient._gender, patient._birth_date))
+
     def get_update_period_entry(self):
         """
         Get the user inputted update period
@@ -498,15 +2470,21 @@ class View:
         """
         return self.update_period_entry.get()
 
+    def get_selected_monitored_id(self):
+        """
+        :return: id of the patient highlighted in the monitor treeview, or None if none is selected
+        """
+        return self.monitored_patients.selected_id()
+
     def show_selected_patient_info(self):
         """
         Displayed the highlighted patients information from the monitor treeview (birth date, gender and address)
         :return: none
         """
-        if len(self.monitored_patients.patient_tree.selection()) > 0:
+        item = self.monitored_patients.selected_id()
+        if item is not None:
 
-            item = self.monitored_patients.patient_tree.selection()[0]
-            selected_patient_values = self.monitored_patients.patient_tree.item(item, "values")
+            selected_patient_values = self.monitored_patients.row_values(item)
             selected_patient_id = selected_patient_values[8]
             selected_patient_name = self.patient_list.patient_dict[selected_patient_id]._birth_date
             selected_patient_gender = self.patient_list.patient_dict[selected_patient_id]._gender
@@ -514,7 +2492,7 @@ class View:
             selected_patient_state = self.patient_list.patient_dict[selected_patient_id]._state
             selected_patient_city = self.patient_list.patient_dict[selected_patient_id]._city
             selected_patient_full_address = selected_patient_city + "," + selected_patient_state + "," + selected_patient_country
-            test_selected_name = selected_patient_values = self.monitored_patients.patient_tree.item(item, "text")
+            test_selected_name = selected_patient_values = self.monitored_patients.row_text(item)
 
 
             self.patient_name_label['text'] = "Birthdate: " + selected_patient_name
@@ -527,31 +2505,89 @@ class View:
 
 
 
-class Controller(Publisher):
+class Controller(Publisher, JournalConsumer):
     """
     Class responsible for the interpretation of user inputs, and the management of the behaviour for
     those inputs by informing the model and/or view classes.
     """
-    def __init__(self):
+    def __init__(self, normalise_mode="inline", virtual_lists=False, receiver=None, dispatch_width=4,
+                 dispatch_timeout=60.0, poll_shards=0, chart_aggregate_above=200, history_dir=None,
+                 journal_retain=10000):
         """
         Initialise the controller object, and super call the publisher class, which creates a set for future observers
         to be placed in. Bind all buttons and clicks to be handled within the controller class.
+        :param normalise_mode: where fetched bundles are normalised, Normaliser.INLINE, THREAD or PROCESS
+        :param virtual_lists: whether the view only materialises the rows of its lists that are in view
+        :param receiver: SubscriptionReceiver used in push mode, one listening on a free local port if not given
+        :param dispatch_width: number of patients updated at the same time
+        :param dispatch_timeout: seconds a patient may take to update before the tick stops waiting for it
+        :param poll_shards: most worker processes to poll patients from, 0 polls them on a thread of this process
+        :param chart_aggregate_above: number of monitored patients above which the graph shows their distributions
+        :param history_dir: folder of the HistoryArchive every reading observed is appended to, or None to not keep one
+        :param journal_retain: most change journal events kept once applied, None keeps them all for replay
         """
-        super().__init__()
+        Publisher.__init__(self, width=dispatch_width, timeout=dispatch_timeout)
+        JournalConsumer.__init__(self)
+        Server.normaliser.set_mode(normalise_mode)
         self.period = 0
+        # a patient that keeps returning the same values is polled at most every period * poll_ceiling_factor seconds
+        self.poll_ceiling_factor = 8
+        self.scheduler = None
+        # ids of the patients with an update running, which are not updated again until it finishes
+        self.updating = set()
+        self.updating_lock = threading.Lock()
+        self.poll_shards = poll_shards
+        self.sharded_poller = None
+        # whether the patient_list is currently filtered or sorted by a search
+        self.searching = False
+        # in push mode the monitored patients are updated as the server notifies the receiver of new reports and
+        # blood pressures, and polling falls back to reconciling every patient at most every reconcile_interval
+        # seconds, in case a notification was lost
+        self.push_mode = False
+        self.reconcile_interval = 300
+        self.receiver = receiver if receiver is not None else SubscriptionReceiver()
+        self.subscriptions = {}
+        self.subscription_lock = threading.Lock()
+        self.notification_thread = None
         self.systolic_limit = None
         self.diastolic_limit = None
 
         self.thread = None
         self.graph_thread = None
         self.root = tk.Tk()
-        self.model = Model()
-        self.view = View(self.root, self.model)
+        self.model = Model(journal_retain)
+        self.view = View(self.root, self.model, virtual_lists, chart_aggregate_above)
         self.server = Server(self.model)
-
-        # bind buttons to functionality defined in the controller.
+        # the location of a patient is only known once its demographics load, so it is reindexed then
+        self.demographics = DemographicsLoader(self.server, on_load=self.model.patient_index.update)
+        self.history = HistoryArchive(history_dir) if history_dir else None
+        # the patient index subscribes itself when the model is created, the archive and the ui follow it so that
+        # searches already see the changes they are refreshed for
+        if self.history is not None:
+            self.model.journal.subscribe(self.history)
+        self.model.journal.subscribe(self)
+        self.model.journal.subscribe(self.view)
+
+        # bind buttons to functionality defined in the controller. The buttons built after the window first appears
+        # are bound in bind_secondary_widgets.
         # also bind the mouse release on the monitored patient list to run functionality in the view class which
         # display the selected patients information.
+        self.view.id_button.bind('<Button>', lambda event, result=(): self.contact_server())
+        self.view.remove_practitioner_button.bind('<Button>', lambda event, result=(): self.remove_practitioner())
+        self.view.bulk_load_button.bind('<Button>', lambda event, result=(): self.bulk_load())
+
+        self.view.monitored_patients.patient_tree.bind('<ButtonRelease-1>',
+                                                       lambda event, result=(): self.show_patient_info())
+        self.view.patient_list.patient_tree.heading("#0", command=self.toggle_sort_direction)
+
+    def bind_secondary_widgets(self):
+        """
+        Build the widgets the view defers until after the first paint, and bind them to their functionality
+        :return: none
+        """
+        if self.view.secondary_widgets_built:
+            return
+        self.view.build_secondary_widgets()
 
         self.view.graph_patient.bind('<Button>', lambda event, result=(): self.add_patient_graph())
 
@@ -573,25 +2609,73 @@ class Controller(Publisher):
         self.view.remove_patient_blood_pressure.bind('<Button>', lambda event, result=(
             self.view.patient_list, self.view.monitored_patients): self.remove_patient_bp_monitor())
 
-        self.view.id_button.bind('<Button>', lambda event, result=(): self.contact_server())
         self.view.update_button.bind('<Button>', lambda event, result=(): self.update_period())
 
         self.view.systolic_bp_button.bind('<Button>', lambda event, result=(): self.set_systolic_limit())
         self.view.diastolic_bp_button.bind('<Button>', lambda event, result=(): self.set_diastolic_limit())
-
-        self.view.monitored_patients.patient_tree.bind('<ButtonRelease-1>',
-                                                       lambda event, result=(): self.view.show_selected_patient_info())
+        self.view.alert_rule_button.bind('<Button>', lambda event, result=(): self.add_alert_rule())
+        self.view.push_button.bind('<Button>', lambda event, result=(): self.toggle_push_mode())
+        self.view.search_button.bind('<Button>', lambda event, result=(): self.search_patients(True))
+        self.view.search_entry.bind('<Return>', lambda event, result=(): self.search_patients(True))
+        self.view.sort_box.bind('<<ComboboxSelected>>', lambda event, result=(): self.search_patients(True))
 
     def run(self):
         """
         Responsible for launching the tkinter mainloop, and the creation of the application to the user.
         :return: none
         """
-
-
         self.root.title("FHIR Monitor")
+        self.refresh_server_status()
+        # build the rest of the widgets once the window has been mapped and its first frame drawn
+        self.root.bind("<Map>", self.on_first_map)
         self.root.mainloop()
+        # the window has been closed, so nothing more is journaled to the archive
+        if self.history is not None:
+            self.history.close()
+
+    def on_first_map(self, event):
+        """
+        Schedule the secondary widgets when the window is first mapped. An idle callback can run before the window is
+        drawn, so the build is left on a short timer, which lets the pending redraw of the first frame go first.
+        :param event: the tkinter <Map> event, which the children of the window send to it too
+        :return: none
+        """
+        if event.widget is not self.root:
+            return
+        self.root.unbind("<Map>")
+        self.root.after(1, self.bind_secondary_widgets)
 
+    def benchmark_startup(self):
+        """
+        Measure how long the application takes to import, to first paint the window, and to finish building every
+        widget, then close the window.
+        :return: dictionary of the milliseconds taken for each stage, measured from when the module started loading
+        """
+        self.root.title("FHIR Monitor")
+        self.root.update()
+        first_paint = perf_counter()
+        self.bind_secondary_widgets()
+        self.root.update()
+        interactive = perf_counter()
+        timings = {
+            "imports": (IMPORTS_LOADED - MODULE_STARTED) * 1000,
+            "first_paint": (first_paint - MODULE_STARTED) * 1000,
+            "interactive": (interactive - MODULE_STARTED) * 1000,
+        }
+        for stage in timings:
+            print(stage + ": " + str(round(timings[stage], 1)) + " ms")
+        self.root.destroy()
+        if self.history is not None:
+            self.history.close()
+        return timings
+
+    def refresh_server_status(self):
+        """
+        Show the servers circuit breaker and rate limiter status in the view, repeating every second on the ui thread
+        :return: none
+        """
+        self.view.show_server_status(self.server.get_status())
+        self.root.after(1000, self.refresh_server_status)
 
     def add_patient_monitor(self):
         """
@@ -599,7 +2683,8 @@ class Controller(Publisher):
         for handling a patient being added to the monitor treeview
         :return: none
         """
-        self.view.add_monitor(self.systolic_limit, self.diastolic_limit, cholestrol=True, bp=True)
+        self.view.add_monitor(cholestrol=True, bp=True)
+        self.sync_subscriptions()
 
     def add_patient_cholestrol_monitor(self):
         """
@@ -607,7 +2692,8 @@ class Controller(Publisher):
         for handling a patient being added to the monitor treeview
         :return: none
         """
-        self.view.add_monitor(self.systolic_limit, self.diastolic_limit, cholestrol=True, bp=False)
+        self.view.add_monitor(cholestrol=True, bp=False)
+        self.sync_subscriptions()
 
     def add_patient_bp_monitor(self):
         """
@@ -615,28 +2701,30 @@ class Controller(Publisher):
         for handling a patient being added to the monitor treeview
         :return: none
         """
-        self.view.add_monitor(self.systolic_limit, self.diastolic_limit, cholestrol=False, bp=True)
+        self.view.add_monitor(cholestrol=False, bp=True)
+        self.sync_subscriptions()
 
     def remove_patient_monitor(self):
         """
         Launches once the remove patient button is pressed, responsible for notifying the view that some behn
         :return: none
         """
-        self.view.remove_monitor(self.systolic_limit, self.diastolic_limit)
+        self.view.remove_monitor()
+        self.sync_subscriptions()
 
     def remove_patient_cholestrol_monitor(self):
         """
         Launches once the remove patient button is pressed, responsible for notifying the view that some behn
         :return: none
         """
-        self.view.remove_specific_monitor(self.systolic_limit, self.diastolic_limit, cholestrol=False, bp=True)
+        self.view.remove_specific_monitor(cholestrol=False, bp=True)
 
     def remove_patient_bp_monitor(self):
         """
         Launches once the remove patient button is pressed, responsible for notifying the view that some behn
         :return: none
         """
-        self.view.remove_specific_monitor(self.systolic_limit, self.diastolic_limit, cholestrol=True, bp=False)
+        self.view.remove_specific_monitor(cholestrol=True, bp=False)
 
     def add_patient_graph(self):
         """
@@ -648,31 +2736,210 @@ class Controller(Publisher):
 
     def contact_server(self):
         """
-        Contact the server to retrieve all patients for a particular practitioners identifier. Launched once the
-        id_button is clicked. Will notify the view to insert all patients into the patient_list treeview
+        Contact the server to retrieve all patients for the practitioner identifiers entered. Launched once the
+        id_button is clicked. Practitioners already on the roster are skipped, and the encounters of the new ones are
+        crawled concurrently. Patients shared with practitioners already on the roster are not fetched again. Will
+        notify the view to insert the new patients into the patient_list treeview
         :return: none
         """
-        practitioner_id = self.view.get_id_entry()
-        # contact server and be returned a dictionary with all patients that have a 'total cholesterol' field attached
-        # to their report
-        self.view.patient_list.patient_dict = self.server.get_patients(practitioner_id)
+        practitioner_ids = [practitioner_id for practitioner_id in self.view.get_practitioner_ids()
+                            if practitioner_id not in self.model.roster]
+        if not practitioner_ids:
+            return
+        # contact server and be returned a dictionary with all new patients that have a 'total cholesterol' field
+        # attached to their report
+        try:
+            practitioner_patients, patient_dict = self.server.get_practitioners_patients(
+                practitioner_ids, self.model.roster.patient_ids())
+        except ServerUnavailableError as error:
+            # leave the roster as it was, the practitioners can be retrieved again once the server recovers
+            print("could not retrieve patients: " + str(error))
+            self.view.show_server_status(self.server.get_status())
+            return
+        for practitioner_id in practitioner_ids:
+            self.model.roster.add_practitioner(practitioner_id, practitioner_patients[practitioner_id])
+
         # attach the patients to the dashboardcontroller so that they may be updated through the observer pattern
-        for patient in self.view.patient_list.patient_dict:
-            self.attach(self.view.patient_list.patient_dict[patient])
+        for patient_id in patient_dict:
+            self.view.patient_list.patient_dict[patient_id] = patient_dict[patient_id]
+            self.attach(patient_dict[patient_id])
+        self.view.insert_patients(patient_dict.values())
+        self.model.add_patients(patient_dict.values())
+        self.model.journal.dispatch()
+        # demographics are only needed once a patient is selected, so load them behind the patient list
+        self.demographics.request(patient_dict.values())
+
+    def bulk_load(self):
+        """
+        Load patients through the FHIR Bulk Data path instead of crawling encounters. If the id field holds a folder,
+        the NDJSON files in it are read, otherwise the practitioner identifiers entered are loaded from a $export run
+        on the server. Runs on its own thread, as a large export can take several minutes.
+        :return: none
+        """
+        source = self.view.get_id_entry().strip()
+        if os.path.isdir(source):
+            practitioner_ids = None
+        else:
+            practitioner_ids = [practitioner_id for practitioner_id in self.view.get_practitioner_ids()
+                                if practitioner_id not in self.model.roster]
+            if not practitioner_ids:
+                return
+        threading.Thread(target=self.run_bulk_load, args=(source, practitioner_ids), daemon=True).start()
+
+    def run_bulk_load(self, source, practitioner_ids):
+        """
+        Ingest the bulk data and hand the patients found back to the ui thread
+        :param source: the folder of NDJSON files, unused when loading from the server
+        :param practitioner_ids: practitioner identifiers to load from the server, or None to read the folder
+        :return: none
+        """
+        ingestor = BulkExportIngestor(self.model)
+        try:
+            if practitioner_ids is None:
+                ingestor.ingest_files(source)
+            else:
+                ingestor.ingest_export(self.server, practitioner_ids)
+        except (ServerUnavailableError, OSError, ValueError) as error:
+            print("bulk load failed: " + str(error))
+            return
+        practitioner_patients, patient_dict = ingestor.build(practitioner_ids)
+        if practitioner_patients is None:
+            # every patient in the folder is kept, under the folder in place of a practitioner
+            practitioner_patients = {source: list(patient_dict)}
+        print("bulk load read " + str(ingestor.lines) + " resources, " + str(len(patient_dict)) + " patients")
+        self.root.after(0, lambda: self.finish_bulk_load(practitioner_patients, patient_dict))
+
+    def finish_bulk_load(self, practitioner_patients, patient_dict):
+        """
+        Add the bulk loaded practitioners and patients to the roster and the view, skipping patients already loaded
+        :param practitioner_patients: dictionary mapping each practitioner identifier to its patient ids
+        :param patient_dict: dictionary of Patient objects, with their demographics already filled in
+        :return: none
+        """
+        new_patients = {}
+        for practitioner_id in practitioner_patients:
+            if practitioner_id in self.model.roster:
+                continue
+            for patient_id in self.model.roster.add_practitioner(practitioner_id, practitioner_patients[practitioner_id]):
+                if patient_id in patient_dict:
+                    new_patients[patient_id] = patient_dict[patient_id]
+
+        for patient_id in new_patients:
+            patient = new_patients[patient_id]
+            # the export already holds the demographics, so the loader never needs to fetch them
+            self.demographics.cache[patient_id] = {"birth_date": patient._birth_date, "gender": patient._gender,
+                                                   "city": patient._city, "state": patient._state,
+                                                   "country": patient._country}
+            self.view.patient_list.patient_dict[patient_id] = patient
+            self.attach(patient)
+        self.view.insert_patients(new_patients.values())
+        self.model.add_patients(new_patients.values())
+        self.model.journal.dispatch()
+
+    def show_patient_info(self):
+        """
+        Display the information of the patient selected in the monitor treeview, loading their demographics first if
+        the background loader has not reached them yet
+        :return: none
+        """
+        patient_id = self.view.get_selected_monitored_id()
+        if patient_id not in self.view.patient_list.patient_dict:
+            return
+        try:
+            self.demographics.load_now(self.view.patient_list.patient_dict[patient_id])
+        except ServerUnavailableError as error:
+            print("could not load patient information: " + str(error))
+        self.view.show_selected_patient_info()
+
+    def search_patients(self, from_top=False):
+        """
+        Show the patients matching the search entry in the patient_list, in the sort order chosen. Also runs after the
+        changes to the patients that can affect the results, so the list stays filtered and sorted as patients are
+        loaded and updated.
+        :param from_top: scroll back to the first result, for a search made by the user rather than a refresh
+        :return: none
+        """
+        text, state, city = self.view.get_search_query() if self.view.secondary_widgets_built else ("", None, None)
+        sort_key, descending = self.view.get_sort()
+        searching = bool(text.strip()) or state is not None or city is not None or sort_key is not None
+        if from_top:
+            self.view.patient_list.scroll_to_top()
+        if not searching and not self.searching:
+            # the list is already unfiltered and in roster order
+            return
+        self.searching = searching
+        self.view.patient_list.show_rows(self.model.patient_index.query(text, state, city, sort_key, descending))
+
+    def toggle_sort_direction(self):
+        self.view.sort_descending = not self.view.sort_descending
+        self.search_patients(True)
+
+    def apply(self, events):
+        """
+        Bring the ui up to date with the changes journaled by the model: show the new values of updated patients in the
+        patient_list, refilter it when patients were added or removed, and resort it when the reading it is sorted by
+        changed. The view keeps the monitored patients up to date itself.
+        :param events: list of ChangeEvents
+        :return: none
+        """
+        self.view.refresh_patients(self.changed_patients(events, (ChangeJournal.VITAL_UPDATED,)))
+        kinds = set(event.kind for event in events)
+        # readings never change which patients match the search, only their place when sorted by that reading
+        sort_key = self.view.get_sort()[0] if self.searching else None
+        if kinds & {ChangeJournal.PATIENT_ADDED, ChangeJournal.PATIENT_REMOVED} or \
+                any(event.kind == ChangeJournal.VITAL_UPDATED and event.field == sort_key for event in events):
+            self.search_patients()
+
+    def remove_practitioner(self):
+        """
+        Remove the practitioner identifiers entered from the roster. Patients that are no longer seen by any remaining
+        practitioner are detached from updates and removed from the view, every other patient is left untouched.
+        :return: none
+        """
+        orphaned_patients = []
+        for practitioner_id in self.view.get_practitioner_ids():
+            orphaned_patients.extend(self.model.roster.remove_practitioner(practitioner_id))
 
-        self.view.insert_patients()
+        for patient_id in orphaned_patients:
+            patient = self.view.patient_list.patient_dict.pop(patient_id, None)
+            if patient is not None:
+                self.detach(patient)
+
+        self.view.remove_patients(orphaned_patients)
+        self.model.remove_patients(orphaned_patients)
+        self.model.journal.dispatch()
+        self.sync_subscriptions()
 
     def set_systolic_limit(self):
         try:
             self.systolic_limit = int(self.view.systolic_bp_entry.get())
         except:
             return
+        self.model.set_limit_rule(Model.SYSTOLIC_RULE, "systolic", self.systolic_limit)
+        self.model.journal.dispatch()
 
     def set_diastolic_limit(self):
         try:
             self.diastolic_limit = int(self.view.diastolic_bp_entry.get())
         except:
             return
+        self.model.set_limit_rule(Model.DIASTOLIC_RULE, "diastolic", self.diastolic_limit)
+        self.model.journal.dispatch()
+
+    def add_alert_rule(self):
+        """
+        Compile the rule written in the alert rule field, such as "systolic > 140 for 3", and add it to the rule engine.
+        The rule text doubles as its name.
+        :return: none
+        """
+        text = self.view.alert_rule_entry.get().strip()
+        try:
+            rule = AlertRule.parse(text, text)
+        except ValueError as error:
+            print("invalid alert rule: " + str(error))
+            return
+        self.model.set_rule(rule)
+        self.model.journal.dispatch()
 
     def update_period(self):
         """
@@ -681,55 +2948,275 @@ class Controller(Publisher):
         :return:
         """
         try:
-            self.period = int(self.view.get_update_period_entry())
+            period = int(self.view.get_update_period_entry())
         except:
             return
+        if period <= 0:
+            return
+        self.period = period
+        self.start_polling()
+
+    def start_polling(self):
+        """
+        Create the scheduler, or change its bounds, to poll every patient at the update period, or at the reconcile
+        interval in push mode, and start the update thread if it has not been started
+        :return: none
+        """
+        floor = max(self.period, self.reconcile_interval) if self.push_mode else self.period
+        if self.poll_shards > 0:
+            self.start_sharded_polling(floor)
+            return
+        if self.scheduler is None:
+            self.scheduler = PollScheduler(floor, floor * self.poll_ceiling_factor)
+            for observer in self.observers:
+                self.scheduler.add(observer._id)
+        else:
+            self.scheduler.set_bounds(floor, floor * self.poll_ceiling_factor)
 
         # Create a new thread if one has not been started, only want one thread
         if self.thread is None and len(self.view.patient_list.patient_dict) > 0:
             # update the patients information through another thread from the main ui thread. lets users interact with
             # system while patients are being updated. This is completed through the threading library, and specifically,
-            # completed through a Thread object at first, then using the time library to place the system in sleep for a
-            # set period of time inside the update_patients function.
+            # completed through a Thread object at first, then the scheduler decides how long to sleep for before
+            # each patient is next due inside the update_patients function.
             self.thread = threading.Thread(target=self.update_patients, args=(self.root,))
             self.thread.start()
 
-    # def update_graph(self, root):
-    #     """
-    #     Repeats itself once launched until the program has been stopped. The function will sleep for a specified period
-    #     of time through the update_period_entry, then notify the observers attached to the controller that they must
-    #     update, which contacts the server to update themselves. Completed asynchronously.
-    #     :param root: The context of which thread to launch itself onto.
-    #     :return: none
-    #     """
-    #
-    #     # while True:
-    #         # sleep for the same period of time before updating the patients again
-    #     sleep(self.period)
-    #     print("updating graph")
-    #     self.notify_observers()
-    #     self.view.create_graph()
-    #
-    #     # root.after(200, self.update_graph(root))
+    def attach(self, observer):
+        """
+        Register a patient to be notified, and schedule its polling if updates have already been started
+        :param observer: Patient object to add
+        :return: none
+        """
+        super().attach(observer)
+        if self.scheduler is not None:
+            self.scheduler.add(observer._id)
+        if self.sharded_poller is not None:
+            self.sharded_poller.add(observer)
+
+    def detach(self, observer):
+        """
+        Deregister a patient from being notified, and stop polling it
+        :param observer: Patient object to remove
+        :return: none
+        """
+        super().detach(observer)
+        if self.scheduler is not None:
+            self.scheduler.remove(observer._id)
+        if self.sharded_poller is not None:
+            self.sharded_poller.remove(observer._id)
+
+    def breaches_limits(self, patient):
+        """
+        Check whether any alert rule other than the cholesterol average is raised for the patient, as of the last
+        evaluation, see evaluate_alerts
+        :param patient: Patient object to check
+        :return: boolean
+        """
+        return len(self.model.rule_engine.alerting_rules(patient._id, exclude=(Model.CHOL_RULE,))) > 0
+
+    def evaluate_alerts(self):
+        """
+        Evaluate the alert rules over the monitored patients, after a round of updates has changed their values
+        :return: list of (state, rule name, patient id) tuples
+        """
+        patient_dict, hidden = self.view.monitored_population()
+        return self.model.evaluate_alerts(patient_dict, hidden)
+
+    def update_patients(self, root):
+        """
+        Repeats itself once launched until the program has been stopped. The function will sleep until the next patient
+        is due according to the scheduler, then notify the due patients that they must update, which contacts the
+        server to update themselves. Each patient is then rescheduled depending on whether its values changed.
+        Completed asynchronously.
+        :param root: The context of which thread to launch itself onto.
+        :return: none
+        """
+        while True:
+            # sleep until the next patient is due, waking at least every period to pick up newly attached patients.
+            # while the circuit breaker is open there is no point waking before it allows requests again
+            due_time = self.scheduler.next_due()
+            wait = self.scheduler.floor if due_time is None else min(due_time - monotonic(), self.scheduler.floor)
+            wait = max(wait, Server.circuit_breaker.retry_in())
+            if wait > 0:
+                sleep(wait)
+
+            patients = []
+            for patient_id in self.scheduler.pop_due():
+                if patient_id in self.view.patient_list.patient_dict:
+                    patients.append(self.view.patient_list.patient_dict[patient_id])
+            if not patients:
+                continue
+
+            print("updating.......")
+            self.update_now(patients)
+
+    def start_sharded_polling(self, floor):
+        """
+        Poll the patients from worker processes instead of the update thread, or change the bounds they poll within
+        :param floor: shortest poll interval in seconds
+        :return: none
+        """
+        if self.sharded_poller is not None:
+            self.sharded_poller.set_bounds(floor, floor * self.poll_ceiling_factor)
+            return
+        self.sharded_poller = ShardedPoller(floor, floor * self.poll_ceiling_factor, max_shards=self.poll_shards,
+                                            width=self.width, timeout=self.timeout)
+        for observer in self.observers:
+            self.sharded_poller.add(observer)
+        self.drain_shards()
+
+    def drain_shards(self):
+        """
+        Apply the readings the shards have sent back to the patients, and show them. Repeats every half second on the
+        ui thread.
+        :return: none
+        """
+        changes = self.sharded_poller.drain()
+        for patient_id in changes:
+            patient = self.view.patient_list.patient_dict.get(patient_id)
+            if patient is None:
+                continue
+            before = patient.get_readings()
+            patient.set_readings(changes[patient_id])
+            self.model.update_readings(patient, before)
+        if changes:
+            self.evaluate_alerts()
+            for patient_id in changes:
+                if patient_id in self.view.patient_list.patient_dict and \
+                        self.breaches_limits(self.view.patient_list.patient_dict[patient_id]):
+                    self.sharded_poller.mark_breached(patient_id)
+            self.model.journal.dispatch()
+        self.root.after(500, self.drain_shards)
+
+    def update_now(self, patients):
+        """
+        Notify patients that they must update, then journal the readings that changed and reschedule each patient
+        depending on whether they did. Used by both the polling loop and push notifications. A patient whose previous
+        update is still running is skipped, and is rescheduled once that update finishes.
+        :param patients: list of Patient objects to update
+        :return: none
+        """
+        with self.updating_lock:
+            patients = [patient for patient in patients if patient._id not in self.updating]
+            self.updating.update(patient._id for patient in patients)
+        before = {}
+        for patient in patients:
+            before[patient._id] = patient.get_readings()
+        report = self.notify_observers(patients)
+        # patients that failed are rescheduled as unchanged, backing off while the server is down
+        for patient in report.failures:
+            print("update failed for patient " + patient._id + ": " + str(report.failures[patient]))
+        # patients that timed out are held out of the schedule until their update finishes, so that a slow patient is
+        # never updated by two threads at once, and their changes are journaled then
+        for patient in report.timed_out:
+            print("update timed out for patient " + patient._id)
+            report.timed_out[patient].add_done_callback(
+                lambda future, patient=patient: self.finish_update(patient, before[patient._id]))
+        patients = [patient for patient in patients if patient not in report.timed_out]
+        if report.slowest:
+            latency, patient = report.slowest[0]
+            print("updated " + str(len(report.latencies)) + " patients, slowest " + patient._id + " in " +
+                  str(round(latency, 2)) + "s")
+        changed = {}
+        for patient in patients:
+            changed[patient._id] = self.model.update_readings(patient, before[patient._id])
+        any_changed = any(changed.values())
+        if any_changed:
+            # the rules are evaluated over the new values before the patients are rescheduled by them
+            self.evaluate_alerts()
+        with self.updating_lock:
+            self.updating.difference_update(changed)
+        for patient in patients:
+            if self.scheduler is not None and patient._id in self.scheduler:
+                self.scheduler.record(patient._id, changed[patient._id], self.breaches_limits(patient))
+        if any_changed:
+            # the consumers are caught up on the ui thread
+            self.root.after(0, self.model.journal.dispatch)
+
+    def finish_update(self, patient, before):
+        """
+        Journal and reschedule a patient whose update timed out, once the update has finished in the background. Runs
+        on the thread that finished the update.
+        :param patient: Patient object that was updated
+        :param before: the patients get_readings from before the update
+        :return: none
+        """
+        changed = self.model.update_readings(patient, before)
+        if changed:
+            self.evaluate_alerts()
+        with self.updating_lock:
+            self.updating.discard(patient._id)
+        if self.scheduler is not None and patient._id in self.scheduler:
+            self.scheduler.record(patient._id, changed, self.breaches_limits(patient))
+        if changed:
+            self.root.after(0, self.model.journal.dispatch)
+
+    def toggle_push_mode(self):
+        """
+        Switch between polling and push updates. Turning push mode on starts the receiver, subscribes the monitored
+        patients and slows polling down to reconciliation, turning it off unsubscribes them and polls at the update
+        period again.
+        :return: none
+        """
+        self.push_mode = not self.push_mode
+        if self.push_mode:
+            self.receiver.start()
+            if self.notification_thread is None:
+                self.notification_thread = threading.Thread(target=self.handle_notifications, daemon=True)
+                self.notification_thread.start()
+        self.view.show_push_mode(self.push_mode)
+        if self.push_mode or self.period > 0:
+            self.start_polling()
+        self.sync_subscriptions()
+
+    def sync_subscriptions(self):
+        """
+        Subscribe the monitored patients that are not subscribed yet, and unsubscribe the patients that are no longer
+        monitored, or every patient once push mode is off. Runs on its own thread, as each subscription is a request.
+        :return: none
+        """
+        if not self.push_mode and not self.subscriptions:
+            return
+        if self.push_mode:
+            wanted = set(self.view.monitored_patients.patient_dict)
+        else:
+            wanted = set()
+        threading.Thread(target=self.run_sync_subscriptions, args=(wanted,), daemon=True).start()
 
-    def update_patients(self, root):
+    def run_sync_subscriptions(self, wanted):
+        with self.subscription_lock:
+            try:
+                for patient_id in [patient_id for patient_id in self.subscriptions if patient_id not in wanted]:
+                    for subscription_id in self.subscriptions[patient_id]:
+                        self.server.delete_subscription(subscription_id)
+                    del self.subscriptions[patient_id]
+                for patient_id in wanted:
+                    if patient_id not in self.subscriptions:
+                        self.subscriptions[patient_id] = self.server.create_subscriptions(
+                            patient_id, self.receiver.url_for(patient_id))
+            except ServerUnavailableError as error:
+                # the patients left over are tried again on the next change to the monitored patients, and the
+                # reconciliation poll covers them until then
+                print("could not update subscriptions: " + str(error))
+
+    def handle_notifications(self):
         """
-        Repeats itself once launched until the program has been stopped. The function will sleep for a specified period
-        of time through the update_period_entry, then notify the observers attached to the controller that they must
-        update, which contacts the server to update themselves. Completed asynchronously.
-        :param root: The context of which thread to launch itself onto.
+        Background loop, updating patients as their notifications arrive. Notifications that arrive together are
+        handled in one batch, and a patient notified several times in a batch is only updated once.
         :return: none
         """
         while True:
-            # sleep for the same period of time before updating the patients again
-            sleep(self.period)
-
-            print("updating.......")
-            self.notify_observers()
-            # root.after(self.period * 1000, lambda: loop.run_until_complete(self.update_patients(root)))
-            root.after(200, self.update_patients(root))
-
-
+            patient_ids = {self.receiver.notifications.get()}
+            while not self.receiver.notifications.empty():
+                patient_ids.add(self.receiver.notifications.get())
+            patients = []
+            for patient_id in patient_ids:
+                if patient_id in self.view.patient_list.patient_dict:
+                    patients.append(self.view.patient_list.patient_dict[patient_id])
+            if patients:
+                print("notified.......")
+                self.update_now(patients)
 
 
 class TreeView(ABC):
@@ -757,9 +3244,271 @@ class TreeView(ABC):
         self.patient_tree.column("#0", minwidth=10, width=75)
         self.patient_tree.bind("<<TreeviewSelect>>")
         # place scroll bar on right hand side of treeview
-        vertical_scroll_bar = ttk.Scrollbar(self.patient_tree, orient="vertical", command=self.patient_tree.yview)
-        vertical_scroll_bar.pack(side='right', fill='y')
-        self.patient_tree.configure(yscrollcommand=vertical_scroll_bar.set)
+        self.vertical_scroll_bar = ttk.Scrollbar(self.patient_tree, orient="vertical", command=self.patient_tree.yview)
+        self.vertical_scroll_bar.pack(side='right', fill='y')
+        self.patient_tree.configure(yscrollcommand=self.vertical_scroll_bar.set)
+
+    # rows are addressed by their item id, which the view sets to the patients id. The view only goes through these
+    # methods, so that VirtualTreeView can hold rows that are not materialised in tkinter.
+
+    def insert_row(self, iid, text, values, tags=()):
+        self.patient_tree.insert("", "end", iid=iid, text=text, values=values, tags=tags)
+
+    def delete_row(self, iid):
+        self.patient_tree.delete(iid)
+
+    def has_row(self, iid):
+        return self.patient_tree.exists(iid)
+
+    def row_ids(self):
+        return self.patient_tree.get_children()
+
+    def row_text(self, iid):
+        return self.patient_tree.item(iid, "text")
+
+    def row_values(self, iid):
+        return self.patient_tree.item(iid, "values")
+
+    def set_row(self, iid, values=None, tags=None):
+        """
+        Change the values and/or tags of a row, leaving whichever is None as it is
+        :param iid: item id of the row
+        :param values: new tuple of values
+        :param tags: new tuple of tags
+        :return: none
+        """
+        if values is not None:
+            self.patient_tree.item(iid, values=values)
+        if tags is not None:
+            self.patient_tree.item(iid, tags=tags)
+
+    def selected_id(self):
+        """
+        :return: item id of the selected row, or None if no row is selected
+        """
+        selection = self.patient_tree.selection()
+        return selection[0] if len(selection) > 0 else None
+
+    def show_rows(self, iids):
+        """
+        Show only the given rows, in the given order. Hidden rows are detached rather than deleted, so they keep their
+        values and can be shown again.
+        :param iids: item ids of the rows to show, rows not in the view are skipped
+        :return: none
+        """
+        shown = [iid for iid in iids if self.patient_tree.exists(iid)]
+        current = self.patient_tree.get_children()
+        # the rows already in place at the top are left alone, and every row after them is detached, then the rows to
+        # show are put back once each in order, so reordering costs one pass however far the rows move
+        unchanged = 0
+        while unchanged < min(len(current), len(shown)) and current[unchanged] == shown[unchanged]:
+            unchanged += 1
+        if unchanged < len(current):
+            self.patient_tree.detach(*current[unchanged:])
+        for iid in shown[unchanged:]:
+            self.patient_tree.move(iid, "", "end")
+
+    def scroll_to_top(self):
+        self.patient_tree.yview_moveto(0)
+
+
+class VirtualTreeView(TreeView):
+    """
+    TreeView that holds its rows in python rather than as tkinter items, and only materialises the rows in view, plus
+    a few rows of overscan either side, as real items. The scrollbar and mouse wheel move a window over the rows, so
+    inserting, updating and scrolling cost the same however many patients there are. Used as the first base class of
+    a concrete list, eg VirtualTreeView and PatientList, so that the concrete list still lays out its columns.
+    """
+    ROW_HEIGHT = 20
+    HEADING_HEIGHT = 25
+
+    def __init__(self, entry_frame, overscan=5):
+        """
+        :param entry_frame: the frame on which to place the TreeView
+        :param overscan: rows materialised above and below the visible ones
+        """
+        super().__init__(entry_frame)
+        self.overscan = overscan
+        self.order = []
+        # position of each row in order, and the rows deleted but not yet taken out of it, so that deleting a row
+        # does not scan or shift the order every time
+        self.positions = {}
+        self.deleted = set()
+        self.rows = {}
+        self.first = 0
+        self.visible_rows = 10
+        self.rendered = []
+        self.selected = None
+        self.render_pending = False
+
+        self.vertical_scroll_bar.configure(command=self.on_scroll)
+        self.patient_tree.configure(yscrollcommand="")
+        self.patient_tree.bind("<<TreeviewSelect>>", self.on_select, add="+")
+        self.patient_tree.bind("<Configure>", self.on_configure, add="+")
+        self.patient_tree.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.patient_tree.bind("<Button-4>", lambda event: self.scroll_rows(-3))
+        self.patient_tree.bind("<Button-5>", lambda event: self.scroll_rows(3))
+        self.patient_tree.bind("<Up>", lambda event: self.move_selection(-1))
+        self.patient_tree.bind("<Down>", lambda event: self.move_selection(1))
+
+    def insert_row(self, iid, text, values, tags=()):
+        if iid in self.deleted:
+            self.compact()
+        self.rows[iid] = [text, tuple(values), tuple(tags)]
+        self.positions[iid] = len(self.order)
+        self.order.append(iid)
+        self.request_render()
+
+    def delete_row(self, iid):
+        del self.rows[iid]
+        if iid in self.positions:
+            self.deleted.add(iid)
+        if self.selected == iid:
+            self.selected = None
+        self.request_render()
+
+    def compact(self):
+        # take the rows deleted since the last compaction out of the order in one pass, however many there were
+        if not self.deleted:
+            return
+        self.order = [iid for iid in self.order if iid not in self.deleted]
+        self.positions = {iid: index for index, iid in enumerate(self.order)}
+        self.deleted.clear()
+
+    def has_row(self, iid):
+        return iid in self.rows
+
+    def row_ids(self):
+        self.compact()
+        return tuple(self.order)
+
+    def row_text(self, iid):
+        return self.rows[iid][0]
+
+    def row_values(self, iid):
+        return self.rows[iid][1]
+
+    def set_row(self, iid, values=None, tags=None):
+        if values is not None:
+            self.rows[iid][1] = tuple(values)
+        if tags is not None:
+            self.rows[iid][2] = tuple(tags)
+        if self.patient_tree.exists(iid):
+            # only rows in view need touching in tkinter, the rest pick the change up when scrolled to
+            self.patient_tree.item(iid, values=self.rows[iid][1], tags=self.rows[iid][2])
+
+    def selected_id(self):
+        return self.selected if self.selected in self.rows else None
+
+    def show_rows(self, iids):
+        self.order = [iid for iid in iids if iid in self.rows]
+        self.positions = {iid: index for index, iid in enumerate(self.order)}
+        self.deleted.clear()
+        if self.selected is not None and self.selected not in self.positions:
+            self.selected = None
+        # keep the scroll position, only pulling it back if the list is now shorter than the window
+        self.first = min(self.first, max(len(self.order) - self.visible_rows, 0))
+        self.request_render()
+
+    def scroll_to_top(self):
+        self.first = 0
+        self.request_render()
+
+    def on_select(self, event):
+        # rows leaving the window deselect their items by being deleted, so the selection is only forgotten when the
+        # selected row is still in view, ie the user deselected it
+        selection = self.patient_tree.selection()
+        if len(selection) > 0:
+            self.selected = selection[0]
+        elif self.selected is not None and self.patient_tree.exists(self.selected):
+            self.selected = None
+
+    def on_configure(self, event):
+        self.visible_rows = max(1, (event.height - self.HEADING_HEIGHT) // self.ROW_HEIGHT)
+        self.request_render()
+
+    def on_mouse_wheel(self, event):
+        return self.scroll_rows(-3 if event.delta > 0 else 3)
+
+    def on_scroll(self, *args):
+        """
+        Scrollbar command, moving the window over the rows
+        :param args: ("moveto", fraction) or ("scroll", number, "units" or "pages")
+        :return: none
+        """
+        self.compact()
+        if args[0] == "moveto":
+            self.set_first(int(round(float(args[1]) * len(self.order))))
+        elif args[0] == "scroll":
+            step = int(args[1]) * (self.visible_rows if args[2] == "pages" else 1)
+            self.set_first(self.first + step)
+
+    def scroll_rows(self, step):
+        self.set_first(self.first + step)
+        return "break"
+
+    def move_selection(self, step):
+        # keyboard navigation walks the rows rather than the materialised items, scrolling the window with it
+        self.compact()
+        if not self.order:
+            return "break"
+        index = self.positions[self.selected] + step if self.selected in self.positions else 0
+        index = min(max(index, 0), len(self.order) - 1)
+        self.selected = self.order[index]
+        if index < self.first:
+            self.first = index
+        elif index >= self.first + self.visible_rows:
+            self.first = index - self.visible_rows + 1
+        self.render()
+        self.patient_tree.event_generate("<<TreeviewSelect>>")
+        return "break"
+
+    def set_first(self, first):
+        self.compact()
+        first = min(max(first, 0), max(len(self.order) - self.visible_rows, 0))
+        if first != self.first:
+            self.first = first
+            self.render()
+
+    def request_render(self):
+        # coalesce the changes made in one event into a single render
+        if not self.render_pending:
+            self.render_pending = True
+            self.patient_tree.after_idle(self.render)
+
+    def render(self):
+        """
+        Materialise the rows in the window as tkinter items, deleting the items that have left it
+        :return: none
+        """
+        self.render_pending = False
+        self.compact()
+        self.first = min(max(self.first, 0), max(len(self.order) - self.visible_rows, 0))
+        start = max(self.first - self.overscan, 0)
+        window = self.order[start:self.first + self.visible_rows + self.overscan]
+        in_window = set(window)
+        stale = [iid for iid in self.rendered if iid not in in_window and self.patient_tree.exists(iid)]
+        if stale:
+            self.patient_tree.delete(*stale)
+        for index, iid in enumerate(window):
+            text, values, tags = self.rows[iid]
+            if self.patient_tree.exists(iid):
+                self.patient_tree.item(iid, text=text, values=values, tags=tags)
+                self.patient_tree.move(iid, "", index)
+            else:
+                self.patient_tree.insert("", index, iid=iid, text=text, values=values, tags=tags)
+        self.rendered = window
+        # the overscan rows above the window are scrolled out of view
+        self.patient_tree.yview_moveto(0)
+        self.patient_tree.yview_scroll(self.first - start, "units")
+        if self.selected in in_window and self.selected not in self.patient_tree.selection():
+            self.patient_tree.selection_set(self.selected)
+
+        total = len(self.order)
+        if total == 0:
+            self.vertical_scroll_bar.set(0, 1)
+        else:
+            self.vertical_scroll_bar.set(self.first / total, min(self.first + self.visible_rows, total) / total)
 
 
 class MonitoredList(TreeView):
@@ -785,6 +3534,8 @@ class MonitoredList(TreeView):
         self.patient_tree.heading("#5", text="Time", anchor="w")
         self.patient_tree.column("#5", minwidth=10, width=75)
         self.patient_tree.place(relheight=0.6, relwidth=0.8, relx=0.20, rely=0.48)
+        # patient id to (cholesterol monitored, blood pressure monitored)
+        self.monitored_vitals = {}
 
 
 class PatientList(TreeView):
@@ -803,6 +3554,18 @@ class PatientList(TreeView):
         self.patient_tree.place(relheight=0.6, relwidth=0.25, relx=0, rely=0.48)
 
 
+class VirtualMonitoredList(VirtualTreeView, MonitoredList):
+    """
+    MonitoredList that only materialises the rows in view.
+    """
+
+
+class VirtualPatientList(VirtualTreeView, PatientList):
+    """
+    PatientList that only materialises the rows in view.
+    """
+
+
 class Patient(Observer):
     """
     Implementation of the Observer class. Represents a single patient for a particular practitioner. This class then
@@ -836,6 +3599,9 @@ class Patient(Observer):
         self._id = id
         self._gender = gender
         self._birth_date = birth_date
+        # fingerprints of the last report and blood pressure searches merged into the patient, see
+        # Server.fetch_changes
+        self._fingerprints = {}
 
     def set_systolic(self, systolic_val):
         self._systolic = systolic_val
@@ -856,6 +3622,21 @@ class Patient(Observer):
         """
         return self._last_update
 
+    def get_readings(self):
+        """
+        Return the values that can change when the patient is updated, used to tell whether an update changed anything
+        :return: tuple of total cholesterol, its date, systolic, diastolic and the blood pressure date
+        """
+        return self._total_chol, self._last_update, self._systolic, self._diastolic, self._blood_pressure_time
+
+    def set_readings(self, readings):
+        """
+        Set the values returned by get_readings, used to apply readings polled in another process
+        :param readings: tuple of total cholesterol, its date, systolic, diastolic and the blood pressure date
+        :return: none
+        """
+        self._total_chol, self._last_update, self._systolic, self._diastolic, self._blood_pressure_time = readings
+
     def update(self):
         """
         Implements the method defined in the abstract Observer class. Contacts the server to check whether this patient
@@ -871,10 +3652,656 @@ class Patient(Observer):
 
 
 
+class ServerUnavailableError(Exception):
+    """
+    Raised when a request to the FHIR server fails, or is refused because the circuit breaker is open.
+    """
+    def __init__(self, message, retry_after=None):
+        """
+        :param message: description of why the server is unavailable
+        :param retry_after: seconds until the server should be contacted again, if known
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ServerResponseError(ServerUnavailableError):
+    """
+    Raised when the server answers a request with an error status that is not a sign of it failing, such as a 404 for
+    a resource that does not exist. The circuit breaker is not tripped by it.
+    """
+    def __init__(self, message, status_code):
+        """
+        :param message: description of the request that was refused
+        :param status_code: the http status the server responded with
+        """
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all traffic to the server. Tokens refill at a steady rate up to the bucket capacity, and
+    every request takes one, waiting for the next token if the bucket is empty.
+    """
+    def __init__(self, rate, capacity):
+        """
+        :param rate: tokens added per second, ie the sustained number of requests per second
+        :param capacity: most tokens the bucket can hold, ie the largest burst of requests allowed
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = monotonic()
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token from the bucket, sleeping until one is available
+        :return: seconds spent waiting for the token
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    if waited:
+                        self.throttled += 1
+                        self.total_wait += waited
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+            waited += wait
+
+
+class CircuitBreaker:
+    """
+    Stops requests being sent to the server while it is failing. After enough consecutive failures, or a response
+    asking the client to back off, the breaker opens and refuses requests until the reset timeout, or the servers
+    Retry-After, has passed. A single trial request is then let through, closing the breaker again if it succeeds.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        """
+        :param failure_threshold: number of consecutive failures that opens the breaker
+        :param reset_timeout: seconds the breaker stays open before a trial request is allowed
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        self.trips = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        Interpret a Retry-After header, given either as a number of seconds or as a HTTP date
+        :param value: header string, or None
+        :return: seconds to wait, or None if the header is missing or unreadable
+        """
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (email_utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def allow(self):
+        """
+        Check whether a request may be sent now
+        :return: boolean
+        """
+        with self.lock:
+            if self.state == self.OPEN and monotonic() >= self.open_until:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self.trial_in_flight):
+                self.trial_in_flight = self.state == self.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_in(self):
+        """
+        :return: seconds until the breaker lets a trial request through, 0 if requests are allowed now
+        """
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.open_until - monotonic())
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self, retry_after=None):
+        """
+        Count a failed request, opening the breaker if the threshold has been reached, the trial request failed, or
+        the server asked to be left alone for a while
+        :param retry_after: seconds the server asked the client to wait, if it sent a Retry-After header
+        :return: none
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold or retry_after is not None:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.open_until = monotonic() + max(self.reset_timeout, retry_after or 0.0)
+                self.trial_in_flight = False
+
+
+class SubscriptionHandler:
+    """
+    Handles the notifications a FHIR server sends to a SubscriptionReceiver. The patient is taken from the path,
+    /patient/<id>, as rest-hook notifications without a payload have an empty body. Servers that send the resource
+    that triggered the notification as the payload PUT it to the endpoint followed by /<type>/<id>, so
+    /patient/<id>/<type>/<resource id> is accepted too. Mixed into http.server.BaseHTTPRequestHandler by
+    SubscriptionReceiver.handler_class, so that http.server is only imported once push mode is turned on.
+    """
+    def do_POST(self):
+        # drain the body, if the server sent the resource that triggered the notification, so the connection can be
+        # reused
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) not in (2, 4) or parts[0] != "patient" or not all(parts):
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.server.notifications.put(parts[1])
+        self.send_response(200)
+        self.end_headers()
+
+    # the patient is all a notification is used for, so a payload sent with a PUT is handled the same
+    do_PUT = do_POST
+
+    def log_message(self, format, *args):
+        # every notification would otherwise be logged to stderr
+        pass
+
+
+class SubscriptionReceiver:
+    """
+    Small embedded http server that receives the rest-hook notifications of FHIR Subscriptions. Each patient is given
+    its own endpoint, and the id of each patient notified is put on the notifications queue for the controller to
+    update.
+    """
+    handler = None
+
+    def __init__(self, host="127.0.0.1", port=0, public_url=None):
+        """
+        :param host: interface to listen on
+        :param port: port to listen on, 0 picks a free port
+        :param public_url: url the FHIR server reaches this receiver on, if it is not the address listened on, eg
+                           behind a tunnel or a reverse proxy
+        """
+        self.host = host
+        self.port = port
+        self.public_url = public_url
+        self.notifications = queue.Queue()
+        self.http_server = None
+        self.thread = None
+
+    @staticmethod
+    def handler_class():
+        """
+        :return: the request handler class, built on the first call
+        """
+        if SubscriptionReceiver.handler is None:
+            SubscriptionReceiver.handler = type("SubscriptionRequestHandler",
+                                                (SubscriptionHandler, http_server.BaseHTTPRequestHandler), {})
+        return SubscriptionReceiver.handler
+
+    def start(self):
+        """
+        Start listening on a background thread, does nothing if already listening
+        :return: none
+        """
+        if self.http_server is not None:
+            return
+        self.http_server = http_server.ThreadingHTTPServer((self.host, self.port), self.handler_class())
+        self.http_server.daemon_threads = True
+        self.http_server.notifications = self.notifications
+        self.port = self.http_server.server_address[1]
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.http_server is None:
+            return
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        self.http_server = None
+        self.thread = None
+
+    def url_for(self, patient_id):
+        """
+        :param patient_id: patient id string
+        :return: the endpoint url to give the Subscriptions of the patient
+        """
+        base_url = self.public_url or "http://" + self.host + ":" + str(self.port)
+        return base_url.rstrip("/") + "/patient/" + patient_id
+
+
+class BundleStream:
+    """
+    Iterates over the entries of a searchset bundle incrementally, as its body is read chunk by chunk. The top level of
+    the bundle is walked by hand, and each element of its entry array is decoded on its own and passed straight to an
+    extract function, so only one entry is ever held as nested dictionaries rather than the whole page. The other top
+    level fields, such as the paging links, are kept once the stream has been read past them.
+    """
+    WHITESPACE = " \t\n\r"
+
+    def __init__(self, chunks, extract, close=None):
+        """
+        :param chunks: iterable of bytes making up the response body
+        :param extract: function reducing an entry dictionary to the fields needed, entries it returns None for are
+                        skipped
+        :param close: optional function called once the body has been read, to release the connection
+        """
+        self.chunks = iter(chunks)
+        self.extract = extract
+        self.close = close
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        # where the value last decoded started in the buffer
+        self.start = 0
+        self.eof = False
+        self.links = []
+        self.fields = {}
+
+    def next_url(self):
+        """
+        :return: url of the next page of the search, or None if this is the last page
+        """
+        for link in self.links:
+            if link.get("relation") == "next":
+                return link.get("url")
+        return None
+
+    def fill(self):
+        # read the next chunk of the body onto the buffer, dropping the part already consumed
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            self.buffer = self.buffer[self.position:] + self.text_decoder.decode(b"", final=True)
+        else:
+            self.buffer = self.buffer[self.position:] + self.text_decoder.decode(chunk)
+        self.position = 0
+        return True
+
+    def peek(self):
+        # the next character that is not whitespace, reading more of the body as needed
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in self.WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                raise ValueError("bundle ended unexpectedly")
+
+    def expect(self, characters):
+        character = self.peek()
+        if character not in characters:
+            raise ValueError("expected one of " + repr(characters) + " in bundle, found " + repr(character))
+        self.position += 1
+        return character
+
+    def decode(self):
+        # decode the json value starting at the current position, reading more of the body until it is complete
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            if end == len(self.buffer) and self.fill():
+                # a number or literal cut off at the end of a chunk decodes without error, so only trust a value
+                # once something follows it
+                continue
+            self.start = self.position
+            self.position = end
+            return value
+
+    def raw_value(self):
+        """
+        :return: the text of the value last decoded, eg of the entry being extracted, as it was in the body
+        """
+        return self.buffer[self.start:self.position]
+
+    def __iter__(self):
+        try:
+            self.expect("{")
+            if self.peek() == "}":
+                return
+            while True:
+                key = self.decode()
+                self.expect(":")
+                if key == "entry":
+                    yield from self.iter_entries()
+                elif key == "link":
+                    self.links = self.decode()
+                else:
+                    self.fields[key] = self.decode()
+                if self.expect(",}") == "}":
+                    return
+        finally:
+            if self.close is not None:
+                self.close()
+
+    def iter_entries(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            entry = self.decode()
+            extracted = self.extract(entry)
+            if extracted is not None:
+                yield extracted
+            if self.expect(",]") == "]":
+                return
+
+
+class DemographicsLoader:
+    """
+    Loads the demographics facet of patients (birth date, gender and address) lazily. Patients are queued to be loaded
+    in the background at low priority once the patient list has been shown, and a patient that is selected before
+    the background loader has reached them is loaded immediately. Loaded demographics are cached by patient id.
+    """
+    BACKGROUND = 1
+
+    def __init__(self, server, background_delay=0.1, on_load=None):
+        """
+        :param server: Server object used to fetch the demographics
+        :param background_delay: seconds the background loader waits between requests, leaving the rate limiter free
+                                 for the requests the user is waiting on
+        :param on_load: called with each patient once its demographics have been applied, may be called from the
+                        background thread
+        """
+        self.server = server
+        self.background_delay = background_delay
+        self.on_load = on_load
+        self.cache = {}
+        self.queued = set()
+        self.queue = queue.PriorityQueue()
+        # breaks ties in the priority queue in the order patients were requested
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def apply(self, patient, demographics):
+        patient._birth_date = demographics["birth_date"]
+        patient._gender = demographics["gender"]
+        patient._city = demographics["city"]
+        patient._state = demographics["state"]
+        patient._country = demographics["country"]
+        if self.on_load is not None:
+            self.on_load(patient)
+
+    def request(self, patients):
+        """
+        Queue patients to have their demographics loaded in the background
+        :param patients: iterable of Patient objects
+        :return: none
+        """
+        with self.lock:
+            for patient in patients:
+                if patient._id in self.cache or patient._id in self.queued:
+                    continue
+                self.queued.add(patient._id)
+                self.queue.put((self.BACKGROUND, next(self.counter), patient))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def load_now(self, patient):
+        """
+        Make sure the patients demographics are loaded, fetching them straight away if they are not cached yet
+        :param patient: Patient object
+        :return: none
+        :raises ServerUnavailableError: if the demographics are not cached and the server cannot be reached
+        """
+        demographics = self.cache.get(patient._id)
+        if demographics is None:
+            demographics = self.server.get_demographics(patient._id)
+            self.cache[patient._id] = demographics
+        self.apply(patient, demographics)
+
+    def run(self):
+        """
+        Background loop, loading queued patients one at a time for as long as the program runs
+        :return: none
+        """
+        while True:
+            priority, order, patient = self.queue.get()
+            if patient._id not in self.cache:
+                try:
+                    self.load_now(patient)
+                except ServerUnavailableError as error:
+                    # try the patient again once the circuit breaker lets requests through
+                    sleep(max(self.background_delay, error.retry_after or 0.0))
+                    self.queue.put((priority, order, patient))
+                    continue
+                except Exception as error:
+                    # a malformed response for one patient must not stop the loader for everyone after it
+                    print("could not load demographics for patient " + patient._id + ": " + repr(error))
+            with self.lock:
+                self.queued.discard(patient._id)
+            sleep(self.background_delay)
+
+
+# compact form of a single bundle entry. kind is "encounter" with values (name,), "report" with the references of the
+# total cholesterol observations as values, or "blood_pressure" with values (systolic, diastolic)
+Record = namedtuple("Record", ["patient_id", "kind", "values", "date"])
+
+
+class Normaliser:
+    """
+    Turns raw searchset bundles into compact Record tuples: walking the nested entries, stripping digits from names
+    and parsing dates. The work is pure python, so it can be moved off the threads sharing the interpreter with tkinter
+    by running it on a process pool, with only the records sent back to the main process to be merged. It can also run
+    inline on the calling thread, or on a thread pool.
+    """
+    INLINE = "inline"
+    THREAD = "thread"
+    PROCESS = "process"
+
+    def __init__(self, mode=INLINE, workers=None):
+        """
+        :param mode: Normaliser.INLINE, Normaliser.THREAD or Normaliser.PROCESS
+        :param workers: size of the thread or process pool, defaults to the executors own default
+        """
+        self.mode = None
+        self.workers = None
+        self.executor = None
+        self.lock = threading.Lock()
+        self.set_mode(mode, workers)
+
+    def set_mode(self, mode, workers=None):
+        """
+        Choose where bundles are normalised, shutting down the pool used before
+        :param mode: Normaliser.INLINE, Normaliser.THREAD or Normaliser.PROCESS
+        :param workers: size of the thread or process pool
+        :return: none
+        """
+        if mode not in (self.INLINE, self.THREAD, self.PROCESS):
+            raise ValueError("unknown normalisation mode " + str(mode))
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            self.mode = mode
+            self.workers = workers
+            self.executor = None
+
+    def get_executor(self):
+        # pools are only started once the first bundle needs them
+        with self.lock:
+            if self.executor is None:
+                if self.mode == self.PROCESS:
+                    # spawned workers do not inherit the Tk interpreter or the poll threads of the parent
+                    self.executor = futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                                mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self.executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    def submit(self, kind, body, known=None):
+        """
+        Normalise a bundle on the configured executor
+        :param kind: one of the kinds in Normaliser.EXTRACTORS
+        :param body: raw bytes of the bundle
+        :param known: optional set of entry fingerprints already processed, to only normalise the entries that are new
+                      or changed, see normalise_delta
+        :return: Future of a tuple of the list of Record tuples and the url of the next page, followed by the set of
+                 entry fingerprints in the bundle if known was given
+        """
+        if known is None:
+            function, args = Normaliser.normalise, (kind, body)
+        else:
+            function, args = Normaliser.normalise_delta, (kind, body, known)
+        if self.mode == self.INLINE:
+            future = futures.Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as error:
+                future.set_exception(error)
+            return future
+        return self.get_executor().submit(function, *args)
+
+    @staticmethod
+    def normalise(kind, body):
+        """
+        :param kind: one of the kinds in Normaliser.EXTRACTORS
+        :param body: raw bytes of the bundle
+        :return: tuple of the list of Record tuples and the url of the next page, or None
+        """
+        bundle = BundleStream([body], Normaliser.EXTRACTORS[kind])
+        return list(bundle), bundle.next_url()
+
+    @staticmethod
+    def normalise_delta(kind, chunks, known, close=None):
+        """
+        Normalise only the entries of a bundle that were not in it when it was last processed. Entries whose
+        fingerprint is known are skipped before their fields are extracted or their dates parsed.
+        :param kind: one of the kinds in Normaliser.EXTRACTORS
+        :param chunks: raw bytes of the bundle, or an iterable of the chunks of a streamed body
+        :param known: set of the entry fingerprints processed last time
+        :param close: optional function called once a streamed body has been read
+        :return: tuple of the list of Record tuples of the new or changed entries, the url of the next page, and the set
+                 of fingerprints of every entry in the bundle
+        """
+        extract = Normaliser.EXTRACTORS[kind]
+        fingerprints = set()
+
+        def extract_new(entry):
+            fingerprint = Normaliser.fingerprint(entry, bundle.raw_value())
+            fingerprints.add(fingerprint)
+            if fingerprint in known:
+                return None
+            return extract(entry)
+
+        if isinstance(chunks, bytes):
+            chunks = [chunks]
+        bundle = BundleStream(chunks, extract_new, close)
+        return list(bundle), bundle.next_url(), fingerprints
+
+    @staticmethod
+    def fingerprint(entry, text):
+        """
+        Identify a version of an entry: by the resource id and meta.versionId when the server gives them, or by a hash
+        of the text of the entry otherwise
+        :param entry: decoded bundle entry
+        :param text: the entry as it was in the body
+        :return: fingerprint string
+        """
+        resource = entry.get('resource', {})
+        version = resource.get('meta', {}).get('versionId')
+        if 'id' in resource and version is not None:
+            return resource.get('resourceType', '') + "/" + resource['id'] + "/_history/" + str(version)
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def issued_date(resource):
+        return datetime.fromisoformat(resource['issued'][:len('2008-10-14')]).date()
+
+    @staticmethod
+    def patient_id(resource):
+        return resource['subject']['reference'].split('/')[1]
+
+    @staticmethod
+    def extract_encounter(entry):
+        item = entry['resource']
+        if item['resourceType'] != 'Encounter':
+            # _include brings the practitioner and patient resources onto the same page
+            return None
+        # get rid of digits in their names
+        name = ''.join(i for i in item['subject']['display'] if not i.isdigit())
+        return Record(Normaliser.patient_id(item), "encounter", (name,), None)
+
+    @staticmethod
+    def extract_report(entry):
+        resource = entry['resource']
+        references = tuple(result['reference'] for result in resource.get('result', [])
+                           if result.get('display') == 'Total Cholesterol')
+        if not references:
+            return None
+        return Record(Normaliser.patient_id(resource), "report", references, Normaliser.issued_date(resource))
+
+    @staticmethod
+    def extract_blood_pressure(entry):
+        resource = entry['resource']
+        # the search api returns the diastolic component first
+        values = (resource['component'][1]['valueQuantity']['value'], resource['component'][0]['valueQuantity']['value'])
+        return Record(Normaliser.patient_id(resource), "blood_pressure", values, Normaliser.issued_date(resource))
+
+
+Normaliser.EXTRACTORS = {
+    "encounter": Normaliser.extract_encounter,
+    "report": Normaliser.extract_report,
+    "blood_pressure": Normaliser.extract_blood_pressure,
+}
+
+
 class Server(threading.Thread):
     """
-    Class responsible for the contacting of the Monash FHIR hosting service.
+    Class responsible for the contacting of the Monash FHIR hosting service. Every Server instance shares the same
+    rate limiter, circuit breaker and normaliser, so the limits and pools hold across all of the threads contacting
+    the server.
     """
+    root_url = 'https://fhir.monash.edu/hapi-fhir-jpaserver/fhir/'
+    # requests.Session whose connection pool every request goes through, None sends each request on its own
+    session = None
+    rate_limiter = RateLimiter(rate=10, capacity=20)
+    circuit_breaker = CircuitBreaker()
+    normaliser = Normaliser()
+
     def __init__(self, model):
         """
         Initialise by calling the initialisation method of the threading.Thread class, which allows this class to be
@@ -882,144 +4309,378 @@ class Server(threading.Thread):
         :param model: the model class responsible for the handling of business logic.
         """
         super().__init__()
-        self.root_url = 'https://fhir.monash.edu/hapi-fhir-jpaserver/fhir/'
         self.model = model
+        # number of practitioners crawled, and patients fetched, at the same time
+        self.max_workers = 8
+        # seconds to wait for the server to respond to a single request
+        self.timeout = 30
+        # bytes of a response body read at a time when streaming bundles
+        self.chunk_size = 64 * 1024
+
+    def get(self, url, headers=None, stream=False, accept=()):
+        """
+        Send a GET request through the shared rate limiter and circuit breaker.
+        :param url: url to request
+        :param headers: optional dictionary of extra request headers
+        :param stream: whether to leave the body unread, so that it can be iterated over in chunks
+        :param accept: statuses other than 2xx the caller handles itself, eg 304
+        :return: the requests.Response
+        :raises ServerUnavailableError: if the breaker is open, the request fails, or the server responds with a 429
+                                        or 5xx status
+        :raises ServerResponseError: if the server responds with any other status that is not 2xx or accepted
+        """
+        return self.send("GET", url, headers=headers, stream=stream, accept=accept)
+
+    def send(self, method, url, headers=None, stream=False, body=None, accept=()):
+        """
+        Send a request through the shared rate limiter and circuit breaker. The breaker is checked before a token is
+        taken, so requests refused while it is open do not use up the rate.
+        :param method: http method, eg "GET", "POST" or "DELETE"
+        :param url: url to request
+        :param headers: optional dictionary of extra request headers
+        :param stream: whether to leave the body unread, so that it can be iterated over in chunks
+        :param body: optional json body to send
+        :param accept: statuses other than 2xx the caller handles itself, eg 304
+        :return: the requests.Response
+        :raises ServerUnavailableError: if the breaker is open, the request fails, or the server responds with a 429
+                                        or 5xx status
+        :raises ServerResponseError: if the server responds with any other status that is not 2xx or accepted
+        """
+        if not self.circuit_breaker.allow():
+            raise ServerUnavailableError("circuit breaker is open", self.circuit_breaker.retry_in())
+        self.rate_limiter.acquire()
+        try:
+            response = (self.session or requests).request(method, url=url, headers=headers, stream=stream, json=body,
+                                        timeout=self.timeout)
+        except requests.RequestException as error:
+            self.circuit_breaker.record_failure()
+            raise ServerUnavailableError(str(error)) from error
+
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = CircuitBreaker.parse_retry_after(response.headers.get("Retry-After"))
+            if response.status_code == 429 and retry_after is None:
+                # too many requests always backs off, even without a Retry-After header
+                retry_after = self.circuit_breaker.reset_timeout
+            self.circuit_breaker.record_failure(retry_after)
+            response.close()
+            raise ServerUnavailableError("server responded with status " + str(response.status_code), retry_after)
+        # any other status means the server is up, but a 4xx, or a 3xx that was not followed, has no usable body
+        self.circuit_breaker.record_success()
+        if not 200 <= response.status_code < 300 and response.status_code not in accept:
+            response.close()
+            raise ServerResponseError(method + " " + url + " responded with status " + str(response.status_code),
+                                      response.status_code)
+        return response
+
+    def iter_body(self, response, lines=False):
+        """
+        Read the body of a streamed response. A connection that drops or times out part way through the body is
+        counted by the circuit breaker and raised as a ServerUnavailableError, as it would be before the response.
+        :param response: requests.Response sent with stream=True
+        :param lines: whether to iterate over the lines of the body rather than chunks of chunk_size bytes
+        :return: generator of the chunks, or lines, of the body
+        :raises ServerUnavailableError: if the body cannot be read to the end
+        """
+        try:
+            if lines:
+                yield from response.iter_lines()
+            else:
+                yield from response.iter_content(chunk_size=self.chunk_size)
+        except requests.RequestException as error:
+            self.circuit_breaker.record_failure()
+            response.close()
+            raise ServerUnavailableError("response body could not be read: " + str(error)) from error
+
+    def get_json(self, url):
+        """
+        Send a GET request through the shared rate limiter and circuit breaker, and decode the json response.
+        :param url: url to request
+        :return: the decoded json body
+        :raises ServerUnavailableError: if the breaker is open, the request fails, or the server responds with a 429
+                                        or 5xx status
+        :raises ServerResponseError: if the server responds with any other status that is not 2xx
+        """
+        return self.get(url).json()
+
+    def create_subscriptions(self, patient_id, endpoint):
+        """
+        Register rest-hook Subscriptions for new diagnostic reports and blood pressure observations of a patient. No
+        payload is asked for, so the server notifies the endpoint with an empty POST, and the endpoint itself
+        identifies the patient.
+        :param patient_id: patient id string
+        :param endpoint: url the server should notify, eg the url_for of a SubscriptionReceiver
+        :return: list of the ids of the Subscriptions created
+        :raises ServerUnavailableError: if the server cannot be reached, or ServerResponseError if it refuses a
+                                        Subscription
+        """
+        subscription_ids = []
+        for criteria in ("DiagnosticReport?patient=" + patient_id,
+                         "Observation?code=55284-4&patient=" + patient_id):
+            subscription = {"resourceType": "Subscription", "status": "requested",
+                            "reason": "FHIR Monitor push updates", "criteria": criteria,
+                            "channel": {"type": "rest-hook", "endpoint": endpoint}}
+            response = self.send("POST", self.root_url + "Subscription", body=subscription)
+            subscription_ids.append(response.json()["id"])
+        return subscription_ids
+
+    def delete_subscription(self, subscription_id):
+        """
+        Delete a Subscription made by create_subscriptions
+        :param subscription_id: id of the Subscription
+        :return: none
+        :raises ServerUnavailableError: if the server cannot be reached
+        """
+        self.send("DELETE", self.root_url + "Subscription/" + subscription_id).close()
+
+    def bulk_export(self, resource_types, type_filters=(), poll_interval=5.0):
+        """
+        Run a FHIR Bulk Data $export: kick the export off, poll its status until the server has written the files,
+        and return where they can be downloaded from.
+        :param resource_types: list of resource type names to export
+        :param type_filters: optional search queries, eg "Encounter?participant.identifier=...", limiting the resources
+                             of their type that are exported
+        :param poll_interval: seconds between status polls when the server does not send a Retry-After
+        :return: list of NDJSON file urls
+        :raises ServerUnavailableError: if the export cannot be started or fails
+        :raises ServerResponseError: if the server refuses the export, eg because it does not support the filters
+        """
+        headers = {"Accept": "application/fhir+json", "Prefer": "respond-async"}
+        url = self.root_url + "$export?_type=" + ",".join(resource_types)
+        for type_filter in type_filters:
+            url += "&_typeFilter=" + urllib.parse.quote(type_filter, safe="")
+        kick_off = self.get(url, headers=headers)
+        if kick_off.status_code != 202 or "Content-Location" not in kick_off.headers:
+            raise ServerUnavailableError("bulk export was not accepted, status " + str(kick_off.status_code))
+        status_url = kick_off.headers["Content-Location"]
+
+        while True:
+            status = self.get(status_url, headers={"Accept": "application/json"})
+            if status.status_code == 200:
+                return [output["url"] for output in status.json().get("output", [])]
+            if status.status_code != 202:
+                raise ServerUnavailableError("bulk export failed, status " + str(status.status_code))
+            print("bulk export in progress: " + status.headers.get("X-Progress", ""))
+            retry_after = CircuitBreaker.parse_retry_after(status.headers.get("Retry-After"))
+            sleep(poll_interval if retry_after is None else retry_after)
+
+    def iter_ndjson(self, url):
+        """
+        Stream the resources of a NDJSON file, one line at a time, without holding the file in memory
+        :param url: url of a NDJSON file from a bulk export
+        :return: generator of resource dictionaries
+        """
+        response = self.get(url, headers={"Accept": "application/fhir+ndjson"}, stream=True)
+        try:
+            for line in self.iter_body(response, lines=True):
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            response.close()
+
+    def get_demographics(self, patient_id):
+        """
+        Fetch the demographics facet of a patient, which is only needed once the patient is selected in the view.
+        :param patient_id: the patients id on the server
+        :return: dictionary with the birth_date, gender, city, state and country of the patient
+        """
+        patient_info = self.get_json(self.root_url + "Patient/" + patient_id)
+        address = patient_info.get("address") or [{}]
+        return {
+            "birth_date": patient_info.get("birthDate", '-'),
+            "gender": patient_info.get("gender", '-'),
+            "city": address[0].get("city", '-'),
+            "state": address[0].get("state", '-'),
+            "country": address[0].get("country", '-'),
+        }
+
+    @classmethod
+    def get_status(cls):
+        """
+        Summary of the shared rate limiter and circuit breaker, for display and metrics
+        :return: dictionary of the breaker state, its counters and the number of throttled requests
+        """
+        return {
+            "state": cls.circuit_breaker.state,
+            "failures": cls.circuit_breaker.failures,
+            "trips": cls.circuit_breaker.trips,
+            "rejected": cls.circuit_breaker.rejected,
+            "retry_in": cls.circuit_breaker.retry_in(),
+            "throttled": cls.rate_limiter.throttled,
+            "throttled_wait": cls.rate_limiter.total_wait,
+        }
+
+    def get_practitioners_patients(self, practitioner_ids, known_patients=()):
+        """
+        Crawl the encounters of several practitioners concurrently, then fetch every patient found exactly once, even
+        when they are shared between practitioners.
+        :param practitioner_ids: list of practitioner identifier strings
+        :param known_patients: patient ids that have already been fetched, and so should not be fetched again
+        :return: tuple of a dictionary mapping each practitioner id to the list of patient ids in their encounters,
+                 and a dictionary of newly fetched Patient objects that have a total cholesterol report
+        """
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            crawls = list(executor.map(self.get_practitioner_patients, practitioner_ids))
+
+            # deduplicate across practitioners before any patient is fetched
+            patient_names = {}
+            for crawl in crawls:
+                for patient_id in crawl:
+                    if patient_id not in known_patients and patient_id not in patient_names:
+                        patient_names[patient_id] = crawl[patient_id]
+
+            patient_ids = list(patient_names)
+            patients = executor.map(lambda patient_id: self.get_patient(patient_id, patient_names[patient_id]),
+                                    patient_ids)
+            patient_dict = {}
+            for patient_id, patient in zip(patient_ids, patients):
+                if patient is not None:
+                    patient_dict[patient_id] = patient
+
+        practitioner_patients = {}
+        for practitioner_id, crawl in zip(practitioner_ids, crawls):
+            practitioner_patients[practitioner_id] = list(crawl)
+        return practitioner_patients, patient_dict
+
+    def fetch_records(self, url, kind):
+        """
+        Request a searchset bundle and normalise its entries into typed records. Inline, the body is streamed through a
+        BundleStream as it arrives. Otherwise the raw body is handed to the shared normaliser so that the parsing runs
+        on a worker thread or process, and only the compact records come back.
+        :param url: url of the search
+        :param kind: one of the kinds in Normaliser.EXTRACTORS
+        :return: tuple of the list of Record tuples and the url of the next page, or None
+        """
+        if self.normaliser.mode == Normaliser.INLINE:
+            response = self.get(url, stream=True)
+            bundle = BundleStream(self.iter_body(response), Normaliser.EXTRACTORS[kind], response.close)
+            return list(bundle), bundle.next_url()
+        return self.normaliser.submit(kind, self.get(url).content).result()
 
-    def get_patients(self, practitioner_id):
+    def fetch_changes(self, url, kind, previous=None):
         """
-        Returns all patients for a particular practitioner identifier that have a total cholesterol value report
-        attached to their file on the server.
+        Request a searchset bundle and normalise only what changed since it was last fetched. The response is tagged
+        by its ETag, which is sent back as If-None-Match, or by a hash of the raw body when the server gives no ETag,
+        and a response with the same tag as last time is returned before any of it is parsed. Otherwise only the
+        entries that are new or have a new version are turned into records, inline or on the shared normaliser as in
+        fetch_records.
+        :param url: url of the search
+        :param kind: one of the kinds in Normaliser.EXTRACTORS
+        :param previous: the fingerprint returned when the search was last fetched, or None
+        :return: tuple of the list of Record tuples of new or changed entries, and the fingerprint of this response,
+                 to be passed back in once the records have been merged
+        """
+        previous_tag, known = previous if previous is not None else (None, frozenset())
+        # an ETag is kept as a string and a body hash as bytes, so one is never mistaken for the other
+        headers = {"If-None-Match": previous_tag} if isinstance(previous_tag, str) else None
+        response = self.get(url, headers=headers, stream=True, accept=(304,))
+        tag = response.headers.get("ETag")
+        if response.status_code == 304 or (tag is not None and tag == previous_tag):
+            response.close()
+            return [], previous
+        if tag is None:
+            # the body is hashed as it streams in, and only parsed once it is known to have changed
+            digest = hashlib.blake2b(digest_size=16)
+            chunks = []
+            for chunk in self.iter_body(response):
+                digest.update(chunk)
+                chunks.append(chunk)
+            response.close()
+            tag = digest.digest()
+            if tag == previous_tag:
+                return [], previous
+        else:
+            chunks = self.iter_body(response)
+        if self.normaliser.mode == Normaliser.INLINE:
+            records, next_url, fingerprints = Normaliser.normalise_delta(kind, chunks, known, response.close)
+        else:
+            records, next_url, fingerprints = self.normaliser.submit(kind, b"".join(chunks), known).result()
+            response.close()
+        return records, (tag, frozenset(fingerprints))
+
+    def get_practitioner_patients(self, practitioner_id):
+        """
+        Collect every patient that appears in an encounter with the practitioner, following the searchset pages.
         :param practitioner_id: Practitioner identifier string that conforms to the "http://hl7.org/fhir/sid/us-npi|"
-        :return: patient_dict: dictionary with Patient objects that represent patients in the system who have the
-                            practitioner as their recorded doctor, and have a report on their file that includes
-                            the total cholesterol.
+        :return: dictionary mapping patient id to the patients name, in the order they were first found
         """
         # get first page
         encounters_url = self.root_url + "Encounter?participant.identifier=http://hl7.org/fhir/sid/us-npi|" + \
                          practitioner_id + "&_include=Encounter.participant.individual&_include=Encounter.patient"
 
-        monitored_patients = []
-        patient_names = []
-        patient_dict = {}
-        next_page = True
+        patient_names = {}
         next_url = encounters_url
 
-        while next_page:
+        while next_url is not None:
             # Collect all encounters for the practitioner, all patient IDs and their names
-            next_page = False
             print(next_url)
-            all_encounters_practitioner = requests.get(url=next_url).json()
-            links = all_encounters_practitioner['link']
-            all_encounter_data = all_encounters_practitioner['entry']
-            for item in links:
-                if item["relation"] == "next":
-                    # check if the page has a next page accessible
-                    next_page = True
-                    next_url = item["url"]
-
-            for entry in all_encounter_data:
-                item = entry['resource']
-                patient = item['subject']['reference']
-                patient_name = item['subject']['display']
-                # get rid of digits in their names
-                patient_id = patient.split('/')[1]
+            # check if the page has a next page accessible
+            encounters, next_url = self.fetch_records(next_url, "encounter")
+            for record in encounters:
                 # Minimising the amount of requests sent to the server is the next stage by doing this check here.
-                if patient_id not in monitored_patients:
+                if record.patient_id not in patient_names:
                     # check whether the patient has already been found in an encounter. Dont care about getting the
                     # latest encounter, because the diagnostic report is the only date we care about.
-                    patient_names.append(''.join(i for i in patient_name if not i.isdigit()))
-                    monitored_patients.append(patient_id)
-
-        # Go through all patients found for all encounters, checking whether the diagnostic reports for those patients
-        for i in range(len(monitored_patients)):
-            patient_id = monitored_patients[i]
-            dReport_url = self.root_url + "DiagnosticReport/?patient=" + patient_id
-            dReports = requests.get(url=dReport_url).json()
-            # Extract data
-            try:
-                entry = dReports['entry']
-            except:
-                continue
-                # no entry
-
-            for en in entry:
-                results = en['resource']['result']
-
-                # Check whether this observation is on cholesterol or not.
-                for result in results:
-                    if result['display'] == 'Total Cholesterol':
-                        temp_patient_info_url = self.root_url + "Patient/" + patient_id
-                        temp_patient_info = requests.get(url=temp_patient_info_url).json()
-                        birth_date = temp_patient_info["birthDate"]
-                        city = temp_patient_info["address"][0]["city"]
-                        state = temp_patient_info["address"][0]["state"]
-                        country = temp_patient_info["address"][0]["country"]
-                        gender = temp_patient_info["gender"]
-                        name = patient_names[i]
-
-                        issued = en['resource']['issued'][:len('2008-10-14')]
-                        date = datetime.strptime(issued, '%Y-%m-%d').date()
-                        observation_ref = result['reference']
-                        observation_data = requests.get(url=self.root_url + observation_ref).json()
-                        value = observation_data['valueQuantity']['value']
-
-                        systolic = 0
-                        diastolic = 0
-                        blood_pressure_time = '-'
-
-                        patient_values = (name,(value, date, systolic, diastolic, blood_pressure_time, city, state, country, patient_id, gender, birth_date))
-                        temp_patient = self.model.return_patient(patient_values)
-
-                        # temp_patient = Patient(name, value, date, city, state, country, patient_id, gender, birth_date)
-                        if patient_id in patient_dict:
-                            # patient has been previously recorded with cholesterol data
-                            if patient_dict[patient_id].get_last_update() < temp_patient.get_last_update():
-                                # newer data available than in the dictionary, so put in there
-                                patient_dict[patient_id] = temp_patient
-                        else:
-                            # no patient has been recorded with cholesterol data yet
-                            patient_dict[patient_id] = temp_patient
-
-                        patient_array = []
-                        patient_array.append(patient_id)
-                        patient_array.append(value)
-                        patient_array.append(systolic)
-                        patient_array.append(diastolic)
-                        patient_array.append(date)
-                        # this prints the cholesterol data of the patients of a particular practitioner
-                        print(patient_array)
-
-            findBPUrl = self.root_url + "Observation?patient=" + patient_id + "&code=55284-4&_sort=date&_count=13"
-            patientBP = requests.get(url=findBPUrl).json()
-            try:
-                BPData = patientBP['entry']
-            except:
-                continue
-                # no entry
-            # here we get all cholesterol values recorded for the particular patient
-            for entry2 in BPData:
-                issued = entry2['resource']['issued'][:len('2008-10-14')]
-                date_issued = datetime.strptime(issued, '%Y-%m-%d').date()
-
-                diastolic_val = entry2['resource']['component'][0]['valueQuantity']['value']
-                systolic_val = entry2['resource']['component'][1]['valueQuantity']['value']
+                    patient_names[record.patient_id] = record.values[0]
 
-                if patient_dict[patient_id].get_blood_pressure_time() == '-':
-                    # newer data available than in the dictionary, so put in there
-                    patient_dict[patient_id].set_blood_pressure_time(date_issued)
-                    patient_dict[patient_id].set_systolic(systolic_val)
-                    patient_dict[patient_id].set_diastolic(diastolic_val)
+        return patient_names
 
-                elif patient_dict[patient_id].get_blood_pressure_time() < date_issued:
-                    patient_dict[patient_id].set_blood_pressure_time(date_issued)
-                    patient_dict[patient_id].set_systolic(systolic_val)
-                    patient_dict[patient_id].set_diastolic(diastolic_val)
+    def get_patient(self, patient_id, name):
+        """
+        Fetch the latest total cholesterol and blood pressure for a single patient found in an encounter.
+        :param patient_id: the patients id on the server
+        :param name: the patients name, as displayed in their encounter
+        :return: Patient object, or None if the patient has no report that includes the total cholesterol
+        """
+        patient = None
+        dReport_url = self.root_url + "DiagnosticReport/?patient=" + patient_id
+
+        reports, next_url = self.fetch_records(dReport_url, "report")
+        for record in reports:
+            date = record.date
+            # only reports with a total cholesterol observation are normalised into records
+            for observation_ref in record.values:
+                # demographics are loaded lazily by the DemographicsLoader, off the critical path
+                birth_date = city = state = country = gender = '-'
+
+                observation_data = self.get_json(self.root_url + observation_ref)
+                value = observation_data['valueQuantity']['value']
+
+                systolic = 0
+                diastolic = 0
+                blood_pressure_time = '-'
+
+                patient_values = (name, (value, date, systolic, diastolic, blood_pressure_time, city, state, country,
+                                         patient_id, gender, birth_date))
+                temp_patient = self.model.return_patient(patient_values)
+
+                if patient is None or patient.get_last_update() < temp_patient.get_last_update():
+                    # newer data available than previously recorded, so keep this one
+                    patient = temp_patient
+
+                # this prints the cholesterol data of the patients of a particular practitioner
+                print([patient_id, value, systolic, diastolic, date])
+
+        if patient is None:
+            # no report on file includes the total cholesterol
+            return None
+
+        findBPUrl = self.root_url + "Observation?patient=" + patient_id + "&code=55284-4&_sort=date&_count=13"
+        # here we get all blood pressure values recorded for the particular patient
+        blood_pressures, next_url = self.fetch_records(findBPUrl, "blood_pressure")
+        for record in blood_pressures:
+            date_issued = record.date
+            systolic_val, diastolic_val = record.values
+            if patient.get_blood_pressure_time() == '-' or patient.get_blood_pressure_time() < date_issued:
+                # newer data available than on the patient, so put in there
+                patient.set_blood_pressure_time(date_issued)
+                patient.set_systolic(systolic_val)
+                patient.set_diastolic(diastolic_val)
 
-        return patient_dict
+        return patient
 
-    async def update_patient(self, patient):
+    def update_patient(self, patient):
         """
-        Asynchronous calling of the server over a period of N seconds, defined and controlled in the Controller class.
+        Called from the update thread whenever the scheduler in the Controller class decides the patient is due.
         Looks at the patient specified in the system, and checks if any new diagnostic reports have been entered that
         have the total cholesterol field given.
         :param patient: Patient object for which to check if any new reports are available, and to change the data if
@@ -1027,59 +4688,75 @@ class Server(threading.Thread):
         :return: none
         """
         diag_url = self.root_url + "DiagnosticReport?patient=" + patient._id
-        diag_report = requests.get(url=diag_url).json()
-        # check if the patient id has any reports to their file
-        try:
-            entry = diag_report['entry']
-        except:
-            return
-
-        for en in entry:
-            results = en['resource']['result']
-            issued = en['resource']['issued'][:len('2008-10-14')]
-            report_issued = datetime.strptime(issued, '%Y-%m-%d').date()
 
+        # only the reports and blood pressures that are new since the last update are merged. The fingerprints are
+        # stored once they have been, so a failed update is merged again next time
+        reports, reports_fingerprint = self.fetch_changes(diag_url, "report", patient._fingerprints.get("report"))
+        for record in reports:
+            report_issued = record.date
             # Check whether this observation is on cholesterol or not, only contact server for the actual cholesterol
             # data if its available, and if the observation was issued after the issued cholesterol value on file
             # for the patient
             if report_issued > patient.get_last_update():
-                for result in results:
-                    if result['display'] == 'Total Cholesterol':
-                        temp_patient_info_url = self.root_url + "Patient/" + patient._id
-                        temp_patient_info = requests.get(url=temp_patient_info_url).json()
-                        # patient object passed to function, so change directly within this function.
-                        patient._birth_date = temp_patient_info["birthDate"]
-                        patient._city = temp_patient_info["address"][0]["city"]
-                        patient._state = temp_patient_info["address"][0]["state"]
-                        patient._country = temp_patient_info["address"][0]["country"]
-                        patient._gender = temp_patient_info["gender"]
-                        patient._name = patient._name
-
-                        observation_ref = result['reference']
-                        observation_data = requests.get(url=self.root_url + observation_ref).json()
-                        patient._total_chol = observation_data['valueQuantity']['value']
+                for observation_ref in record.values:
+                    # patient object passed to function, so change directly within this function.
+                    # demographics do not change with a new report, so are not fetched again here. The value is
+                    # fetched before anything is assigned, so a failed fetch leaves the report to be merged next time
+                    observation_data = self.get_json(self.root_url + observation_ref)
+                    value = observation_data['valueQuantity']['value']
+                    patient._total_chol = value
+                    patient._last_update = report_issued
 
         findBPUrl = self.root_url + "Observation?patient=" + patient._id + "&code=55284-4&_sort=date&_count=13"
-        patientBP = requests.get(url=findBPUrl).json()
-        try:
-            BPData = patientBP['entry']
-        except:
-            return
-            # no entry
-        # here we get all cholesterol values recorded for the particular patient
-        for entry2 in BPData:
-            issued = entry2['resource']['issued'][:len('2008-10-14')]
-            date_issued = datetime.strptime(issued, '%Y-%m-%d').date()
-
-            diastolic_val = entry2['resource']['component'][0]['valueQuantity']['value']
-            systolic_val = entry2['resource']['component'][1]['valueQuantity']['value']
-
-            if date_issued > patient.get_blood_pressure_time():
+        # here we get all blood pressure values recorded for the particular patient
+        blood_pressures, blood_pressures_fingerprint = self.fetch_changes(findBPUrl, "blood_pressure",
+                                                                          patient._fingerprints.get("blood_pressure"))
+        for record in blood_pressures:
+            date_issued = record.date
+            systolic_val, diastolic_val = record.values
+            if patient.get_blood_pressure_time() == '-' or date_issued > patient.get_blood_pressure_time():
                 patient._blood_pressure_time = date_issued
                 patient._systolic = systolic_val
                 patient._diastolic = diastolic_val
+        patient._fingerprints["report"] = reports_fingerprint
+        patient._fingerprints["blood_pressure"] = blood_pressures_fingerprint
 
 
 if __name__ == "__main__":
-    dashboard = Controller()
-    dashboard.run()
+    parser = argparse.ArgumentParser(description="FHIR Monitor")
+    parser.add_argument("--normalise", choices=[Normaliser.INLINE, Normaliser.THREAD, Normaliser.PROCESS],
+                        default=Normaliser.INLINE, help="where fetched bundles are parsed into records")
+    parser.add_argument("--benchmark-startup", action="store_true",
+                        help="print the import, first paint and interactive times, then exit")
+    parser.add_argument("--virtual-lists", action="store_true",
+                        help="only materialise the rows in view, for panels of many thousands of patients")
+    parser.add_argument("--fhir-url", default=Server.root_url, help="base url of the FHIR server")
+    parser.add_argument("--poll-shards", type=int, default=0,
+                        help="most worker processes to poll patients from, for very large sets of patients")
+    parser.add_argument("--chart-aggregate-above", type=int, default=200,
+                        help="number of monitored patients above which the graph shows their distributions")
+    parser.add_argument("--history-dir", default=None,
+                        help="folder of an archive to append every reading observed to, eg ~/.fhir_monitor/history, "
+                             "no archive is kept unless one is given")
+    parser.add_argument("--dispatch-width", type=int, default=4, help="number of patients updated at the same time")
+    parser.add_argument("--dispatch-timeout", type=float, default=60.0,
+                        help="seconds a patient may take to update before a tick stops waiting for it")
+    parser.add_argument("--push-port", type=int, default=0,
+                        help="port the push update receiver listens on, a free port if not given")
+    parser.add_argument("--push-url", default=None,
+                        help="url the FHIR server reaches the push update receiver on, if not the local address")
+    parser.add_argument("--keep-journal", action="store_true",
+                        help="keep every change journal event so consumers can replay it from the start, rather than "
+                             "the latest 10000")
+    arguments = parser.parse_args()
+    Server.root_url = arguments.fhir_url.rstrip("/") + "/"
+    dashboard = Controller(normalise_mode=arguments.normalise, virtual_lists=arguments.virtual_lists,
+                           receiver=SubscriptionReceiver(port=arguments.push_port, public_url=arguments.push_url),
+                           dispatch_width=arguments.dispatch_width, dispatch_timeout=arguments.dispatch_timeout,
+                           poll_shards=arguments.poll_shards, chart_aggregate_above=arguments.chart_aggregate_above,
+                           history_dir=arguments.history_dir,
+                           journal_retain=None if arguments.keep_journal else 10000)
+    if arguments.benchmark_startup:
+        dashboard.benchmark_startup()
+    else:
+        dashboard.run()
@@ -0,0 +1,30 @@
+import unittest
+from unittest import mock
+
+
+class FakeClock:
+    """
+    Stands in for time.monotonic and time.sleep, so that waiting costs nothing and is exact
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class ClockTest(unittest.TestCase):
+    """
+    Runs each test with the FakeClock in place of the clock FHIRapp reads
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        for name in ("monotonic", "sleep"):
+            patcher = mock.patch("FHIRapp." + name, getattr(self.clock, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
@@ -0,0 +1,135 @@
+import hashlib
+import json
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers the few FHIR interactions the monitor uses to follow a patient: creating and deleting Subscriptions,
+    searching the diagnostic reports and blood pressures of a patient, and reading the cholesterol observations.
+    """
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        if self.server.etags and self.command == "GET" and status == 200:
+            tag = '"' + hashlib.md5(data).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == tag:
+                status, data = 304, b""
+            self.send_response(status)
+            self.send_header("ETag", tag)
+        else:
+            self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.path.partition("?")[0] in self.server.truncated:
+            # the connection drops part way through the body
+            data = data[:len(data) // 2]
+            self.close_connection = True
+        self.wfile.write(data)
+
+    def do_POST(self):
+        subscription = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path != "/Subscription" or self.server.refuse:
+            self.reply(422, {"resourceType": "OperationOutcome"})
+            return
+        subscription["id"] = str(len(self.server.subscriptions) + 1)
+        self.server.subscriptions[subscription["id"]] = subscription
+        self.reply(201, subscription)
+
+    def do_DELETE(self):
+        self.server.subscriptions.pop(self.path.rsplit("/", 1)[-1], None)
+        self.reply(204)
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if self.server.failures.get(path, 0) > 0:
+            self.server.failures[path] -= 1
+            self.reply(503, {"resourceType": "OperationOutcome"})
+            return
+        patient_id = query.split("patient=")[-1].split("&")[0]
+        if path.startswith("/$export") or path.startswith("/export"):
+            self.export(path, query)
+        elif path == "/DiagnosticReport":
+            entries = [{"resource": {"resourceType": "DiagnosticReport", "id": report_id,
+                                     "issued": issued + "T00:00:00", "subject": {"reference": "Patient/" + patient_id},
+                                     "result": [{"display": "Total Cholesterol",
+                                                 "reference": "Observation/" + report_id}]}}
+                       for report_id, (issued, value) in self.server.reports.get(patient_id, {}).items()]
+            self.reply(200, {"resourceType": "Bundle", "link": [], "entry": entries})
+        elif path.startswith("/Observation/"):
+            report_id = path.rsplit("/", 1)[-1]
+            for reports in self.server.reports.values():
+                if report_id in reports:
+                    self.reply(200, {"resourceType": "Observation", "valueQuantity": {"value": reports[report_id][1]}})
+                    return
+            self.reply(404, {"resourceType": "OperationOutcome"})
+        elif path == "/Observation":
+            self.reply(200, {"resourceType": "Bundle", "link": [], "entry": []})
+        else:
+            self.reply(404, {"resourceType": "OperationOutcome"})
+
+    def export(self, path, query):
+        # a bulk export that completes straight away, writing one NDJSON file per resource type
+        if path == "/$export":
+            parameters = parse_qs(query)
+            self.server.exports.append(parameters)
+            if "_typeFilter" in parameters and self.server.refuse_type_filter:
+                self.reply(400, {"resourceType": "OperationOutcome"})
+                return
+            self.send_response(202)
+            self.send_header("Content-Location", self.server.url + "export-status")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif path == "/export-status":
+            self.reply(200, {"output": [{"type": resource_type, "url": self.server.url + "export/" + resource_type}
+                                        for resource_type in self.server.export_files]})
+        else:
+            resources = self.server.export_files[path.rsplit("/", 1)[-1]]
+            data = "".join(json.dumps(resource) + "\n" for resource in resources).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/fhir+ndjson")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInFHIRServer(ThreadingHTTPServer):
+    """
+    Local stand-in for a FHIR server with rest-hook Subscriptions, notifying the endpoint of every matching
+    Subscription when a report is added, as a real server does. GET requests to a path can be made to fail or be cut
+    off part way through their body, and successful ones can be tagged with an ETag and answered with a 304 when the
+    tag sent back still matches. A bulk export serves the resources in export_files, and can refuse _typeFilter.
+    """
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.daemon_threads = True
+        self.subscriptions = {}
+        self.reports = {}
+        self.refuse = False
+        # path to the number of GET requests to it still to fail with a 503
+        self.failures = {}
+        self.etags = False
+        # paths whose responses are cut off half way through the body
+        self.truncated = set()
+        # resource type to the resources its NDJSON file of a bulk export holds, and the query of every export
+        self.export_files = {}
+        self.exports = []
+        self.refuse_type_filter = False
+        self.url = "http://127.0.0.1:" + str(self.server_address[1]) + "/"
+
+    def add_report(self, patient_id, report_id, issued, value, payload=False):
+        self.reports.setdefault(patient_id, {})[report_id] = (issued, value)
+        for subscription in list(self.subscriptions.values()):
+            if subscription["criteria"] != "DiagnosticReport?patient=" + patient_id:
+                continue
+            endpoint = subscription["channel"]["endpoint"]
+            if payload:
+                requests.put(endpoint + "/DiagnosticReport/" + report_id, json={"resourceType": "DiagnosticReport"})
+            else:
+                requests.post(endpoint)
@@ -0,0 +1,88 @@
+import os
+import sys
+import unittest
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FHIRapp import AlertRule, Patient, RuleEngine
+
+
+def make_patient(patient_id, total_chol, last_update=date(2010, 1, 2)):
+    return Patient("Patient " + patient_id, total_chol, 120, 80, date(2010, 1, 2), last_update, '-', '-', '-',
+                   patient_id, '-', '-')
+
+
+class AlertRuleParseTest(unittest.TestCase):
+    def test_fixed_threshold(self):
+        rule = AlertRule.parse("high", "systolic > 140")
+        self.assertEqual((rule.vital, rule.operator, rule.get_threshold(), rule.consecutive),
+                         ("systolic", ">", 140.0, 1))
+        self.assertFalse(rule.is_dynamic())
+
+    def test_dynamic_thresholds(self):
+        self.assertEqual(AlertRule.parse("mean", "total_chol >= mean").get_threshold(), "mean")
+        rule = AlertRule.parse("p90", "total_chol > p90 for 3")
+        self.assertEqual((rule.get_threshold(), rule.consecutive), ("p90", 3))
+        self.assertTrue(rule.is_dynamic())
+
+    def test_for_readings(self):
+        self.assertEqual(AlertRule.parse("low", "diastolic < 60 for 3 readings").consecutive, 3)
+
+    def test_malformed_rules_are_rejected(self):
+        for text in ("systolic > 140 for", "systolic > 140 for x", "systolic > 140 3", "systolic > 140 for 3 times",
+                     "systolic > 140 for 3 readings more", "systolic >", "pulse > 100", "systolic => 140",
+                     "total_chol > p120"):
+            with self.assertRaises(ValueError, msg=text):
+                AlertRule.parse("rule", text)
+
+
+class RuleEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = RuleEngine()
+
+    def evaluate(self, patients):
+        return sorted(self.engine.evaluate({patient._id: patient for patient in patients}))
+
+    def test_fixed_threshold_raises_and_clears(self):
+        self.engine.set_rule(AlertRule.parse("high", "total_chol > 200"))
+        patients = [make_patient("p1", 250.0), make_patient("p2", 150.0)]
+        self.assertEqual(self.evaluate(patients), [("raised", "high", "p1")])
+        # only transitions are reported
+        self.assertEqual(self.evaluate(patients), [])
+        patients[0]._total_chol = 180.0
+        self.assertEqual(self.evaluate(patients), [("cleared", "high", "p1")])
+
+    def test_mean_threshold(self):
+        self.engine.set_rule(AlertRule.parse("above mean", "total_chol > mean"))
+        patients = [make_patient("p1", 100.0), make_patient("p2", 200.0), make_patient("p3", 300.0)]
+        self.assertEqual(self.evaluate(patients), [("raised", "above mean", "p3")])
+
+    def test_percentile_threshold(self):
+        self.engine.set_rule(AlertRule.parse("top half", "total_chol > p50"))
+        patients = [make_patient("p" + str(index), 100.0 * index) for index in range(1, 6)]
+        self.assertEqual(self.evaluate(patients), [("raised", "top half", "p4"), ("raised", "top half", "p5")])
+
+    def test_missing_values_are_not_counted(self):
+        self.engine.set_rule(AlertRule.parse("above mean", "total_chol > mean"))
+        patients = [make_patient("p1", 100.0), make_patient("p2", 300.0), make_patient("p3", '-')]
+        self.assertEqual(self.evaluate(patients), [("raised", "above mean", "p2")])
+
+    def test_consecutive_readings(self):
+        self.engine.set_rule(AlertRule.parse("sustained", "total_chol > 200 for 2 readings"))
+        patient = make_patient("p1", 250.0, date(2010, 1, 2))
+        self.assertEqual(self.evaluate([patient]), [])
+        # the same reading seen again is not a second reading
+        self.assertEqual(self.evaluate([patient]), [])
+        patient._total_chol, patient._last_update = 260.0, date(2011, 1, 2)
+        self.assertEqual(self.evaluate([patient]), [("raised", "sustained", "p1")])
+        patient._total_chol, patient._last_update = 150.0, date(2012, 1, 2)
+        self.assertEqual(self.evaluate([patient]), [("cleared", "sustained", "p1")])
+
+    def test_rule_deeper_than_history_is_refused(self):
+        with self.assertRaises(ValueError):
+            self.engine.set_rule(AlertRule.parse("long", "total_chol > 200 for 9"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from FHIRapp import BulkExportIngestor, CircuitBreaker, Model, RateLimiter, Server
+from stand_in import StandInFHIRServer
+
+
+def practitioner(resource_id, npi):
+    return {"resourceType": "Practitioner", "id": resource_id,
+            "identifier": [{"system": BulkExportIngestor.NPI_SYSTEM, "value": npi}]}
+
+
+def encounter(resource_id, patient_id, name, practitioner_id):
+    return {"resourceType": "Encounter", "id": resource_id,
+            "subject": {"reference": "Patient/" + patient_id, "display": name},
+            "participant": [{"individual": {"reference": "Practitioner/" + practitioner_id}}]}
+
+
+def report(resource_id, patient_id, observation_id):
+    return {"resourceType": "DiagnosticReport", "id": resource_id, "issued": "2012-05-05T00:00:00",
+            "subject": {"reference": "Patient/" + patient_id},
+            "result": [{"display": "Total Cholesterol", "reference": "Observation/" + observation_id}]}
+
+
+def cholesterol(resource_id, value):
+    return {"resourceType": "Observation", "id": resource_id, "valueQuantity": {"value": value},
+            "code": {"coding": [{"code": BulkExportIngestor.CHOLESTEROL_CODE}]}}
+
+
+class BulkExportTest(unittest.TestCase):
+    def setUp(self):
+        self.fhir = StandInFHIRServer()
+        threading.Thread(target=self.fhir.serve_forever, daemon=True).start()
+        self.fhir.export_files = {
+            "Practitioner": [practitioner("pr1", "111"), practitioner("pr2", "222")],
+            "Encounter": [encounter("e1", "p1", "Ann Lee", "pr1"), encounter("e2", "p2", "Bo Chan", "pr2")],
+            "DiagnosticReport": [report("r1", "p1", "o1"), report("r2", "p2", "o2")],
+            "Observation": [cholesterol("o1", 190.0), cholesterol("o2", 250.0)],
+        }
+        self.rate_limiter = Server.rate_limiter
+        self.circuit_breaker = Server.circuit_breaker
+        Server.rate_limiter = RateLimiter(rate=1000, capacity=1000)
+        Server.circuit_breaker = CircuitBreaker()
+        self.server = Server(Model())
+        self.server.root_url = self.fhir.url
+        self.ingestor = BulkExportIngestor(Model())
+
+    def tearDown(self):
+        Server.rate_limiter = self.rate_limiter
+        Server.circuit_breaker = self.circuit_breaker
+        self.fhir.shutdown()
+        self.fhir.server_close()
+
+    def test_export_is_scoped_to_the_practitioners(self):
+        self.ingestor.ingest_export(self.server, ["111"])
+        self.assertEqual(len(self.fhir.exports), 1)
+        type_filters = self.fhir.exports[0]["_typeFilter"]
+        self.assertEqual(type_filters, BulkExportIngestor.type_filters(["111"]))
+        self.assertIn("Encounter?participant.identifier=" + BulkExportIngestor.NPI_SYSTEM + "|111", type_filters)
+        practitioner_patients, patient_dict = self.ingestor.build(["111"])
+        self.assertEqual(practitioner_patients, {"111": ["p1"]})
+        self.assertEqual(patient_dict["p1"]._total_chol, 190.0)
+
+    def test_refused_filters_fall_back_to_the_whole_export(self):
+        self.fhir.refuse_type_filter = True
+        self.ingestor.ingest_export(self.server, ["111"])
+        self.assertEqual(["_typeFilter" in export for export in self.fhir.exports], [True, False])
+        practitioner_patients, patient_dict = self.ingestor.build(["111"])
+        self.assertEqual(list(patient_dict), ["p1"])
+
+    def test_export_without_practitioners_is_not_filtered(self):
+        self.ingestor.ingest_export(self.server)
+        self.assertNotIn("_typeFilter", self.fhir.exports[0])
+        self.assertEqual(self.fhir.exports[0]["_type"], [",".join(BulkExportIngestor.RESOURCE_TYPES)])
+        self.assertEqual(sorted(self.ingestor.build()[1]), ["p1", "p2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
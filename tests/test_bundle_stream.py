@@ -0,0 +1,49 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FHIRapp import BundleStream, Normaliser
+
+
+def report_bundle(count):
+    entries = [{"resource": {"resourceType": "DiagnosticReport", "id": "r" + str(index), "issued": "2012-05-05T00:00:00",
+                             "subject": {"reference": "Patient/p" + str(index)},
+                             "result": [{"display": "Total Cholesterol", "reference": "Observation/o" + str(index)}]}}
+               for index in range(count)]
+    return json.dumps({"resourceType": "Bundle", "meta": {"lastUpdated": "2012-05-05T00:00:00Z"},
+                       "entry": entries, "link": [{"relation": "next", "url": "http://example.org/page2"}],
+                       "total": count, "note": "café"}, ensure_ascii=False).encode()
+
+
+class BundleStreamTest(unittest.TestCase):
+    def test_split_chunks_parse_as_whole_body(self):
+        body = report_bundle(3)
+        whole = BundleStream([body], Normaliser.extract_report)
+        whole_records = list(whole)
+        # one byte at a time splits every token, number and the multi-byte character
+        split = BundleStream([body[index:index + 1] for index in range(len(body))], Normaliser.extract_report)
+        self.assertEqual(list(split), whole_records)
+        self.assertEqual([record.patient_id for record in whole_records], ["p0", "p1", "p2"])
+        self.assertEqual(split.next_url(), "http://example.org/page2")
+        self.assertEqual(split.fields["total"], 3)
+        self.assertEqual(split.fields["note"], "café")
+
+    def test_truncated_body_raises_and_closes(self):
+        body = report_bundle(3)
+        closed = []
+        bundle = BundleStream([body[:len(body) // 2]], Normaliser.extract_report, lambda: closed.append(True))
+        with self.assertRaises(ValueError):
+            list(bundle)
+        self.assertEqual(closed, [True])
+
+    def test_empty_entry_array(self):
+        bundle = BundleStream([b'{"resourceType": "Bundle", "entry": [], "link": []}'], Normaliser.extract_report)
+        self.assertEqual(list(bundle), [])
+        self.assertIsNone(bundle.next_url())
+
+
+if __name__ == "__main__":
+    unittest.main()
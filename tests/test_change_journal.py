@@ -0,0 +1,115 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FHIRapp import ChangeJournal, JournalConsumer
+
+
+class RecordingConsumer(JournalConsumer):
+    """
+    Consumer that records the sequence numbers it applies, and can be paused to fall behind the journal
+    """
+    def __init__(self):
+        super().__init__()
+        self.applied = []
+        self.paused = False
+
+    def catch_up(self, journal):
+        if not self.paused:
+            super().catch_up(journal)
+
+    def apply(self, events):
+        self.applied.extend(event.seq for event in events)
+
+
+class ChangeJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.journal = ChangeJournal(retain=3)
+
+    def append(self, count):
+        for _ in range(count):
+            self.journal.append(ChangeJournal.VITAL_UPDATED, "p1", "total_chol", 1, 2)
+
+    def test_applied_events_are_trimmed_to_the_retention(self):
+        consumer = RecordingConsumer()
+        self.journal.subscribe(consumer)
+        self.append(10)
+        self.journal.dispatch()
+        self.assertEqual(consumer.applied, list(range(10)))
+        self.assertEqual((self.journal.first_seq, len(self.journal)), (7, 10))
+        self.assertEqual([event.seq for event in self.journal.read(7)], [7, 8, 9])
+        with self.assertRaises(ValueError):
+            self.journal.read(6)
+
+    def test_without_retention_every_event_is_kept(self):
+        journal = ChangeJournal()
+        journal.subscribe(RecordingConsumer())
+        for _ in range(10):
+            journal.append(ChangeJournal.VITAL_UPDATED, "p1", "total_chol", 1, 2)
+        journal.dispatch()
+        self.assertEqual(len(journal.read(0)), 10)
+
+    def test_events_a_consumer_has_not_applied_are_kept(self):
+        current = RecordingConsumer()
+        lagging = RecordingConsumer()
+        self.journal.subscribe(current)
+        self.journal.subscribe(lagging)
+        self.append(2)
+        self.journal.dispatch()
+        lagging.paused = True
+        self.append(8)
+        self.journal.dispatch()
+        # the lagging consumer still needs every event from 2 on
+        self.assertEqual(self.journal.first_seq, 2)
+
+        lagging.paused = False
+        self.journal.dispatch()
+        self.assertEqual(lagging.applied, list(range(10)))
+        self.assertEqual(current.applied, list(range(10)))
+        self.assertEqual(self.journal.first_seq, 7)
+
+    def test_consumer_subscribed_after_trimming_catches_up_from_then(self):
+        self.journal.subscribe(RecordingConsumer())
+        self.append(10)
+        self.journal.dispatch()
+        late = RecordingConsumer()
+        self.journal.subscribe(late)
+        self.append(2)
+        self.journal.dispatch()
+        self.assertEqual(late.applied, [10, 11])
+
+    def test_consumer_can_replay_the_retained_events(self):
+        self.journal.subscribe(RecordingConsumer())
+        self.append(10)
+        self.journal.dispatch()
+        replay = RecordingConsumer()
+        self.journal.subscribe(replay, offset=self.journal.first_seq)
+        self.journal.dispatch()
+        self.assertEqual(replay.applied, [7, 8, 9])
+
+    def test_consumer_behind_the_trimmed_events_cannot_catch_up(self):
+        self.journal.subscribe(RecordingConsumer())
+        self.append(10)
+        self.journal.dispatch()
+        stale = RecordingConsumer()
+        self.journal.subscribe(stale, offset=0)
+        with self.assertRaises(ValueError):
+            self.journal.dispatch()
+        self.assertEqual((stale.offset, stale.applied), (0, []))
+
+    def test_patients_are_tracked_across_catch_ups(self):
+        consumer = RecordingConsumer()
+        self.journal.subscribe(consumer)
+        self.journal.append(ChangeJournal.PATIENT_ADDED, "p1", new="patient one")
+        self.journal.append(ChangeJournal.PATIENT_ADDED, "p2", new="patient two")
+        self.journal.dispatch()
+        self.journal.append(ChangeJournal.PATIENT_REMOVED, "p1")
+        self.append(5)
+        self.journal.dispatch()
+        self.assertEqual(consumer.patients, {"p2": "patient two"})
+
+
+if __name__ == "__main__":
+    unittest.main()
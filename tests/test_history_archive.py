@@ -0,0 +1,97 @@
+import os
+import sys
+import tempfile
+import unittest
+from datetime import date, datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FHIRapp import HistoryArchive, Patient
+
+
+class HistoryArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.archive = self.open()
+
+    def tearDown(self):
+        self.archive.close()
+
+    def open(self):
+        return HistoryArchive(self.directory.name, segment_rows=4)
+
+    def reopen(self):
+        self.archive.close()
+        self.archive = self.open()
+
+    def append_readings(self):
+        # ten readings over three segments of four rows, the first two sealed
+        for day in range(1, 11):
+            patient_id = "p" + str(day % 3)
+            self.archive.append(patient_id, HistoryArchive.CHOLESTEROL, date(2012, 1, day), 100.0 + day)
+        self.archive.append("p1", HistoryArchive.BLOOD_PRESSURE, datetime(2012, 1, 3, 12, 30), 130.0, 85.0)
+        self.archive.flush()
+
+    def test_append_fills_and_seals_segments(self):
+        self.append_readings()
+        segments = self.archive.manifest["segments"]
+        self.assertEqual([segment["rows"] for segment in segments], [4, 4, 3])
+        self.assertEqual([segment["sealed"] for segment in segments], [True, True, False])
+        self.assertEqual(segments[0]["start"], HistoryArchive.seconds(date(2012, 1, 1)))
+        self.assertEqual(segments[0]["end"], HistoryArchive.seconds(date(2012, 1, 4)))
+        # a sealed segment groups the rows of each patient together in time order
+        order = np.load(self.archive.segment_path(segments[0], "order"))
+        patients = self.archive.columns(segments[0])["patient"][order]
+        self.assertEqual(list(patients), sorted(patients))
+
+    def test_query_by_patient_time_and_kind(self):
+        self.append_readings()
+        result = self.archive.query(["p1"], kind=HistoryArchive.CHOLESTEROL)
+        self.assertEqual(sorted(result["value1"]), [101.0, 104.0, 107.0, 110.0])
+        self.assertTrue(all(patient_id == "p1" for patient_id in result["patient"]))
+
+        result = self.archive.query(start=date(2012, 1, 3), end=date(2012, 1, 5))
+        self.assertEqual(sorted(result["value1"]), [103.0, 104.0, 105.0, 130.0])
+
+        result = self.archive.query(["p1", "unknown"], kind=HistoryArchive.BLOOD_PRESSURE)
+        self.assertEqual((list(result["value1"]), list(result["value2"])), ([130.0], [85.0]))
+        self.assertEqual(result["time"][0], np.datetime64("2012-01-03T12:30:00"))
+
+        self.assertEqual(len(self.archive.query(["unknown"])["patient"]), 0)
+        self.assertEqual(len(self.archive.query(start=date(2013, 1, 1))["patient"]), 0)
+
+    def test_reopen_keeps_readings_and_appends_after_them(self):
+        self.append_readings()
+        self.reopen()
+        self.assertEqual(len(self.archive.query()["patient"]), 11)
+        self.archive.append("p3", HistoryArchive.CHOLESTEROL, date(2012, 2, 1), 200.0)
+        self.archive.flush()
+        self.reopen()
+        self.assertEqual([segment["rows"] for segment in self.archive.manifest["segments"]], [4, 4, 4])
+        self.assertEqual(list(self.archive.query(["p3"])["value1"]), [200.0])
+
+    def test_readings_are_only_recorded_once_across_reopening(self):
+        patient = Patient("Ann Lee", 190.0, 120, 80, date(2011, 5, 5), date(2010, 1, 2), '-', '-', '-', "p1", '-', '-')
+        self.archive.record(patient)
+        self.archive.record(patient)
+        self.archive.flush()
+        self.reopen()
+        self.assertEqual(self.archive.last_times["p1"], [HistoryArchive.seconds(date(2010, 1, 2)),
+                                                         HistoryArchive.seconds(date(2011, 5, 5))])
+        self.archive.record(patient)
+        patient._total_chol, patient._last_update = 250.0, date(2012, 5, 5)
+        self.archive.record(patient)
+        result = self.archive.query(["p1"], kind=HistoryArchive.CHOLESTEROL)
+        self.assertEqual(list(result["value1"]), [190.0, 250.0])
+        self.assertEqual(len(self.archive.query(["p1"], kind=HistoryArchive.BLOOD_PRESSURE)["patient"]), 1)
+
+    def test_close_twice(self):
+        self.archive.close()
+        self.archive.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
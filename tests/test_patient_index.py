@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FHIRapp import Patient, PatientIndex
+
+
+def make_patient(patient_id, name, last_update, total_chol=200.0):
+    return Patient(name, total_chol, 120.0, 80.0, last_update, last_update, "Boston", "MA", "US", patient_id, "female",
+                   "1970-01-01")
+
+
+class SortValueTest(unittest.TestCase):
+    def test_date_is_sortable(self):
+        self.assertEqual(PatientIndex.sort_value("last_update", date(2008, 10, 14)),
+                         (0, float(date(2008, 10, 14).toordinal())))
+
+    def test_dates_and_datetimes_share_one_scale(self):
+        keys = [PatientIndex.sort_value("last_update", value) for value in
+                (date(2008, 10, 14), datetime(2008, 10, 14, 12), "2008-10-15", date(2008, 10, 16))]
+        self.assertEqual(keys, sorted(keys))
+
+    def test_missing_dates_sort_last(self):
+        self.assertEqual(PatientIndex.sort_value("last_update", "-"), PatientIndex.MISSING)
+        self.assertEqual(PatientIndex.sort_value("last_update", None), PatientIndex.MISSING)
+
+
+class QueryTest(unittest.TestCase):
+    def test_sort_by_last_update(self):
+        index = PatientIndex()
+        index.update_many([make_patient("1", "Ann Lee", date(2010, 5, 1)),
+                           make_patient("2", "Bob Ray", date(2008, 1, 2)),
+                           make_patient("3", "Cy Moe", "-"),
+                           make_patient("4", "Di Fox", date(2012, 7, 3))])
+        self.assertEqual(index.query(sort_key="last_update"), ["2", "1", "4", "3"])
+        self.assertEqual(index.query(sort_key="last_update", descending=True), ["4", "1", "2", "3"])
+
+    def test_reindex_moves_patient(self):
+        index = PatientIndex()
+        patients = [make_patient("1", "Ann Lee", date(2010, 5, 1)), make_patient("2", "Bob Ray", date(2011, 1, 2))]
+        index.update_many(patients)
+        patients[0]._last_update = date(2012, 1, 1)
+        index.update(patients[0])
+        self.assertEqual(index.query(sort_key="last_update"), ["2", "1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
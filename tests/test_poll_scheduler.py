@@ -0,0 +1,83 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from FHIRapp import PollScheduler
+from fake_clock import ClockTest
+
+
+class PollSchedulerTest(ClockTest):
+    def setUp(self):
+        super().setUp()
+        self.scheduler = PollScheduler(floor=10.0, ceiling=80.0, backoff=2.0, jitter=False)
+
+    def poll(self, patient_id, changed, breached=False):
+        # move the clock to when the patient is due, take it and record the result
+        self.clock.now = self.scheduler.next_due()
+        self.assertEqual(self.scheduler.pop_due(), [patient_id])
+        return self.scheduler.record(patient_id, changed, breached)
+
+    def test_unchanged_patient_backs_off_to_the_ceiling(self):
+        self.scheduler.add("p1")
+        self.assertEqual([self.poll("p1", False) for _ in range(5)], [20.0, 40.0, 80.0, 80.0, 80.0])
+
+    def test_change_shrinks_the_interval_to_the_floor(self):
+        self.scheduler.add("p1")
+        for _ in range(3):
+            self.poll("p1", False)
+        self.assertEqual([self.poll("p1", True) for _ in range(4)], [40.0, 20.0, 10.0, 10.0])
+
+    def test_breach_resets_to_the_floor(self):
+        self.scheduler.add("p1")
+        for _ in range(3):
+            self.poll("p1", False)
+        self.assertEqual(self.poll("p1", False, breached=True), 10.0)
+
+    def test_due_patients_are_taken_in_order(self):
+        self.scheduler.add("p1")
+        self.clock.now += 5.0
+        self.scheduler.add("p2")
+        self.clock.now += 1.0
+        self.scheduler.add("p3")
+        self.assertEqual(self.scheduler.pop_due(), [])
+        self.clock.now += 10.0
+        self.assertEqual(self.scheduler.pop_due(), ["p1", "p2", "p3"])
+        # p2 comes back soonest, then p1 which backed off, while p3 is not rescheduled until it is recorded
+        self.scheduler.record("p1", False)
+        self.scheduler.record("p2", True)
+        self.assertEqual(self.scheduler.next_due(), self.clock.now + 10.0)
+        self.clock.now += 20.0
+        self.assertEqual(self.scheduler.pop_due(), ["p2", "p1"])
+        self.assertEqual(self.scheduler.next_due(), None)
+
+    def test_removed_patient_is_not_due(self):
+        self.scheduler.add("p1")
+        self.scheduler.add("p2")
+        self.scheduler.remove("p1")
+        self.clock.now += 10.0
+        self.assertEqual(self.scheduler.pop_due(), ["p2"])
+        self.assertIsNone(self.scheduler.record("p1", False))
+        self.assertNotIn("p1", self.scheduler)
+
+    def test_bounds_clamp_current_intervals(self):
+        self.scheduler.add("p1")
+        for _ in range(3):
+            self.poll("p1", False)
+        self.scheduler.set_bounds(5.0, 30.0)
+        self.assertEqual(self.poll("p1", False), 30.0)
+        self.assertEqual(self.poll("p1", True), 15.0)
+
+    def test_jitter_spreads_the_first_poll_over_the_floor(self):
+        scheduler = PollScheduler(floor=10.0, ceiling=80.0)
+        for index in range(50):
+            scheduler.add("p" + str(index))
+        due_times = [due_time - self.clock.now for due_time, patient_id in scheduler.queue]
+        self.assertTrue(all(0 <= offset <= 10.0 for offset in due_times))
+        self.assertGreater(len(set(due_times)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import threading
+import unittest
+from time import monotonic, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FHIRapp import Observer, Publisher
+
+
+class BlockingObserver(Observer):
+    """
+    Observer whose update waits until it is released, counting the updates started
+    """
+    def __init__(self):
+        self.release = threading.Event()
+        self.updates = 0
+
+    def update(self):
+        self.updates += 1
+        self.release.wait(5)
+
+
+class FailingObserver(Observer):
+    def update(self):
+        raise ValueError("no reading")
+
+
+class QuickObserver(Observer):
+    def __init__(self):
+        self.updates = 0
+
+    def update(self):
+        self.updates += 1
+
+
+class PublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.publisher = Publisher(width=2, timeout=0.1)
+        self.slow = BlockingObserver()
+        self.quick = QuickObserver()
+        self.publisher.attach(self.slow)
+        self.publisher.attach(self.quick)
+
+    def tearDown(self):
+        self.slow.release.set()
+        self.publisher.executor.shutdown(wait=True)
+
+    def test_timed_out_observer_is_skipped_until_it_finishes(self):
+        report = self.publisher.notify_observers()
+        self.assertEqual(list(report.timed_out), [self.slow])
+        self.assertIn(self.quick, report.latencies)
+
+        report = self.publisher.notify_observers()
+        self.assertEqual((report.skipped, report.timed_out), ([self.slow], {}))
+        self.assertEqual((self.slow.updates, self.quick.updates), (1, 2))
+
+        self.slow.release.set()
+        # the observer leaves in_flight from the done callback of its update
+        deadline = monotonic() + 5
+        while self.publisher.in_flight and monotonic() < deadline:
+            sleep(0.01)
+        report = self.publisher.notify_observers()
+        self.assertEqual(report.skipped, [])
+        self.assertEqual(self.slow.updates, 2)
+
+    def test_failures_are_reported(self):
+        failing = FailingObserver()
+        self.publisher.attach(failing)
+        self.slow.release.set()
+        report = self.publisher.notify_observers()
+        self.assertIsInstance(report.failures[failing], ValueError)
+        self.assertEqual(set(report.latencies), {self.slow, self.quick, failing})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from FHIRapp import CircuitBreaker, RateLimiter
+from fake_clock import ClockTest
+
+
+class CircuitBreakerTest(ClockTest):
+    def test_trips_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30.0)
+        breaker.record_failure()
+        breaker.record_failure()
+        # a success in between starts the count again
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual((breaker.state, breaker.trips), (CircuitBreaker.OPEN, 1))
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.retry_in(), 30.0)
+
+    def test_retry_after_trips_at_once(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30.0)
+        breaker.record_failure(retry_after=120.0)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.retry_in(), 120.0)
+
+    def test_half_open_lets_one_trial_through(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30.0)
+        breaker.record_failure()
+        self.clock.now += 29.0
+        self.assertFalse(breaker.allow())
+        self.clock.now += 1.0
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # only the one trial request is let through until it comes back
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.rejected, 2)
+
+    def test_failed_trial_opens_again(self):
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30.0)
+        breaker.record_failure(retry_after=10.0)
+        self.clock.now += 30.0
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.retry_in(), 30.0)
+
+    def test_successful_trial_resets(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30.0)
+        breaker.record_failure()
+        self.clock.now += 30.0
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual((breaker.state, breaker.failures), (CircuitBreaker.CLOSED, 0))
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.retry_in(), 0.0)
+
+
+class RateLimiterTest(ClockTest):
+    def test_burst_up_to_capacity(self):
+        limiter = RateLimiter(rate=2.0, capacity=3)
+        self.assertEqual([limiter.acquire() for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertEqual(self.clock.slept, [])
+
+    def test_waits_for_refill(self):
+        limiter = RateLimiter(rate=2.0, capacity=3)
+        for _ in range(3):
+            limiter.acquire()
+        self.assertEqual(limiter.acquire(), 0.5)
+        self.assertEqual((limiter.throttled, limiter.total_wait), (1, 0.5))
+
+    def test_refill_is_capped_at_capacity(self):
+        limiter = RateLimiter(rate=2.0, capacity=3)
+        for _ in range(3):
+            limiter.acquire()
+        self.clock.now += 60.0
+        self.assertEqual([limiter.acquire() for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertEqual(limiter.acquire(), 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
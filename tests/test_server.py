@@ -0,0 +1,103 @@
+import os
+import sys
+import threading
+import unittest
+from datetime import date
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from FHIRapp import (CircuitBreaker, Model, Normaliser, Patient, RateLimiter, Server, ServerResponseError,
+                     ServerUnavailableError)
+from stand_in import StandInFHIRServer
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.fhir = StandInFHIRServer()
+        threading.Thread(target=self.fhir.serve_forever, daemon=True).start()
+        self.rate_limiter = Server.rate_limiter
+        self.circuit_breaker = Server.circuit_breaker
+        Server.rate_limiter = RateLimiter(rate=1000, capacity=1000)
+        Server.circuit_breaker = CircuitBreaker()
+        self.server = Server(Model())
+        self.server.root_url = self.fhir.url
+
+    def tearDown(self):
+        Server.rate_limiter = self.rate_limiter
+        Server.circuit_breaker = self.circuit_breaker
+        self.fhir.shutdown()
+        self.fhir.server_close()
+
+    def test_failed_observation_fetch_is_retried(self):
+        self.fhir.add_report("p1", "r1", "2010-01-02", 190.0)
+        patient = Patient("Ann Lee", 190.0, '-', '-', '-', date(2010, 1, 2), '-', '-', '-', "p1", '-', '-')
+        self.fhir.add_report("p1", "r2", "2012-05-05", 250.0)
+        self.fhir.failures["/Observation/r2"] = 1
+        with self.assertRaises(ServerUnavailableError):
+            self.server.update_patient(patient)
+        # nothing of the new report is kept, so the next poll merges it again
+        self.assertEqual((patient._total_chol, patient._last_update), (190.0, date(2010, 1, 2)))
+        self.server.update_patient(patient)
+        self.assertEqual((patient._total_chol, patient._last_update), (250.0, date(2012, 5, 5)))
+
+    def test_missing_resource_is_a_response_error(self):
+        Server.circuit_breaker.record_failure()
+        with self.assertRaises(ServerResponseError) as raised:
+            self.server.get_json(self.fhir.url + "Observation/missing")
+        self.assertEqual(raised.exception.status_code, 404)
+        # the server answered, so the breaker counts it as up
+        self.assertEqual(Server.circuit_breaker.failures, 0)
+
+    def test_open_breaker_takes_no_token(self):
+        Server.rate_limiter = RateLimiter(rate=0.001, capacity=1)
+        Server.circuit_breaker = CircuitBreaker(failure_threshold=1)
+        Server.circuit_breaker.record_failure()
+        with self.assertRaises(ServerUnavailableError):
+            self.server.get(self.fhir.url + "Observation")
+        self.assertEqual(Server.rate_limiter.tokens, 1)
+
+    def test_dropped_body_is_server_unavailable(self):
+        self.fhir.add_report("p1", "r1", "2010-01-02", 190.0)
+        self.fhir.truncated.add("/DiagnosticReport")
+        with self.assertRaises(ServerUnavailableError):
+            self.server.fetch_records(self.fhir.url + "DiagnosticReport?patient=p1", "report")
+        self.assertEqual(Server.circuit_breaker.failures, 1)
+        Server.circuit_breaker = CircuitBreaker(failure_threshold=1)
+        with self.assertRaises(ServerUnavailableError):
+            self.fetch_reports()
+        self.assertEqual(Server.circuit_breaker.state, CircuitBreaker.OPEN)
+
+    def fetch_reports(self, previous=None):
+        return self.server.fetch_changes(self.fhir.url + "DiagnosticReport?patient=p1", "report", previous)
+
+    def test_unchanged_bundle_is_not_normalised(self):
+        self.fhir.add_report("p1", "r1", "2010-01-02", 190.0)
+        records, fingerprint = self.fetch_reports()
+        self.assertEqual([record.values for record in records], [("Observation/r1",)])
+        with mock.patch.object(Normaliser, "normalise_delta", side_effect=AssertionError("bundle was normalised")):
+            self.assertEqual(self.fetch_reports(fingerprint), ([], fingerprint))
+
+    def test_changed_bundle_only_normalises_new_entries(self):
+        self.fhir.add_report("p1", "r1", "2010-01-02", 190.0)
+        records, fingerprint = self.fetch_reports()
+        self.fhir.add_report("p1", "r2", "2012-05-05", 250.0)
+        records, fingerprint = self.fetch_reports(fingerprint)
+        self.assertEqual([record.values for record in records], [("Observation/r2",)])
+        self.assertEqual(len(fingerprint[1]), 2)
+
+    def test_unchanged_bundle_with_etag_is_not_modified(self):
+        self.fhir.etags = True
+        self.fhir.add_report("p1", "r1", "2010-01-02", 190.0)
+        records, fingerprint = self.fetch_reports()
+        self.assertIsInstance(fingerprint[0], str)
+        with mock.patch.object(Normaliser, "normalise_delta", side_effect=AssertionError("bundle was normalised")):
+            self.assertEqual(self.fetch_reports(fingerprint), ([], fingerprint))
+        self.fhir.add_report("p1", "r2", "2012-05-05", 250.0)
+        records, fingerprint = self.fetch_reports(fingerprint)
+        self.assertEqual([record.values for record in records], [("Observation/r2",)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import threading
+import unittest
+from datetime import date
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from FHIRapp import Model, Patient, RateLimiter, Server, ServerUnavailableError, SubscriptionReceiver
+from stand_in import StandInFHIRServer
+
+
+class SubscriptionTest(unittest.TestCase):
+    def setUp(self):
+        self.fhir = StandInFHIRServer()
+        threading.Thread(target=self.fhir.serve_forever, daemon=True).start()
+        self.receiver = SubscriptionReceiver()
+        self.receiver.start()
+        self.rate_limiter = Server.rate_limiter
+        Server.rate_limiter = RateLimiter(rate=1000, capacity=1000)
+        self.server = Server(Model())
+        self.server.root_url = self.fhir.url
+
+    def tearDown(self):
+        Server.rate_limiter = self.rate_limiter
+        self.receiver.stop()
+        self.fhir.shutdown()
+        self.fhir.server_close()
+
+    def test_subscriptions_are_created_and_deleted(self):
+        subscription_ids = self.server.create_subscriptions("p1", self.receiver.url_for("p1"))
+        self.assertEqual(len(subscription_ids), 2)
+        self.assertEqual(sorted(subscription["criteria"] for subscription in self.fhir.subscriptions.values()),
+                         ["DiagnosticReport?patient=p1", "Observation?code=55284-4&patient=p1"])
+        for subscription_id in subscription_ids:
+            self.server.delete_subscription(subscription_id)
+        self.assertEqual(self.fhir.subscriptions, {})
+
+    def test_refused_subscription_raises(self):
+        self.fhir.refuse = True
+        with self.assertRaises(ServerUnavailableError):
+            self.server.create_subscriptions("p1", self.receiver.url_for("p1"))
+
+    def test_notification_updates_patient(self):
+        self.fhir.add_report("p1", "r1", "2010-01-02", 190.0)
+        patient = Patient("Ann Lee", 190.0, '-', '-', '-', date(2010, 1, 2), '-', '-', '-', "p1", '-', '-')
+        self.server.create_subscriptions("p1", self.receiver.url_for("p1"))
+
+        self.fhir.add_report("p1", "r2", "2012-05-05", 250.0)
+        self.assertEqual(self.receiver.notifications.get(timeout=5), "p1")
+        self.server.update_patient(patient)
+        self.assertEqual(patient._total_chol, 250.0)
+        self.assertEqual(patient._last_update, date(2012, 5, 5))
+
+    def test_notification_with_payload(self):
+        self.server.create_subscriptions("p1", self.receiver.url_for("p1"))
+        self.fhir.add_report("p1", "r1", "2012-05-05", 250.0, payload=True)
+        self.assertEqual(self.receiver.notifications.get(timeout=5), "p1")
+
+    def test_unknown_path_is_rejected(self):
+        base_url = "http://127.0.0.1:" + str(self.receiver.port)
+        self.assertEqual(requests.post(base_url + "/patient").status_code, 404)
+        self.assertEqual(requests.post(base_url + "/other/p1").status_code, 404)
+        self.assertEqual(requests.put(base_url + "/patient/p1/DiagnosticReport").status_code, 404)
+        self.assertTrue(self.receiver.notifications.empty())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import FHIRapp
+from FHIRapp import TreeView, VirtualTreeView
+
+
+class FakeTree:
+    """
+    Stand-in for the ttk.Treeview the lists draw into, holding the order of the attached items as tkinter does, so
+    the lists can be tested without a display.
+    """
+    def __init__(self, *args, **kwargs):
+        self.children = []
+        self.attached = set()
+        self.items = {}
+        self.selected = ()
+        self.idle = []
+
+    def insert(self, parent, index, iid, text="", values=(), tags=()):
+        self.items[iid] = (text, values, tags)
+        self.attach_at(iid, index)
+
+    def attach_at(self, iid, index):
+        if iid in self.attached:
+            self.children.remove(iid)
+        self.attached.add(iid)
+        if index == "end":
+            self.children.append(iid)
+        else:
+            self.children.insert(index, iid)
+
+    def move(self, iid, parent, index):
+        self.attach_at(iid, index)
+
+    def detach(self, *iids):
+        leaving = set(iids)
+        self.attached -= leaving
+        self.children = [iid for iid in self.children if iid not in leaving]
+
+    def delete(self, *iids):
+        self.detach(*iids)
+        for iid in iids:
+            del self.items[iid]
+        self.selected = tuple(iid for iid in self.selected if iid not in iids)
+
+    def item(self, iid, text=None, values=None, tags=None):
+        old_text, old_values, old_tags = self.items[iid]
+        self.items[iid] = (old_text if text is None else text, old_values if values is None else values,
+                           old_tags if tags is None else tags)
+
+    def selection(self):
+        return self.selected
+
+    def selection_set(self, iid):
+        self.selected = (iid,)
+
+    def after_idle(self, callback):
+        self.idle.append(callback)
+
+    def run_idle(self):
+        idle, self.idle = self.idle, []
+        for callback in idle:
+            callback()
+
+    def ignore(self, *args, **kwargs):
+        pass
+
+    heading = column = bind = configure = yview = yview_moveto = yview_scroll = event_generate = ignore
+
+    def exists(self, iid):
+        return iid in self.items
+
+    def get_children(self):
+        return tuple(self.children)
+
+
+class FakeScrollbar:
+    def __init__(self, *args, **kwargs):
+        self.position = (0, 1)
+
+    def set(self, first, last):
+        self.position = (first, last)
+
+    def pack(self, *args, **kwargs):
+        pass
+
+    configure = pack
+
+
+class PlainList(TreeView):
+    def __init__(self):
+        self.patient_dict = {}
+        self.patient_tree = FakeTree()
+
+
+class ShowRowsTest(unittest.TestCase):
+    def setUp(self):
+        self.view = PlainList()
+        for index in range(50000):
+            self.view.insert_row(str(index), "", ())
+
+    def test_reversed_order_is_fast(self):
+        order = [str(index) for index in reversed(range(50000))]
+        start = time.perf_counter()
+        self.view.show_rows(order)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(list(self.view.patient_tree.get_children()), order)
+
+    def test_rows_left_out_are_detached(self):
+        self.view.show_rows(["3", "1", "2"])
+        self.assertEqual(self.view.patient_tree.get_children(), ("3", "1", "2"))
+        self.view.show_rows(["3", "1", "4", "missing"])
+        self.assertEqual(self.view.patient_tree.get_children(), ("3", "1", "4"))
+
+
+class VirtualTreeViewTest(unittest.TestCase):
+    def setUp(self):
+        with mock.patch.object(FHIRapp.ttk, "Treeview", FakeTree), \
+                mock.patch.object(FHIRapp.ttk, "Scrollbar", FakeScrollbar):
+            self.view = VirtualTreeView(None, overscan=2)
+        self.tree = self.view.patient_tree
+        for index in range(50):
+            self.view.insert_row(str(index), "Patient " + str(index), (index,))
+        self.tree.run_idle()
+
+    def test_only_the_window_is_materialised(self):
+        self.assertEqual(self.tree.get_children(), tuple(str(index) for index in range(12)))
+        self.view.set_first(20)
+        self.assertEqual(self.tree.get_children(), tuple(str(index) for index in range(18, 32)))
+
+    def test_deleted_rows_leave_the_order(self):
+        for index in range(0, 50, 2):
+            self.view.delete_row(str(index))
+        self.tree.run_idle()
+        odd = tuple(str(index) for index in range(1, 50, 2))
+        self.assertEqual(self.view.row_ids(), odd)
+        self.assertEqual(self.tree.get_children(), odd[:12])
+        self.assertEqual([self.view.positions[iid] for iid in odd], list(range(25)))
+        # a deleted row can be inserted again, at the end
+        self.view.insert_row("0", "Patient 0", (0,))
+        self.assertEqual(self.view.row_ids(), odd + ("0",))
+
+    def test_deleting_many_rows_is_fast(self):
+        for index in range(50, 50000):
+            self.view.insert_row(str(index), "", ())
+        start = time.perf_counter()
+        for index in range(0, 50000, 2):
+            self.view.delete_row(str(index))
+        self.tree.run_idle()
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(len(self.view.row_ids()), 25000)
+
+    def test_keyboard_moves_the_selection(self):
+        self.tree.selection_set("3")
+        self.view.on_select(None)
+        self.view.move_selection(1)
+        self.assertEqual(self.view.selected_id(), "4")
+        self.view.delete_row("5")
+        self.view.move_selection(1)
+        self.assertEqual(self.view.selected_id(), "6")
+
+    def test_selection_is_cleared_when_the_row_is_deleted(self):
+        self.tree.selection_set("3")
+        self.view.on_select(None)
+        self.view.delete_row("3")
+        self.assertIsNone(self.view.selected_id())
+        self.view.insert_row("3", "Patient 3", (3,))
+        self.assertIsNone(self.view.selected_id())
+
+    def test_selection_is_cleared_when_the_row_is_deselected(self):
+        self.tree.selection_set("3")
+        self.view.on_select(None)
+        self.tree.selected = ()
+        self.view.on_select(None)
+        self.assertIsNone(self.view.selected_id())
+
+    def test_selection_is_kept_when_the_row_scrolls_out_of_view(self):
+        self.tree.selection_set("3")
+        self.view.on_select(None)
+        self.view.set_first(30)
+        # the item of the row is deleted, which deselects it
+        self.view.on_select(None)
+        self.assertEqual(self.view.selected_id(), "3")
+        self.view.set_first(0)
+        self.assertEqual(self.tree.selection(), ("3",))
+
+
+if __name__ == "__main__":
+    unittest.main()